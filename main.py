@@ -99,6 +99,11 @@ class SpectreCore(Star):
         self.config = config
         HistoryStorage.init(config)
         ImageCaptionUtils.init(context, config)
+        ImageTranscoder.init(config)
+        TokenEstimator.init(config)
+        PersonaUtils.init(config)
+        MemoryBridge.init(config)
+        HistoryStorage.start_caption_warmup()
         self.dossier_manager = UserDossierManager(self)
         
         self.enable_forward_analysis = self.config.get("enable_forward_analysis", True)
@@ -135,6 +140,11 @@ class SpectreCore(Star):
             return False
             
     async def _process_message(self, event: AstrMessageEvent):
+        # 会话切换人格（/persona）后立即丢弃该会话的人格缓存
+        command_text = (event.message_str or "").strip().lstrip("/")
+        if command_text.startswith("persona"):
+            PersonaUtils.invalidate(event.unified_msg_origin)
+
         # 静默期间仅保留归档与图片转述调度，禁止默认 LLM 链路。
         if self._is_temp_muted():
             await HistoryStorage.process_and_save_user_message(event)
@@ -239,32 +249,24 @@ class SpectreCore(Star):
             sender_id = event.get_sender_id() or "unknown"
 
             prompt_template = self.config.get("forward_analysis_prompt", self.DEFAULT_ANALYSIS_PROMPT)
-            base_prompt = prompt_template.replace("{sender_name}", str(sender_name)) \
-                                         .replace("{sender_id}", str(sender_id)) \
-                                         .replace("{user_query}", str(user_query)) \
-                                         .replace("{chat_records}", chat_records_injection)
+            base_prompt = PromptTemplate.render(
+                prompt_template,
+                {
+                    "sender_name": sender_name,
+                    "sender_id": sender_id,
+                    "user_query": user_query,
+                    "chat_records": chat_records_injection,
+                },
+            )
 
             event._is_forward_analysis = True
             
             persona_system_prompt = ""
             try:
-                if hasattr(PersonaUtils, "resolve_persona_v3"):
-                    persona = await PersonaUtils.resolve_persona_v3(
-                        self.context,
-                        event.unified_msg_origin,
-                    )
-                else:
-                    persona = await self.context.persona_manager.get_default_persona_v3(
-                        umo=event.unified_msg_origin
-                    )
-                if persona:
-                    persona_system_prompt = persona.get("prompt", "")
-                    mood_dialogs = persona.get("_mood_imitation_dialogs_processed", "")
-                    if mood_dialogs:
-                        persona_system_prompt += (
-                            "\n请模仿以下示例的对话风格来反应(示例中，a代表用户，b代表你)\n"
-                            + str(mood_dialogs)
-                        )
+                _persona, persona_system_prompt = await PersonaUtils.get_persona_prompt(
+                    self.context,
+                    event.unified_msg_origin,
+                )
             except Exception as e:
                 logger.error(f"加载人设失败: {e}")
 
@@ -328,6 +330,7 @@ class SpectreCore(Star):
                                     prepared = src
 
                             if prepared:
+                                prepared = await ImageTranscoder.prepare(prepared)
                                 img_count += 1
                                 imgs.append(prepared)
                                 parts.append(f"[图片{img_count}]")
@@ -435,13 +438,7 @@ class SpectreCore(Star):
         if dossier_vars:
             replacements.update({k: v for k, v in dossier_vars.items() if k != "first_interaction"})
 
-        instruction = template
-        for key, value in replacements.items():
-            if value is None:
-                continue
-            instruction = instruction.replace(f"{{{key}}}", str(value))
-
-        return instruction
+        return PromptTemplate.render(template, replacements)
 
     @filter.on_llm_request(priority=90)
     async def on_llm_request_custom(self, event: AstrMessageEvent, req: ProviderRequest):
@@ -465,102 +462,37 @@ class SpectreCore(Star):
                 history_str = ""
             if not history_str:
                 history_str = getattr(event, "_spectre_history", "")
+            volatile_block = ""
+            try:
+                volatile_block = event.get_extra("spectre_volatile", "") or ""
+            except Exception:
+                volatile_block = ""
+            if not volatile_block:
+                volatile_block = getattr(event, "_spectre_volatile", "")
             if not history_str and spectre_request:
                 try:
-                    platform_name = event.get_platform_name()
-                    is_private = event.is_private_chat()
-                    chat_id = event.get_group_id() if not is_private else event.get_sender_id()
-                    all_msgs = await HistoryStorage.get_history_async(
-                        platform_name, is_private, chat_id
-                    )
-                    msg_limit = self.config.get("group_msg_history", 10)
-                    bot_history_keep = self.config.get("bot_reply_history_count", 3)
-                    image_processing_cfg = self.config.get("image_processing", {})
-                    use_image_caption = bool(image_processing_cfg.get("use_image_caption", False))
-                    current_msg_id = getattr(event.message_obj, "message_id", None)
-                    current_msg_id = str(current_msg_id) if current_msg_id is not None else None
-
-                    history_str = "（暂无历史记录）"
-                    if all_msgs:
-                        tail_msgs = all_msgs[-msg_limit:] if len(all_msgs) > msg_limit else all_msgs
-
-                        recent_bot_msgs = []
-                        if bot_history_keep > 0:
-                            bot_msgs = []
-                            bot_self_id = str(event.get_self_id())
-                            for msg in all_msgs:
-                                sender_id = None
-                                if hasattr(msg, "sender") and msg.sender:
-                                    sender_id = str(msg.sender.user_id)
-                                if sender_id == bot_self_id:
-                                    bot_msgs.append(msg)
-                            if bot_msgs:
-                                recent_bot_msgs = bot_msgs[-bot_history_keep:]
-
-                        seen_timestamps = set()
-                        merged_list = []
-                        for msg in tail_msgs:
-                            merged_list.append(msg)
-                            if hasattr(msg, "timestamp"):
-                                seen_timestamps.add(msg.timestamp)
-
-                        for bot_msg in recent_bot_msgs:
-                            ts = getattr(bot_msg, "timestamp", 0)
-                            if ts not in seen_timestamps:
-                                merged_list.append(bot_msg)
-                                seen_timestamps.add(ts)
-
-                        merged_list.sort(key=lambda x: getattr(x, "timestamp", 0))
-                        if current_msg_id:
-                            merged_list = [
-                                msg
-                                for msg in merged_list
-                                if str(getattr(msg, "message_id", "")) != current_msg_id
-                            ]
-
-                        fmt = await MessageUtils.format_history_for_llm(
-                            merged_list,
-                            max_messages=999,
-                            image_caption=use_image_caption,
-                            platform_name=platform_name,
-                            is_private=is_private,
-                            chat_id=str(chat_id),
-                            uploaded_images=None,
-                        )
-                        if fmt:
-                            history_str = "以下是最近的聊天记录：\n" + fmt
+                    snapshot = ContextSnapshot.from_event(event)
+                    if snapshot is not None and snapshot.history_text:
+                        history_str = snapshot.history_text
+                    else:
+                        if snapshot is None:
+                            snapshot = await ContextSnapshot.capture(event, self.config)
+                        image_processing_cfg = self.config.get("image_processing", {})
+                        use_image_caption = bool(image_processing_cfg.get("use_image_caption", False))
+                        history_str = await snapshot.render(use_image_caption)
                 except Exception as e:
                     logger.warning(f"[SpectreCore] 历史兜底构建失败: {e}")
             current_msg = req.prompt or "[图片/非文本消息]"
-            mem_data = ""
             sender_name = event.get_sender_name() or "用户"
             sender_id = str(event.get_sender_id() or "unknown")
             dossier_profile = await self.dossier_manager.get_or_create_profile(sender_id, sender_name)
             dossier_vars = self.dossier_manager.build_prompt_variables(dossier_profile)
-            mnemosyne_plugin = None
-
-            # 预获取 Mnemosyne 插件实例和记忆数据，避免对用户原始消息的二次污染
-            all_stars = self.context.get_all_stars()
-            for star_meta in all_stars:
-                if star_meta.name == "Mnemosyne" or star_meta.name == "astrbot_plugin_mnemosyne":
-                    # AstrBot 的 StarMetadata 使用 star_cls 保存实例
-                    if getattr(star_meta, "star_cls", None):
-                        mnemosyne_plugin = star_meta.star_cls
-                    elif hasattr(star_meta, "plugin"):
-                        mnemosyne_plugin = star_meta.plugin
-                    elif hasattr(star_meta, "star"):
-                        mnemosyne_plugin = star_meta.star
-                    elif hasattr(star_meta, "plugin_instance"):
-                        mnemosyne_plugin = star_meta.plugin_instance
-                    
-                    if mnemosyne_plugin:
-                        break
-
-            if mnemosyne_plugin and hasattr(mnemosyne_plugin, "get_memory_data"):
-                mem_data = mnemosyne_plugin.get_memory_data(event.unified_msg_origin) or ""
-                if mem_data and mem_data in current_msg:
-                    stripped = current_msg.replace(mem_data, "").strip()
-                    current_msg = stripped or current_msg
+
+            # 预获取 Mnemosyne 记忆数据，避免对用户原始消息的二次污染
+            mem_data = await MemoryBridge.fetch(self.context, event.unified_msg_origin)
+            if mem_data and mem_data in current_msg:
+                stripped = current_msg.replace(mem_data, "").strip()
+                current_msg = stripped or current_msg
             
             instruction = ""
 
@@ -594,16 +526,37 @@ class SpectreCore(Star):
                 # 1. 渲染模板 (Try Rendering)
                 # 使用 format_map 允许部分 key 缺失，或者手动 replace 更安全
                 rendered_prompt = instruction.replace("{memory_block}", mem_data)
-                prompt_parts = [p for p in [history_str, rendered_prompt] if p]
+                # 易变内容（缓存友好布局下的时间/图片说明）始终放在最后
+                prompt_parts = [p for p in [history_str, rendered_prompt, volatile_block] if p]
                 final_prompt = "\n\n".join(prompt_parts)
                 
                 # [Visual Log] 成功组装
                 mem_status = f"✅ 已注入 ({len(mem_data)} chars)" if mem_data else "⚪ 无记忆/获取失败"
+                snapshot = ContextSnapshot.from_event(event)
+                history_report = snapshot.history_report if snapshot is not None else {}
+                history_tokens = history_report.get("tokens")
+                if history_tokens is None:
+                    history_tokens = TokenEstimator.estimate(history_str)
+                token_sections = {
+                    "系统": TokenEstimator.estimate(getattr(req, "system_prompt", "") or ""),
+                    "历史": history_tokens,
+                    "记忆": TokenEstimator.estimate(mem_data),
+                    "指令": TokenEstimator.estimate(instruction.replace("{memory_block}", "")),
+                }
+                if volatile_block:
+                    token_sections["易变"] = TokenEstimator.estimate(volatile_block)
+                token_total = sum(token_sections.values())
+                history_kept = ""
+                if history_report.get("messages"):
+                    history_kept = f" | 历史保留 {history_report.get('kept', 0)}/{history_report['messages']} 条"
+                if history_report.get("saved"):
+                    history_kept += f" | 紧凑格式节省约 {history_report['saved']} tokens"
                 logger.info("\n" + "╔" + "═"*50 + "╗")
                 logger.info(f"║ 🎭 [SpectreCore] Prompt 组装成功")
                 logger.info("╠" + "═"*50 + "╣")
                 logger.info(f"║ 🧠 记忆模块: {mem_status}")
                 logger.info(f"║ 🚀 最终长度: {len(final_prompt)} chars")
+                logger.info(f"║ 🔢 Token 估算: {TokenEstimator.format_report(token_sections)} / 合计 {token_total}{history_kept}")
                 logger.info("╚" + "═"*50 + "╝\n")
                 # 完整打印最终提示词与记忆，方便后台排查触发与注入
                 if mem_data:
@@ -620,13 +573,30 @@ class SpectreCore(Star):
                 
                 # 降级：仅拼接历史和原始指令（不做任何变量替换）
                 fallback_prompt = f"{history_str}\n\n{instruction}" if history_str else instruction
+                if volatile_block:
+                    fallback_prompt += f"\n\n{volatile_block}"
                 req.prompt = fallback_prompt
                 
                 # [Visual Log] 展示完整的降级 Prompt (无省略)
                 logger.info(f"🛡️ 降级 Prompt 完整内容:\n{'-'*20}\n{fallback_prompt}\n{'-'*20}")
             
+            try:
+                reuse = PromptCacheTracker.observe(
+                    event.unified_msg_origin,
+                    [
+                        getattr(req, "system_prompt", "") or "",
+                        json.dumps(getattr(req, "contexts", None) or [], ensure_ascii=False, default=str),
+                        req.prompt or "",
+                    ],
+                )
+                logger.info(f"[SpectreCore] 前缀复用率（对比该会话上一次请求）: {reuse:.0%}")
+            except Exception as e:
+                logger.debug(f"[SpectreCore] 前缀指纹计算失败: {e}")
+
             if hasattr(event, "_spectre_history"):
                 delattr(event, "_spectre_history")
+            if hasattr(event, "_spectre_volatile"):
+                delattr(event, "_spectre_volatile")
 
         except Exception as e:
             logger.error(f"[SpectreCore Pro] Prompt 组装失败: {e}")
@@ -786,6 +756,7 @@ class SpectreCore(Star):
             "/sc mute <分钟> - 临时静默（需管理员）",
             "/sc unmute - 解除静默（需管理员）",
             "/sc callllm - 直接触发 LLM 调用（管理员）",
+            "/sc cachestats - 查看缓存运行统计（需管理员）",
             "/sc dossier [user_id] [section] - 查看档案（需管理员），section: all/identity/category/impression/recent/taboo/weakness",
             "/sc dossier_edit <user_id> <field> <value> [index] - 修订档案（需管理员），field: name/names,codename,type,emotion,positioning,commentary,recent,taboo,weakness；index 仅用于列表替换",
             "/sc dossier_del <user_id> <field> <index> - 删除条目（需管理员），field: names/recent/taboo/weakness",
@@ -985,8 +956,75 @@ class SpectreCore(Star):
     async def callllm(self, event: AstrMessageEvent):
         yield await LLMUtils.call_llm(event, self.config, self.context)
 
+    @filter.permission_type(filter.PermissionType.ADMIN)
+    @spectrecore.command("cachestats")
+    async def cachestats(self, event: AstrMessageEvent):
+        """查看各级缓存的命中/淘汰统计"""
+        stats = ImageCaptionUtils.get_stats()
+        mem = stats.get("memory", {})
+        queue = stats.get("queue", {})
+        negative = stats.get("negative", {})
+        hedge = stats.get("hedge", {})
+        batch = stats.get("batch", {})
+        lines = [
+            "SpectreCore 缓存统计：",
+            (
+                f"[转述内存缓存] 条目 {mem.get('entries', 0)}，"
+                f"占用 {mem.get('bytes', 0) / 1024:.1f} KB，"
+                f"命中 {mem.get('hits', 0)} / 未命中 {mem.get('misses', 0)} "
+                f"({mem.get('hit_rate', 0.0):.0%})，"
+                f"淘汰 {mem.get('evictions', 0)}，过期 {mem.get('expirations', 0)}"
+            ),
+            (
+                f"[转述队列] 排队 {queue.get('queued', 0)}，执行中 {queue.get('running', 0)}，"
+                f"已完成 {queue.get('completed', 0)}，"
+                f"超时丢弃 {queue.get('dropped_stale', 0)}，满队丢弃 {queue.get('dropped_overflow', 0)}"
+            ),
+            (
+                f"[转述失败退避] 跟踪 {negative.get('tracked', 0)} 张，累计失败 {negative.get('failures', 0)}，"
+                f"放弃 {negative.get('given_up', 0)}，已避免调用 {negative.get('avoided', 0)} 次"
+            ),
+            f"[转述提供商] 对冲 {hedge.get('hedged', 0)} 次，非首选胜出 {hedge.get('fallback_wins', 0)} 次",
+            (
+                f"[批量转述] 请求 {batch.get('batches', 0)} 次，合并转述 {batch.get('batched_images', 0)} 张，"
+                f"回退逐张 {batch.get('fallback_images', 0)} 张"
+            ),
+        ]
+        for label, info in stats.get("providers", {}).items():
+            p50, p90 = info.get("p50"), info.get("p90")
+            lines.append(
+                f"  - {label}: 调用 {info.get('calls', 0)}，失败 {info.get('failures', 0)}，"
+                f"p50 {f'{p50:.1f}s' if p50 is not None else '-'}，"
+                f"p90 {f'{p90:.1f}s' if p90 is not None else '-'}"
+            )
+        persona = PersonaUtils.cache_stats()
+        lines.append(
+            f"[人格缓存] 条目 {persona.get('entries', 0)}，命中 {persona.get('hits', 0)} / "
+            f"解析 {persona.get('resolves', 0)} 次（平均 {persona.get('avg_resolve_ms', 0.0):.1f} ms），"
+            f"失效 {persona.get('invalidations', 0)} 次，约节省 {persona.get('saved_ms', 0.0):.0f} ms"
+        )
+        memory = MemoryBridge.stats()
+        memo_desc = (
+            f"命中 {memory.get('hits', 0)} / 未命中 {memory.get('misses', 0)}，条目 {memory.get('entries', 0)}"
+            if memory.get("enabled") else "记忆缓存未启用"
+        )
+        lines.append(
+            f"[Mnemosyne] 插件{'已连接' if memory.get('plugin') else '未找到'}（查找 {memory.get('lookups', 0)} 次），{memo_desc}"
+        )
+        prefix = PromptCacheTracker.stats()
+        lines.append(
+            f"[前缀复用] 请求 {prefix.get('requests', 0)} 次，跟踪会话 {prefix.get('chats', 0)} 个，"
+            f"可复用前缀占比 {prefix.get('reuse_ratio', 0.0):.0%}"
+        )
+        yield event.plain_result("\n".join(lines))
+
     # [核心修复] 插件终止清理逻辑
     async def terminate(self):
         """插件终止时清理资源，防止内存泄漏"""
         LLMUtils._llm_call_status.clear()
+        CaptionScheduler.stop()
+        ImageTranscoder.shutdown()
+        ImagePHash.flush()
+        ImageCaptionUtils.flush_pending()
+        CaptionStore.close()
         logger.info("[SpectreCore] 资源已释放。")
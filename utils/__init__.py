@@ -10,6 +10,17 @@ from .persona_utils import PersonaUtils
 from .text_filter import TextFilter
 from .reply_decision import ReplyDecision
 from .dossier_manager import UserDossierManager
+from .image_transcode import ImageTranscoder
+from .image_phash import ImagePHash
+from .caption_store import CaptionStore
+from .lru_cache import LRUCache
+from .caption_scheduler import CaptionScheduler
+from .latency_tracker import LatencyTracker
+from .context_snapshot import ContextSnapshot
+from .token_estimator import TokenEstimator
+from .memory_bridge import MemoryBridge
+from .prompt_cache import PromptCacheTracker
+from .prompt_template import PromptTemplate
 
 __all__ = [
     "HistoryStorage",
@@ -19,5 +30,16 @@ __all__ = [
     "PersonaUtils",
     "TextFilter",
     "ReplyDecision",
-    "UserDossierManager"
+    "UserDossierManager",
+    "ImageTranscoder",
+    "ImagePHash",
+    "CaptionStore",
+    "LRUCache",
+    "CaptionScheduler",
+    "LatencyTracker",
+    "ContextSnapshot",
+    "TokenEstimator",
+    "MemoryBridge",
+    "PromptCacheTracker",
+    "PromptTemplate",
 ]
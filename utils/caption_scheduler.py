@@ -0,0 +1,292 @@
+from __future__ import annotations
+
+import asyncio
+import heapq
+import itertools
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from astrbot.api.all import logger
+
+
+class CaptionJob:
+    """一条待转述的图片任务。"""
+
+    __slots__ = (
+        "key",
+        "image",
+        "platform_name",
+        "is_private",
+        "chat_id",
+        "priority",
+        "msg_ts",
+        "enqueued_at",
+        "urgent",
+    )
+
+    def __init__(
+        self,
+        key: str,
+        image: str,
+        platform_name: str,
+        is_private: bool,
+        chat_id: str,
+        priority: int,
+        msg_ts: float | None = None,
+    ):
+        self.key = key
+        self.image = image
+        self.platform_name = platform_name
+        self.is_private = is_private
+        self.chat_id = chat_id
+        self.priority = priority
+        self.enqueued_at = time.time()
+        self.msg_ts = msg_ts if msg_ts is not None else self.enqueued_at
+        # 有请求正在等待该结果：不因目标会话 LLM 繁忙而暂缓
+        self.urgent = False
+
+    def sort_key(self) -> tuple[int, float]:
+        # 先按优先级档位，同档内越新的图片越先处理
+        return (self.priority, -float(self.msg_ts or 0))
+
+
+class CaptionScheduler:
+    """
+    图片转述调度器
+
+    取代逐图轮询：任务进入有界优先队列，由 caption_concurrency 个常驻 worker 消费。
+    目标会话的 LLM 正在生成时任务暂缓（expedite 标记的紧急任务除外），收到该会话"LLM 结束"信号后立即唤醒；
+    等待超过 busy_wait 秒仍照常执行。排队超过 stale_after 秒的任务直接丢弃（<= 0 表示不过期）。
+    """
+
+    PRIORITY_HIGH = 0
+    PRIORITY_NORMAL = 1
+    PRIORITY_LOW = 2
+
+    _runner: Callable[[List[CaptionJob]], Awaitable[Any]] | None = None
+    _is_busy: Callable[[CaptionJob], bool] | None = None
+    _on_drop: Callable[[CaptionJob], None] | None = None
+    _heap: List[tuple[tuple[int, float], int, CaptionJob]] = []
+    _seq = itertools.count()
+    _workers: List[asyncio.Task] = []
+    _wakeup: asyncio.Event | None = None
+    _concurrency = 2
+    _max_depth = 200
+    _stale_after = 600.0
+    _busy_wait = 60.0
+    _batch_size = 1
+    _running = 0
+    _stats: Dict[str, int] = {}
+
+    @staticmethod
+    def configure(
+        runner: Callable[[List[CaptionJob]], Awaitable[Any]],
+        is_busy: Callable[[CaptionJob], bool],
+        on_drop: Callable[[CaptionJob], None] | None = None,
+        concurrency: int = 2,
+        max_depth: int = 200,
+        stale_after: float = 600.0,
+        busy_wait: float = 60.0,
+        batch_size: int = 1,
+    ) -> None:
+        CaptionScheduler.stop()
+        CaptionScheduler._runner = runner
+        CaptionScheduler._is_busy = is_busy
+        CaptionScheduler._on_drop = on_drop
+        CaptionScheduler._concurrency = max(1, int(concurrency))
+        CaptionScheduler._max_depth = max(1, int(max_depth))
+        CaptionScheduler._stale_after = float(stale_after)
+        CaptionScheduler._busy_wait = float(busy_wait)
+        CaptionScheduler._batch_size = max(1, int(batch_size))
+        CaptionScheduler._stats = {
+            "submitted": 0,
+            "completed": 0,
+            "dropped_stale": 0,
+            "dropped_overflow": 0,
+        }
+
+    @staticmethod
+    def stop() -> None:
+        for task in CaptionScheduler._workers:
+            if not task.done():
+                task.cancel()
+        CaptionScheduler._workers = []
+        CaptionScheduler._wakeup = None
+        CaptionScheduler._running = 0
+        dropped = [item[2] for item in CaptionScheduler._heap]
+        CaptionScheduler._heap = []
+        for job in dropped:
+            CaptionScheduler._drop(job)
+
+    @staticmethod
+    def _drop(job: CaptionJob) -> None:
+        if CaptionScheduler._on_drop:
+            try:
+                CaptionScheduler._on_drop(job)
+            except Exception:
+                pass
+
+    @staticmethod
+    def _ensure_workers() -> None:
+        CaptionScheduler._workers = [t for t in CaptionScheduler._workers if not t.done()]
+        if CaptionScheduler._wakeup is None:
+            CaptionScheduler._wakeup = asyncio.Event()
+        while len(CaptionScheduler._workers) < CaptionScheduler._concurrency:
+            CaptionScheduler._workers.append(
+                asyncio.create_task(CaptionScheduler._worker())
+            )
+
+    @staticmethod
+    def submit(job: CaptionJob) -> bool:
+        """入队；队列已满且新任务不优于队尾时返回 False。需在事件循环中调用。"""
+        if CaptionScheduler._runner is None:
+            return False
+        heap = CaptionScheduler._heap
+        if len(heap) >= CaptionScheduler._max_depth:
+            worst_idx = max(range(len(heap)), key=lambda i: heap[i][0])
+            if heap[worst_idx][0] <= job.sort_key():
+                CaptionScheduler._stats["dropped_overflow"] += 1
+                return False
+            worst = heap[worst_idx][2]
+            heap[worst_idx] = heap[-1]
+            heap.pop()
+            heapq.heapify(heap)
+            CaptionScheduler._stats["dropped_overflow"] += 1
+            CaptionScheduler._drop(worst)
+        heapq.heappush(heap, (job.sort_key(), next(CaptionScheduler._seq), job))
+        CaptionScheduler._stats["submitted"] += 1
+        CaptionScheduler._ensure_workers()
+        CaptionScheduler.notify()
+        return True
+
+    @staticmethod
+    def claim(key: str) -> Optional[CaptionJob]:
+        """将尚未开始的任务移出队列交由调用方立即执行；已在执行或不存在时返回 None。"""
+        heap = CaptionScheduler._heap
+        for idx, item in enumerate(heap):
+            if item[2].key == key:
+                heap[idx] = heap[-1]
+                heap.pop()
+                heapq.heapify(heap)
+                return item[2]
+        return None
+
+    @staticmethod
+    def expedite(key: str) -> bool:
+        """将排队中的任务提升为 PRIORITY_HIGH 并标记为紧急；任务不在队列中时返回 False。"""
+        heap = CaptionScheduler._heap
+        for idx, item in enumerate(heap):
+            job = item[2]
+            if job.key != key:
+                continue
+            job.urgent = True
+            if job.priority > CaptionScheduler.PRIORITY_HIGH:
+                job.priority = CaptionScheduler.PRIORITY_HIGH
+                heap[idx] = (job.sort_key(), item[1], job)
+                heapq.heapify(heap)
+            CaptionScheduler.notify()
+            return True
+        return False
+
+    @staticmethod
+    def notify() -> None:
+        """唤醒等待中的 worker（新任务入队或某会话 LLM 结束时调用）。"""
+        if CaptionScheduler._wakeup is not None:
+            CaptionScheduler._wakeup.set()
+
+    @staticmethod
+    def _is_stale(job: CaptionJob, now: float) -> bool:
+        stale_after = CaptionScheduler._stale_after
+        return stale_after > 0 and now - job.enqueued_at > stale_after
+
+    @staticmethod
+    def _pick_ready() -> tuple[Optional[CaptionJob], Optional[float]]:
+        """取出优先级最高且可执行的任务；否则返回距最近一次超时放行的等待秒数。"""
+        now = time.time()
+        heap = CaptionScheduler._heap
+        skipped = []
+        picked = None
+        wait: Optional[float] = None
+        while heap:
+            item = heapq.heappop(heap)
+            job = item[2]
+            if CaptionScheduler._is_stale(job, now):
+                CaptionScheduler._stats["dropped_stale"] += 1
+                CaptionScheduler._drop(job)
+                continue
+            busy = False
+            try:
+                busy = not job.urgent and bool(CaptionScheduler._is_busy and CaptionScheduler._is_busy(job))
+            except Exception:
+                busy = False
+            waited = now - job.enqueued_at
+            if busy and waited < CaptionScheduler._busy_wait:
+                remain = CaptionScheduler._busy_wait - waited
+                wait = remain if wait is None else min(wait, remain)
+                skipped.append(item)
+                continue
+            picked = job
+            break
+        for item in skipped:
+            heapq.heappush(heap, item)
+        return picked, wait
+
+    @staticmethod
+    def _take_companions(job: CaptionJob) -> List[CaptionJob]:
+        """批量模式下，取出同一会话中优先级最高的其余任务与 job 合并为一批。"""
+        limit = CaptionScheduler._batch_size - 1
+        if limit <= 0 or not CaptionScheduler._heap:
+            return []
+        now = time.time()
+        same_chat = sorted(
+            (
+                item
+                for item in CaptionScheduler._heap
+                if item[2].platform_name == job.platform_name
+                and item[2].is_private == job.is_private
+                and item[2].chat_id == job.chat_id
+                and not CaptionScheduler._is_stale(item[2], now)
+            ),
+            key=lambda item: (item[0], item[1]),
+        )[:limit]
+        if not same_chat:
+            return []
+        taken = {id(item) for item in same_chat}
+        CaptionScheduler._heap = [
+            item for item in CaptionScheduler._heap if id(item) not in taken
+        ]
+        heapq.heapify(CaptionScheduler._heap)
+        return [item[2] for item in same_chat]
+
+    @staticmethod
+    async def _worker() -> None:
+        while True:
+            job, wait = CaptionScheduler._pick_ready()
+            if job is None:
+                wakeup = CaptionScheduler._wakeup
+                if wakeup is None:
+                    return
+                wakeup.clear()
+                try:
+                    await asyncio.wait_for(wakeup.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            batch = [job] + CaptionScheduler._take_companions(job)
+            CaptionScheduler._running += len(batch)
+            try:
+                await CaptionScheduler._runner(batch)
+                CaptionScheduler._stats["completed"] += len(batch)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"后台图片转述任务异常: {e}")
+            finally:
+                CaptionScheduler._running -= len(batch)
+
+    @staticmethod
+    def stats() -> Dict[str, int]:
+        data = dict(CaptionScheduler._stats)
+        data["queued"] = len(CaptionScheduler._heap)
+        data["running"] = CaptionScheduler._running
+        return data
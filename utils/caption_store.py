@@ -0,0 +1,184 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+from astrbot.api.all import logger
+
+
+class CaptionStore:
+    """
+    全局图片转述库
+
+    以图片内容哈希为键，跨会话共享转述结果：同一张图转发到多个群时，
+    只需调用一次视觉模型。会话级缓存文件只记录内容哈希，查询时经由此库解析。
+    最近用到的行保存在内存 LRU 中（由 put/get 填充，独立加锁）；事件循环上的同步
+    路径只读该 LRU（peek），不会等待 SQLite。
+    """
+
+    MEMO_LIMIT = 2000
+
+    db_path = None
+    _conn: sqlite3.Connection | None = None
+    _lock = threading.Lock()
+    _memo_lock = threading.Lock()
+    _memo: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+
+    @staticmethod
+    def init(cache_dir: str, max_age_days: int = 30) -> None:
+        CaptionStore.close()
+        CaptionStore.db_path = os.path.join(cache_dir, "captions.db")
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            conn = sqlite3.connect(CaptionStore.db_path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS captions ("
+                "content_hash TEXT PRIMARY KEY, "
+                "caption TEXT NOT NULL, "
+                "ts REAL NOT NULL, "
+                "provider TEXT, "
+                "prompt_version TEXT)"
+            )
+            if max_age_days > 0:
+                conn.execute(
+                    "DELETE FROM captions WHERE ts < ?",
+                    (time.time() - max_age_days * 86400,),
+                )
+            conn.commit()
+            CaptionStore._conn = conn
+        except Exception as e:
+            CaptionStore._conn = None
+            logger.error(f"初始化全局转述库失败: {e}")
+
+    @staticmethod
+    def close() -> None:
+        with CaptionStore._memo_lock:
+            CaptionStore._memo.clear()
+        with CaptionStore._lock:
+            conn = CaptionStore._conn
+            CaptionStore._conn = None
+            if conn is not None:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+
+    @staticmethod
+    def available() -> bool:
+        return CaptionStore._conn is not None
+
+    @staticmethod
+    def prompt_version(prompt: str) -> str:
+        return hashlib.sha1((prompt or "").encode("utf-8")).hexdigest()[:12]
+
+    @staticmethod
+    def _memo_get(content_hash: str) -> Optional[Dict[str, Any]]:
+        with CaptionStore._memo_lock:
+            row = CaptionStore._memo.get(content_hash)
+            if row is not None:
+                CaptionStore._memo.move_to_end(content_hash)
+            return row
+
+    @staticmethod
+    def _remember(content_hash: str, row: Dict[str, Any]) -> None:
+        with CaptionStore._memo_lock:
+            CaptionStore._memo[content_hash] = row
+            CaptionStore._memo.move_to_end(content_hash)
+            while len(CaptionStore._memo) > CaptionStore.MEMO_LIMIT:
+                CaptionStore._memo.popitem(last=False)
+
+    @staticmethod
+    def peek(content_hash: str | None) -> Optional[Dict[str, Any]]:
+        """仅查内存 LRU，不访问数据库，可在事件循环上调用。"""
+        if not content_hash:
+            return None
+        return CaptionStore._memo_get(content_hash)
+
+    @staticmethod
+    def get(content_hash: str | None) -> Optional[Dict[str, Any]]:
+        """
+        按内容哈希查询，返回 {"caption", "ts", "provider", "prompt_version"}。
+        未命中内存时会访问数据库，事件循环上请用 get_async 或 peek。
+        """
+        if not content_hash:
+            return None
+        row = CaptionStore._memo_get(content_hash)
+        if row is not None:
+            return row
+        with CaptionStore._lock:
+            conn = CaptionStore._conn
+            if conn is None:
+                return None
+            try:
+                found = conn.execute(
+                    "SELECT caption, ts, provider, prompt_version FROM captions WHERE content_hash = ?",
+                    (content_hash,),
+                ).fetchone()
+            except Exception as e:
+                logger.warning(f"查询全局转述库失败: {e}")
+                return None
+        if not found:
+            return None
+        row = {
+            "caption": found[0],
+            "ts": found[1],
+            "provider": found[2] or "",
+            "prompt_version": found[3] or "",
+        }
+        CaptionStore._remember(content_hash, row)
+        return row
+
+    @staticmethod
+    def put(
+        content_hash: str | None,
+        caption: str,
+        provider: str = "",
+        prompt_version: str = "",
+    ) -> None:
+        if not content_hash or not caption:
+            return
+        row = {
+            "caption": caption,
+            "ts": time.time(),
+            "provider": provider or "",
+            "prompt_version": prompt_version or "",
+        }
+        CaptionStore._remember(content_hash, row)
+        with CaptionStore._lock:
+            conn = CaptionStore._conn
+            if conn is None:
+                return
+            try:
+                conn.execute(
+                    "INSERT OR REPLACE INTO captions (content_hash, caption, ts, provider, prompt_version) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (content_hash, caption, row["ts"], row["provider"], row["prompt_version"]),
+                )
+                conn.commit()
+            except Exception as e:
+                logger.warning(f"写入全局转述库失败: {e}")
+
+    @staticmethod
+    async def get_async(content_hash: str | None) -> Optional[Dict[str, Any]]:
+        if not content_hash:
+            return None
+        row = CaptionStore._memo_get(content_hash)
+        if row is not None:
+            return row
+        return await asyncio.to_thread(CaptionStore.get, content_hash)
+
+    @staticmethod
+    async def put_async(
+        content_hash: str | None,
+        caption: str,
+        provider: str = "",
+        prompt_version: str = "",
+    ) -> None:
+        await asyncio.to_thread(CaptionStore.put, content_hash, caption, provider, prompt_version)
@@ -0,0 +1,385 @@
+from __future__ import annotations
+
+import heapq
+import time
+from typing import List, Optional
+
+from astrbot.api.all import *
+
+from .history_storage import HistoryStorage
+from .lru_cache import LRUCache
+from .message_utils import MessageUtils
+from .token_estimator import TokenEstimator
+
+
+def _ts(msg: AstrBotMessage) -> float:
+    return getattr(msg, "timestamp", 0) or 0
+
+
+def _sender_id(msg: AstrBotMessage) -> str:
+    sender = getattr(msg, "sender", None)
+    return str(sender.user_id) if sender else ""
+
+
+class ContextSnapshot:
+    """
+    单次请求的上下文快照
+
+    一次倒序遍历历史即得到：最近 msg_limit 条消息窗口、最近 bot_history_keep 条机器人回复、
+    时间提示所需的活跃度（最近一条他人/该用户发言）。窗口与机器人回复作为两段有序序列归并，
+    格式化文本按需生成（受 history_token_budget 约束）并缓存。快照挂在事件上，
+    on_llm_request 兜底路径直接复用。
+
+    anchored（缓存友好布局）模式下窗口起点按会话锚定，只以半个窗口为步长整块前移；
+    起点之后已写满的整块与起点之前的机器人回复组成稳定段，单独渲染并放在最新消息之前，
+    在锚点前移之前逐字节不变，便于服务端前缀缓存命中。
+    """
+
+    EXTRA_KEY = "spectre_snapshot"
+    # 会话 -> 窗口起点消息的缓存键
+    _anchors = LRUCache(max_entries=256)
+
+    def __init__(
+        self,
+        platform_name: str,
+        is_private: bool,
+        chat_id: str,
+        all_msgs: List[AstrBotMessage],
+        window: List[AstrBotMessage],
+        last_global_msg: Optional[AstrBotMessage],
+        last_user_msg: Optional[AstrBotMessage],
+        bot_self_id: str = "",
+        compact: bool = False,
+        stable_window: Optional[List[AstrBotMessage]] = None,
+    ):
+        self.platform_name = platform_name
+        self.is_private = is_private
+        self.chat_id = str(chat_id)
+        self.all_msgs = all_msgs
+        self.window = window
+        self.last_global_msg = last_global_msg
+        self.last_user_msg = last_user_msg
+        self.bot_self_id = bot_self_id
+        self.compact = compact
+        # 稳定段（window 的前缀）；None 表示未启用锚定布局
+        self.stable_window = stable_window
+        self.history_report: dict[str, int] = {}
+        self._render_key: tuple | None = None
+        self._history_text: str | None = None
+
+    @property
+    def history_text(self) -> str | None:
+        """最近一次 render 的结果；尚未渲染时为 None。"""
+        return self._history_text
+
+    @staticmethod
+    def build(
+        all_msgs: List[AstrBotMessage],
+        platform_name: str,
+        is_private: bool,
+        chat_id: str,
+        bot_self_id: str,
+        current_user_id: str,
+        current_msg_id: str | None = None,
+        msg_limit: int = 10,
+        bot_history_keep: int = 3,
+        now_ts: float | None = None,
+        compact: bool = False,
+        anchored: bool = False,
+    ) -> "ContextSnapshot":
+        all_msgs = all_msgs or []
+        now_ts = time.time() if now_ts is None else now_ts
+        bot_self_id = str(bot_self_id)
+        current_user_id = str(current_user_id)
+        total = len(all_msgs)
+        # 与切片 all_msgs[-msg_limit:] 语义一致（msg_limit 为 0 时取全部）
+        tail_start = total - msg_limit if 0 < msg_limit < total else 0
+
+        bot_msgs: list[AstrBotMessage] = []
+        last_global_msg = None
+        last_user_msg = None
+        for idx in range(total - 1, -1, -1):
+            msg = all_msgs[idx]
+            sender_id = _sender_id(msg)
+            if len(bot_msgs) < bot_history_keep and sender_id == bot_self_id:
+                bot_msgs.append(msg)
+            if (last_global_msg is None or last_user_msg is None) and getattr(msg, "timestamp", None):
+                # 忽略该用户 2 秒内的消息（即触发本次回复的消息）
+                if not (now_ts - msg.timestamp < 2.0 and sender_id == current_user_id):
+                    if last_global_msg is None:
+                        last_global_msg = msg
+                    if last_user_msg is None and sender_id == current_user_id:
+                        last_user_msg = msg
+            if (
+                idx <= tail_start
+                and len(bot_msgs) >= bot_history_keep
+                and last_global_msg is not None
+                and last_user_msg is not None
+            ):
+                break
+
+        if anchored and msg_limit > 0 and total:
+            return ContextSnapshot._build_anchored(
+                all_msgs,
+                platform_name,
+                is_private,
+                chat_id,
+                bot_self_id,
+                current_msg_id,
+                msg_limit,
+                bot_history_keep,
+                compact,
+                last_global_msg,
+                last_user_msg,
+            )
+
+        tail = all_msgs[tail_start:]
+        seen_timestamps = {getattr(m, "timestamp") for m in tail if hasattr(m, "timestamp")}
+        extra_bots = []
+        for bm in reversed(bot_msgs):
+            ts = getattr(bm, "timestamp", 0)
+            if ts not in seen_timestamps:
+                extra_bots.append(bm)
+                seen_timestamps.add(ts)
+        window = list(
+            heapq.merge(
+                ContextSnapshot._sorted_run(tail),
+                ContextSnapshot._sorted_run(extra_bots),
+                key=_ts,
+            )
+        )
+        if current_msg_id:
+            window = [m for m in window if str(getattr(m, "message_id", "")) != current_msg_id]
+        return ContextSnapshot(
+            platform_name,
+            is_private,
+            chat_id,
+            all_msgs,
+            window,
+            last_global_msg,
+            last_user_msg,
+            bot_self_id=bot_self_id,
+            compact=compact,
+        )
+
+    @staticmethod
+    def _anchored_start(chat_key: str, all_msgs: List[AstrBotMessage], msg_limit: int, chunk: int) -> int:
+        """
+        返回锚定的窗口起点下标：沿用上次的起点，窗口超过 msg_limit 条时按 chunk 整块前移。
+        锚点消息已不在历史中（首次请求、重启或被清理）时从 total - msg_limit 重新锚定。
+        """
+        total = len(all_msgs)
+        anchor_key = ContextSnapshot._anchors.get(chat_key, count=False)
+        start = None
+        if anchor_key is not None:
+            for idx in range(total - 1, -1, -1):
+                if MessageUtils._message_cache_key(all_msgs[idx]) == anchor_key:
+                    start = idx
+                    break
+        if start is None:
+            start = max(0, total - msg_limit)
+        overflow = total - start - msg_limit
+        if overflow > 0:
+            start += -(-overflow // chunk) * chunk
+        key = MessageUtils._message_cache_key(all_msgs[start]) if start < total else None
+        if key:
+            ContextSnapshot._anchors.set(chat_key, key)
+        return start
+
+    @staticmethod
+    def _build_anchored(
+        all_msgs: List[AstrBotMessage],
+        platform_name: str,
+        is_private: bool,
+        chat_id: str,
+        bot_self_id: str,
+        current_msg_id: str | None,
+        msg_limit: int,
+        bot_history_keep: int,
+        compact: bool,
+        last_global_msg: Optional[AstrBotMessage],
+        last_user_msg: Optional[AstrBotMessage],
+    ) -> "ContextSnapshot":
+        total = len(all_msgs)
+        chunk = max(1, msg_limit // 2)
+        chat_key = f"{platform_name}_{'private' if is_private else 'group'}_{chat_id}"
+        start = ContextSnapshot._anchored_start(chat_key, all_msgs, msg_limit, chunk)
+        # 最后一个（可能未满的）整块之前的部分为稳定段
+        boundary = start + ((total - start - 1) // chunk) * chunk if total > start else start
+
+        # 补充的机器人回复只取起点之前的最近若干条，锚点不动时保持不变
+        extra_bots = []
+        if bot_history_keep > 0:
+            for idx in range(start - 1, -1, -1):
+                if _sender_id(all_msgs[idx]) == bot_self_id:
+                    extra_bots.append(all_msgs[idx])
+                    if len(extra_bots) >= bot_history_keep:
+                        break
+            extra_bots.reverse()
+
+        stable = ContextSnapshot._sorted_run(extra_bots) + ContextSnapshot._sorted_run(all_msgs[start:boundary])
+        recent = ContextSnapshot._sorted_run(all_msgs[boundary:])
+        if current_msg_id:
+            stable = [m for m in stable if str(getattr(m, "message_id", "")) != current_msg_id]
+            recent = [m for m in recent if str(getattr(m, "message_id", "")) != current_msg_id]
+        return ContextSnapshot(
+            platform_name,
+            is_private,
+            chat_id,
+            all_msgs,
+            stable + recent,
+            last_global_msg,
+            last_user_msg,
+            bot_self_id=bot_self_id,
+            compact=compact,
+            stable_window=stable,
+        )
+
+    @staticmethod
+    def _sorted_run(msgs: List[AstrBotMessage]) -> List[AstrBotMessage]:
+        # 历史按写入顺序基本有序，仅在出现乱序时才排序
+        for a, b in zip(msgs, msgs[1:]):
+            if _ts(a) > _ts(b):
+                return sorted(msgs, key=_ts)
+        return msgs
+
+    @staticmethod
+    def from_event(event: AstrMessageEvent) -> Optional["ContextSnapshot"]:
+        try:
+            snapshot = event.get_extra(ContextSnapshot.EXTRA_KEY)
+        except Exception:
+            snapshot = None
+        if snapshot is None:
+            snapshot = getattr(event, "_spectre_snapshot", None)
+        return snapshot if isinstance(snapshot, ContextSnapshot) else None
+
+    @staticmethod
+    async def capture(
+        event: AstrMessageEvent,
+        config: AstrBotConfig,
+        all_msgs: List[AstrBotMessage] | None = None,
+        now_ts: float | None = None,
+    ) -> "ContextSnapshot":
+        """为事件构建快照（未提供历史时自行加载），并挂到事件上供后续复用。"""
+        platform_name = event.get_platform_name()
+        is_private = event.is_private_chat()
+        chat_id = event.get_group_id() if not is_private else event.get_sender_id()
+        if all_msgs is None:
+            try:
+                all_msgs = await HistoryStorage.get_history_async(
+                    platform_name, is_private, chat_id
+                )
+            except Exception as e:
+                logger.error(f"获取历史失败: {e}")
+                all_msgs = []
+        current_msg_id = getattr(event.message_obj, "message_id", None)
+        snapshot = ContextSnapshot.build(
+            all_msgs,
+            platform_name,
+            is_private,
+            chat_id,
+            bot_self_id=str(event.get_self_id()),
+            current_user_id=str(event.get_sender_id()),
+            current_msg_id=str(current_msg_id) if current_msg_id is not None else None,
+            msg_limit=config.get("group_msg_history", 10),
+            bot_history_keep=config.get("bot_reply_history_count", 3),
+            now_ts=now_ts,
+            compact=config.get("history_render_mode", "standard") == "compact",
+            anchored=bool(config.get("prompt_cache_layout", False)),
+        )
+        setattr(event, "_spectre_snapshot", snapshot)
+        try:
+            event.set_extra(ContextSnapshot.EXTRA_KEY, snapshot)
+        except Exception:
+            pass
+        return snapshot
+
+    async def render(
+        self,
+        image_caption: bool = True,
+        uploaded_images: set[str] | None = None,
+    ) -> str:
+        """格式化历史窗口（含前缀文案），相同参数下只渲染一次。"""
+        key = (bool(image_caption), frozenset(uploaded_images or ()))
+        if self._history_text is not None and self._render_key == key:
+            return self._history_text
+        history_str = "（暂无历史记录）"
+        report: dict[str, int] = {}
+        if self.all_msgs:
+            if self.stable_window:
+                fmt = await self._render_anchored(image_caption, uploaded_images, report)
+            else:
+                fmt = await self._format(self.window, image_caption, uploaded_images, TokenEstimator.budget(), report)
+            if fmt:
+                history_str = "以下是最近的聊天记录：\n" + fmt
+        report["tokens"] = TokenEstimator.estimate(history_str)
+        self.history_report = report
+        self._render_key = key
+        self._history_text = history_str
+        return history_str
+
+    async def _format(
+        self,
+        messages: List[AstrBotMessage],
+        image_caption: bool,
+        uploaded_images: set[str] | None,
+        token_budget: int,
+        report: dict[str, int],
+        image_ids: bool = False,
+    ) -> str:
+        return await MessageUtils.format_history_for_llm(
+            messages,
+            max_messages=999,
+            image_caption=image_caption,
+            platform_name=self.platform_name,
+            is_private=self.is_private,
+            chat_id=self.chat_id,
+            uploaded_images=uploaded_images,
+            token_budget=token_budget,
+            bot_self_id=self.bot_self_id,
+            report=report,
+            compact=self.compact,
+            image_ids=image_ids,
+        )
+
+    async def _render_anchored(
+        self,
+        image_caption: bool,
+        uploaded_images: set[str] | None,
+        report: dict[str, int],
+    ) -> str:
+        """
+        稳定段与最新消息分别渲染后拼接。稳定段在锚点前移前保持不变：图片以固定标识
+        [图片@标识] 代替随新图片变化的倒数序号（[ImageRefs] 中列出相同标识），
+        固定使用一半 token 预算；仅在转述完成或图片滑出上传窗口时随之更新。
+        引用、#n 标签与紧凑格式的成员表均为段内独立，最新消息引用稳定段时按内联渲染。
+        """
+        budget = TokenEstimator.budget()
+        stable_budget = budget // 2 if budget > 0 else 0
+        stable_report: dict[str, int] = {}
+        stable_text = await self._format(
+            self.stable_window,
+            image_caption,
+            uploaded_images,
+            stable_budget,
+            stable_report,
+            image_ids=True,
+        )
+        recent = self.window[len(self.stable_window):]
+        recent_report: dict[str, int] = {}
+        recent_text = ""
+        if recent:
+            recent_budget = max(1, budget - stable_report.get("tokens", 0)) if budget > 0 else 0
+            recent_text = await self._format(
+                recent,
+                image_caption,
+                uploaded_images,
+                recent_budget,
+                recent_report,
+            )
+        for name in ("messages", "kept", "tokens", "saved"):
+            value = stable_report.get(name, 0) + recent_report.get(name, 0)
+            if value or name in stable_report or name in recent_report:
+                report[name] = value
+        separator = "\n" if self.compact else "\n-\n"
+        return separator.join(text for text in (stable_text, recent_text) if text)
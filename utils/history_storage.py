@@ -13,8 +13,11 @@ from astrbot.core.utils.astrbot_path import (
     get_astrbot_plugin_data_path,
 )
 
+from .caption_scheduler import CaptionScheduler
 from .image_caption import ImageCaptionUtils
 from .image_ref import extract_image_src, normalize_image_ref
+from .message_utils import MessageUtils
+from .image_transcode import ImageTranscoder
 
 class HistoryStorage:
     """
@@ -27,6 +30,15 @@ class HistoryStorage:
     images_path = None
     legacy_images_path = None
     _file_locks: dict[tuple[int, str], asyncio.Lock] = {}
+    # 各会话预计会被上传的图片: chat_key -> {图片键: (图片引用, 消息时间戳)}
+    _upload_windows: dict[str, dict[str, tuple[str, float | None]]] = {}
+    _warmup_started = False
+    # 待回填进入库大纲的转述: (platform, is_private, chat_id) -> {规范化图片引用: 转述}
+    _outline_backfill: dict[tuple[str, bool, str], dict[str, str]] = {}
+    _backfill_task: asyncio.Task | None = None
+    OUTLINE_BACKFILL_SCAN = 30
+    OUTLINE_BACKFILL_DELAY = 2.0
+    WARMUP_DELAY = 10.0
     _use_plugin_data_root = True
     _keep_legacy_read_fallback = True
     _migrate_legacy_once = True
@@ -66,6 +78,9 @@ class HistoryStorage:
             "images",
         )
         HistoryStorage._file_locks.clear()
+        HistoryStorage._upload_windows.clear()
+        HistoryStorage._outline_backfill.clear()
+        HistoryStorage._warmup_started = False
         HistoryStorage._ensure_dir(HistoryStorage.base_storage_path)
         HistoryStorage._ensure_dir(HistoryStorage.images_path)
         if (
@@ -203,6 +218,46 @@ class HistoryStorage:
     def _get_image_src(component: Image) -> str | None:
         return extract_image_src(component)
 
+    @staticmethod
+    def collect_chat_image_refs() -> list[tuple[str, bool, str, set[str]]]:
+        """
+        遍历全部会话历史文件，收集其中出现过的图片引用（含引用消息内的图片）。
+
+        Returns:
+            [(platform_name, is_private_chat, chat_id, {image_ref, ...}), ...]
+        """
+        root = HistoryStorage.base_storage_path
+        result: list[tuple[str, bool, str, set[str]]] = []
+        if not root or not os.path.isdir(root):
+            return result
+        for platform_name in os.listdir(root):
+            for chat_type in ("group", "private"):
+                directory = os.path.join(root, platform_name, chat_type)
+                if not os.path.isdir(directory):
+                    continue
+                for file_name in os.listdir(directory):
+                    if not file_name.endswith(".json"):
+                        continue
+                    history = HistoryStorage._read_history_file(
+                        os.path.join(directory, file_name)
+                    )
+                    refs: set[str] = set()
+                    for msg in history:
+                        for comp in getattr(msg, "message", None) or []:
+                            comps = [comp]
+                            if isinstance(comp, Reply) and getattr(comp, "chain", None):
+                                comps = comp.chain
+                            for c in comps:
+                                if isinstance(c, Image):
+                                    src = HistoryStorage._get_image_src(c)
+                                    if src:
+                                        refs.add(str(src))
+                    if refs:
+                        result.append(
+                            (platform_name, chat_type == "private", file_name[:-5], refs)
+                        )
+        return result
+
     @staticmethod
     def _is_managed_image_path(path_value: str) -> bool:
         if not path_value or not HistoryStorage.images_path:
@@ -237,16 +292,45 @@ class HistoryStorage:
             )
             file_lock = HistoryStorage._get_file_lock(file_path)
 
+            HistoryStorage.start_caption_warmup()
             await HistoryStorage._process_image_persistence(message)
-            # 后台调度图片转述（不阻塞）
+            sanitized_message = HistoryStorage._sanitize_message(message)
+            # 入库时生成规范化大纲，提示词组装直接复用，无需再遍历消息组件
+            try:
+                if getattr(message, "message", None):
+                    sanitized_message.spectre_outline = MessageUtils.build_outline_record(
+                        message.message
+                    )
+            except Exception as e:
+                logger.debug(f"生成消息大纲失败: {e}")
+
+            async with file_lock:
+                history = await asyncio.to_thread(
+                    HistoryStorage._read_history_file, file_path
+                )
+                history.append(sanitized_message)
+
+                if len(history) > 200:
+                    history = history[-200:]
+
+                await asyncio.to_thread(
+                    HistoryStorage._write_history_file, file_path, history
+                )
+
+            # 后台调度图片转述（不阻塞）；即将作为视觉输入上传的图片暂缓，滑出上传窗口后再转述
             try:
+                upload_window = HistoryStorage._update_upload_window(
+                    platform_name, is_private_chat, chat_id, history
+                )
                 if hasattr(message, "message") and message.message:
+                    msg_ts = getattr(message, "timestamp", None)
                     for comp in message.message:
                         if isinstance(comp, Image):
                             img_src = HistoryStorage._get_image_src(comp)
                             if not img_src:
                                 continue
-                            msg_ts = getattr(message, "timestamp", None)
+                            if ImageCaptionUtils._hash_image(str(img_src)) in upload_window:
+                                continue
                             ImageCaptionUtils.schedule_caption(
                                 img_src,
                                 platform_name,
@@ -254,24 +338,24 @@ class HistoryStorage:
                                 chat_id,
                                 msg_ts,
                             )
+                        elif isinstance(comp, Reply) and getattr(comp, "chain", None):
+                            # 被引用的图片大概率会出现在下一次回复中，优先转述
+                            for r in comp.chain:
+                                if not isinstance(r, Image):
+                                    continue
+                                img_src = HistoryStorage._get_image_src(r)
+                                if img_src:
+                                    ImageCaptionUtils.schedule_caption(
+                                        img_src,
+                                        platform_name,
+                                        is_private_chat,
+                                        chat_id,
+                                        msg_ts,
+                                        priority=CaptionScheduler.PRIORITY_HIGH,
+                                    )
             except Exception:
                 pass
 
-            sanitized_message = HistoryStorage._sanitize_message(message)
-
-            async with file_lock:
-                history = await asyncio.to_thread(
-                    HistoryStorage._read_history_file, file_path
-                )
-                history.append(sanitized_message)
-
-                if len(history) > 200:
-                    history = history[-200:]
-
-                await asyncio.to_thread(
-                    HistoryStorage._write_history_file, file_path, history
-                )
-
             if random.random() < 0.05:
                 try:
                     await asyncio.to_thread(HistoryStorage._cleanup_old_images)
@@ -283,6 +367,244 @@ class HistoryStorage:
             logger.error(f"保存消息历史记录失败: {e}")
             return False
 
+    @staticmethod
+    def queue_outline_backfill(
+        platform_name: str,
+        is_private_chat: bool,
+        chat_id: str,
+        image: str,
+        caption: str,
+    ) -> None:
+        """
+        新转述产生时调用：记下待回填的转述，短暂延迟后按会话合并为一次整文件写入，
+        写回近期消息的入库大纲，渲染时直接读取。需在事件循环中调用。
+        """
+        if not image or not caption:
+            return
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        chat = (platform_name, is_private_chat, str(chat_id))
+        HistoryStorage._outline_backfill.setdefault(chat, {})[
+            ImageCaptionUtils._cache_key(image)
+        ] = caption
+        task = HistoryStorage._backfill_task
+        if task is None or task.done():
+            HistoryStorage._backfill_task = asyncio.create_task(
+                HistoryStorage._flush_outline_backfill()
+            )
+
+    @staticmethod
+    async def _flush_outline_backfill() -> None:
+        await asyncio.sleep(HistoryStorage.OUTLINE_BACKFILL_DELAY)
+        while HistoryStorage._outline_backfill:
+            pending = HistoryStorage._outline_backfill
+            HistoryStorage._outline_backfill = {}
+            for (platform_name, is_private_chat, chat_id), captions in pending.items():
+                file_path = HistoryStorage._get_storage_path(
+                    platform_name, is_private_chat, chat_id
+                )
+                try:
+                    async with HistoryStorage._get_file_lock(file_path):
+                        changed = await asyncio.to_thread(
+                            HistoryStorage._apply_outline_backfill, file_path, captions
+                        )
+                except Exception as e:
+                    logger.warning(f"回填图片转述到消息大纲失败: {e}")
+                    continue
+                if changed:
+                    # 使含未转述图片的渲染缓存失效，下次渲染读取回填后的大纲
+                    ImageCaptionUtils.caption_generation += 1
+
+    @staticmethod
+    def _apply_outline_backfill(file_path: str, captions: dict[str, str]) -> bool:
+        if not os.path.exists(file_path):
+            return False
+        history = HistoryStorage._read_history_file(file_path)
+        changed = False
+        for item in history[-HistoryStorage.OUTLINE_BACKFILL_SCAN:]:
+            record = MessageUtils.get_outline_record(item)
+            if record is None:
+                # 旧版本入库的消息没有大纲，顺带补建
+                if not getattr(item, "message", None):
+                    continue
+                try:
+                    record = MessageUtils.build_outline_record(item.message)
+                except Exception:
+                    continue
+                if not record.get("images"):
+                    continue
+                if MessageUtils.backfill_outline_captions(record["parts"], captions):
+                    item.spectre_outline = record
+                    changed = True
+                continue
+            if record.get("images") and MessageUtils.backfill_outline_captions(
+                record["parts"], captions
+            ):
+                changed = True
+        if changed:
+            HistoryStorage._write_history_file(file_path, history)
+        return changed
+
+    @staticmethod
+    def _update_upload_window(
+        platform_name: str,
+        is_private_chat: bool,
+        chat_id: str,
+        history: List[AstrBotMessage],
+    ) -> set[str]:
+        """
+        刷新会话的上传窗口，返回窗口内图片键集合。
+
+        窗口内的图片下次回复时会直接作为视觉输入上传，无需转述；
+        上一次在窗口内、此次已滑出的图片立即补发转述。
+        """
+        from .llm_utils import LLMUtils  # 延迟导入避免循环
+
+        image_cfg = HistoryStorage.config.get("image_processing", {}) if HistoryStorage.config else {}
+        if not image_cfg.get("caption_defer_uploaded", True):
+            window = {}
+        else:
+            window = LLMUtils.upload_window_images(history, int(image_cfg.get("image_count", 0) or 0))
+        chat_key = LLMUtils.get_chat_key(platform_name, is_private_chat, chat_id)
+        previous = HistoryStorage._upload_windows.get(chat_key, {})
+        if window:
+            HistoryStorage._upload_windows[chat_key] = window
+        else:
+            HistoryStorage._upload_windows.pop(chat_key, None)
+        for key, (img_src, msg_ts) in previous.items():
+            if key not in window:
+                ImageCaptionUtils.schedule_caption(
+                    img_src, platform_name, is_private_chat, chat_id, msg_ts
+                )
+        return set(window)
+
+    @staticmethod
+    def in_upload_window(platform_name: str, is_private_chat: bool, chat_id: str, image: str) -> bool:
+        from .llm_utils import LLMUtils  # 延迟导入避免循环
+
+        window = HistoryStorage._upload_windows.get(
+            LLMUtils.get_chat_key(platform_name, is_private_chat, chat_id)
+        )
+        return bool(window) and ImageCaptionUtils._hash_image(str(image)) in window
+
+    @staticmethod
+    def _is_chat_allowed(is_private_chat: bool, chat_id: str) -> bool:
+        if not HistoryStorage.config:
+            return False
+        if is_private_chat:
+            return bool(HistoryStorage.config.get("enabled_private", False))
+        if not chat_id:
+            return False
+        group_id = str(chat_id)
+        blocked_groups = {str(g) for g in HistoryStorage.config.get("blocked_groups", [])}
+        enabled_groups = {str(g) for g in HistoryStorage.config.get("enabled_groups", [])}
+        if group_id in blocked_groups:
+            return False
+        if not HistoryStorage.config.get("enable_all_groups", False):
+            return group_id in enabled_groups
+        return True
+
+    @staticmethod
+    def start_caption_warmup() -> None:
+        """启动后按配置在后台预热一次图片转述（幂等，需在事件循环中调用）。"""
+        if HistoryStorage._warmup_started or not HistoryStorage.config:
+            return
+        image_cfg = HistoryStorage.config.get("image_processing", {})
+        if not image_cfg.get("caption_warmup_enable", False) or not image_cfg.get("use_image_caption", False):
+            return
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        HistoryStorage._warmup_started = True
+        asyncio.create_task(HistoryStorage._warmup_captions())
+
+    @staticmethod
+    def _recent_history_files(limit: int) -> list[tuple[str, bool, str, str]]:
+        """按修改时间倒序返回最近活跃的会话 [(platform, is_private, chat_id, path), ...]。"""
+        root = HistoryStorage.base_storage_path
+        found: list[tuple[float, str, bool, str, str]] = []
+        if not root or not os.path.isdir(root):
+            return []
+        for platform_name in os.listdir(root):
+            for chat_type in ("group", "private"):
+                directory = os.path.join(root, platform_name, chat_type)
+                if not os.path.isdir(directory):
+                    continue
+                for file_name in os.listdir(directory):
+                    if not file_name.endswith(".json"):
+                        continue
+                    path = os.path.join(directory, file_name)
+                    try:
+                        mtime = os.path.getmtime(path)
+                    except OSError:
+                        continue
+                    found.append((mtime, platform_name, chat_type == "private", file_name[:-5], path))
+        found.sort(reverse=True)
+        return [(p, priv, cid, path) for _m, p, priv, cid, path in found[:limit]]
+
+    @staticmethod
+    async def _warmup_captions() -> None:
+        """
+        重启预热：为最近活跃会话的提示词窗口内、重启前收到的图片补发低优先级转述。
+
+        总量受 caption_warmup_budget 限制，任务以 PRIORITY_LOW 入队，
+        由转述调度器按并发上限慢慢消化，不与实时消息争抢。
+        """
+        from .llm_utils import LLMUtils  # 延迟导入避免循环
+
+        try:
+            await asyncio.sleep(HistoryStorage.WARMUP_DELAY)
+            image_cfg = HistoryStorage.config.get("image_processing", {})
+            budget = int(image_cfg.get("caption_warmup_budget", 50))
+            max_chats = int(image_cfg.get("caption_warmup_chats", 10))
+            window_size = int(HistoryStorage.config.get("group_msg_history", 10))
+            image_count = int(image_cfg.get("image_count", 0) or 0)
+            chats = await asyncio.to_thread(HistoryStorage._recent_history_files, max_chats)
+            queued = 0
+            for platform_name, is_private_chat, chat_id, path in chats:
+                if queued >= budget:
+                    break
+                if not HistoryStorage._is_chat_allowed(is_private_chat, chat_id):
+                    continue
+                history = await asyncio.to_thread(HistoryStorage._read_history_file, path)
+                if not history:
+                    continue
+                uploaded = set(LLMUtils.upload_window_images(history, image_count))
+                for msg in reversed(history[-window_size:]):
+                    msg_ts = getattr(msg, "timestamp", None)
+                    for comp in getattr(msg, "message", None) or []:
+                        comps = [comp]
+                        if isinstance(comp, Reply) and getattr(comp, "chain", None):
+                            comps = comp.chain
+                        for c in comps:
+                            if not isinstance(c, Image):
+                                continue
+                            img_src = HistoryStorage._get_image_src(c)
+                            if not img_src or ImageCaptionUtils._hash_image(str(img_src)) in uploaded:
+                                continue
+                            if ImageCaptionUtils.schedule_caption(
+                                img_src,
+                                platform_name,
+                                is_private_chat,
+                                chat_id,
+                                msg_ts,
+                                priority=CaptionScheduler.PRIORITY_LOW,
+                                warmup=True,
+                            ):
+                                queued += 1
+                            if queued >= budget:
+                                break
+                        if queued >= budget:
+                            break
+                    if queued >= budget:
+                        break
+            logger.info(f"[SpectreCore] 图片转述预热：已为 {len(chats)} 个最近活跃会话排队 {queued} 张图片。")
+        except Exception as e:
+            logger.warning(f"图片转述预热失败: {e}")
+
     @staticmethod
     async def retry_uncaptioned_images(platform_name: str, is_private_chat: bool, chat_id: str, max_scan: int = 30) -> None:
         """
@@ -291,22 +613,8 @@ class HistoryStorage:
         - 插件重启前的图片不会被转述（依赖 schedule_caption 的 start_time/时间戳判断）
         """
         try:
-            if not HistoryStorage.config:
+            if not HistoryStorage._is_chat_allowed(is_private_chat, chat_id):
                 return
-            if is_private_chat:
-                if not HistoryStorage.config.get("enabled_private", False):
-                    return
-            else:
-                if not chat_id:
-                    return
-                group_id = str(chat_id)
-                blocked_groups = {str(g) for g in HistoryStorage.config.get("blocked_groups", [])}
-                enabled_groups = {str(g) for g in HistoryStorage.config.get("enabled_groups", [])}
-                if group_id in blocked_groups:
-                    return
-                if not HistoryStorage.config.get("enable_all_groups", False):
-                    if group_id not in enabled_groups:
-                        return
             history = (
                 await HistoryStorage.get_history_async(
                     platform_name,
@@ -329,6 +637,10 @@ class HistoryStorage:
                             img_src = HistoryStorage._get_image_src(comp)
                             if not img_src:
                                 continue
+                            if HistoryStorage.in_upload_window(
+                                platform_name, is_private_chat, chat_id, img_src
+                            ):
+                                continue
                             ImageCaptionUtils.schedule_caption(
                                 img_src, platform_name, is_private_chat, chat_id, msg_ts
                             )
@@ -344,6 +656,7 @@ class HistoryStorage:
                                         is_private_chat,
                                         chat_id,
                                         msg_ts,
+                                        priority=CaptionScheduler.PRIORITY_HIGH,
                                     )
                 except Exception:
                     continue
@@ -562,5 +875,6 @@ class HistoryStorage:
                         os.remove(fpath)
                     except Exception:
                         pass
+            ImageTranscoder.cleanup(days)
         except Exception:
             pass
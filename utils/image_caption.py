@@ -4,6 +4,8 @@ import asyncio
 import os
 import json
 import hashlib
+import re
+import heapq
 import time
 import shutil
 from astrbot.core.utils.astrbot_path import (
@@ -11,7 +13,13 @@ from astrbot.core.utils.astrbot_path import (
     get_astrbot_plugin_data_path,
 )
 
-from .image_ref import build_image_aliases, normalize_image_ref
+from .caption_scheduler import CaptionJob, CaptionScheduler
+from .caption_store import CaptionStore
+from .image_ref import build_image_aliases, file_content_hash, normalize_image_ref
+from .image_phash import ImagePHash
+from .image_transcode import ImageTranscoder
+from .latency_tracker import LatencyTracker
+from .lru_cache import LRUCache
 
 class ImageCaptionUtils:
     """
@@ -23,17 +31,46 @@ class ImageCaptionUtils:
     # 保存context和config对象的静态变量
     context = None
     config = None
-    # 图片描述缓存
-    caption_cache = {}
+    # 图片描述缓存（有界 LRU，上限由配置决定）
+    caption_cache = LRUCache(max_entries=500, max_bytes=1 << 20)
     cache_dir = None
     legacy_cache_dir = None
-    _pending: set[str] = set()
+    # 进行中的转述：图片键 -> Future（排队、后台执行与同步调用共享同一结果）
+    _pending: dict[str, asyncio.Future] = {}
     start_time: float = 0.0
-    _sema: asyncio.Semaphore | None = None
     _use_plugin_data_root = True
     _keep_legacy_read_fallback = True
     _migrate_legacy_once = True
     _migration_done = False
+    # 已解析的会话转述文件（按会话数有界 LRU）:
+    # path -> {"sig": (mtime_ns, size) | None, "checked": float, "data": dict}
+    FILE_CACHE_CHATS = 256
+    _file_cache = LRUCache(max_entries=FILE_CACHE_CHATS)
+    _known_dirs: set[str] = set()
+    FILE_CACHE_REVALIDATE = 10.0
+    # 批量写入：待落盘的会话文件 path -> data（独立持有，不受 _file_cache 淘汰影响）
+    # 与按 ts 排序的过期堆 (ts, key)，后者被淘汰时按需重建
+    _dirty_paths: dict[str, Dict[str, Any]] = {}
+    _expiry_heaps = LRUCache(max_entries=FILE_CACHE_CHATS)
+    _flush_task: asyncio.Task | None = None
+    FLUSH_DELAY = 2.0
+    # 会话转述文件的键格式版本：2 表示已全部迁移为规范化引用的哈希
+    CAPTION_FORMAT_VERSION = 2
+    # 转述完成（成功或失败）时递增，供渲染缓存判断含未转述图片的消息是否需重绘
+    caption_generation = 0
+    _keys_canonical = False
+    # 转述失败记录：图片键 -> {"attempts": int, "next_retry": float}，按指数退避重试
+    _failures = LRUCache(max_entries=5000)
+    _failure_stats: Dict[str, int] = {"failures": 0, "avoided": 0, "given_up": 0}
+    RETRY_BACKOFF_MAX = 6 * 3600
+    # 转述提供商的滚动延迟统计与对冲计数
+    _provider_latency: dict[str, LatencyTracker] = {}
+    _hedge_stats: Dict[str, int] = {"hedged": 0, "fallback_wins": 0}
+    MIN_CAPTION_TIMEOUT = 10.0
+    # 批量转述统计与逐行解析格式（"1. xxx"、"图片2：xxx"）
+    _batch_stats: Dict[str, int] = {"batches": 0, "batched_images": 0, "fallback_images": 0}
+    _BATCH_LINE_RE = re.compile(r"^\s*(?:第\s*)?(?:图片|图|image\s*)?\s*(\d+)\s*(?:张)?\s*[\.．:：、)）\]-]\s*(.+?)\s*$", re.IGNORECASE)
+    _key_migration_task: asyncio.Task | None = None
     
     @staticmethod
     def init(context: Context, config: AstrBotConfig):
@@ -70,12 +107,60 @@ class ImageCaptionUtils:
         ):
             ImageCaptionUtils._migrate_legacy_cache()
         ImageCaptionUtils._migration_done = True
+        ImagePHash.init(config, base)
+        image_cfg = config.get("image_processing", {})
+        if image_cfg.get("caption_global_store", True):
+            CaptionStore.init(base, int(image_cfg.get("caption_global_days", 30)))
+        else:
+            CaptionStore.close()
         ImageCaptionUtils.start_time = time.time()
         ImageCaptionUtils.caption_cache.clear()
-        ImageCaptionUtils._pending.clear()
-        conc = int(config.get("image_processing", {}).get("caption_concurrency", 2))
-        conc = 1 if conc <= 0 else conc
-        ImageCaptionUtils._sema = asyncio.Semaphore(conc)
+        ImageCaptionUtils.caption_cache.reset_stats()
+        ImageCaptionUtils.caption_cache.configure(
+            max_entries=int(image_cfg.get("caption_memory_limit", 500)),
+            max_bytes=int(image_cfg.get("caption_memory_kb", 1024)) * 1024,
+            ttl=float(image_cfg.get("caption_memory_ttl", 0)),
+        )
+        ImageCaptionUtils.flush_pending()
+        ImageCaptionUtils._file_cache.clear()
+        ImageCaptionUtils._known_dirs.clear()
+        ImageCaptionUtils._expiry_heaps.clear()
+        for key, fut in list(ImageCaptionUtils._pending.items()):
+            ImageCaptionUtils._settle(key, fut, None)
+        ImageCaptionUtils._keys_canonical = (
+            ImageCaptionUtils._read_format_version() >= ImageCaptionUtils.CAPTION_FORMAT_VERSION
+        )
+        ImageCaptionUtils._key_migration_task = None
+        ImageCaptionUtils._failures.clear()
+        ImageCaptionUtils._failure_stats = {"failures": 0, "avoided": 0, "given_up": 0}
+        ImageCaptionUtils._provider_latency.clear()
+        ImageCaptionUtils._hedge_stats = {"hedged": 0, "fallback_wins": 0}
+        ImageCaptionUtils._batch_stats = {"batches": 0, "batched_images": 0, "fallback_images": 0}
+        ImageCaptionUtils.start_key_migration()
+        conc = int(image_cfg.get("caption_concurrency", 2))
+        CaptionScheduler.configure(
+            runner=ImageCaptionUtils._run_caption_jobs,
+            is_busy=ImageCaptionUtils._job_chat_busy,
+            on_drop=ImageCaptionUtils._on_job_dropped,
+            concurrency=1 if conc <= 0 else conc,
+            max_depth=int(image_cfg.get("caption_queue_limit", 200)),
+            stale_after=float(image_cfg.get("caption_queue_ttl", 600)),
+            batch_size=int(image_cfg.get("caption_batch_size", 1)),
+        )
+
+    @staticmethod
+    def get_stats() -> Dict[str, Any]:
+        return {
+            "memory": ImageCaptionUtils.caption_cache.stats(),
+            "queue": CaptionScheduler.stats(),
+            "negative": dict(ImageCaptionUtils._failure_stats, tracked=len(ImageCaptionUtils._failures)),
+            "providers": {
+                label: tracker.stats()
+                for label, tracker in ImageCaptionUtils._provider_latency.items()
+            },
+            "hedge": dict(ImageCaptionUtils._hedge_stats),
+            "batch": dict(ImageCaptionUtils._batch_stats),
+        }
 
     @staticmethod
     def _cache_key(image: str) -> str:
@@ -110,6 +195,87 @@ class ImageCaptionUtils:
             candidates.append(hashed)
         return candidates
 
+    @staticmethod
+    def _format_marker_path() -> str:
+        return os.path.join(ImageCaptionUtils.cache_dir, ".format_version")
+
+    @staticmethod
+    def _read_format_version() -> int:
+        try:
+            with open(ImageCaptionUtils._format_marker_path(), "r", encoding="utf-8") as f:
+                return int(json.load(f).get("version", 1))
+        except Exception:
+            return 1
+
+    @staticmethod
+    def _write_format_version() -> None:
+        try:
+            with open(ImageCaptionUtils._format_marker_path(), "w", encoding="utf-8") as f:
+                json.dump(
+                    {"version": ImageCaptionUtils.CAPTION_FORMAT_VERSION, "migrated_at": time.time()},
+                    f,
+                )
+        except Exception as e:
+            logger.warning(f"写入转述缓存版本标记失败: {e}")
+
+    @staticmethod
+    def start_key_migration() -> None:
+        """若会话转述文件仍含旧格式键，在后台启动一次性迁移（幂等，无事件循环时推迟到首次调度）。"""
+        if ImageCaptionUtils._keys_canonical:
+            return
+        task = ImageCaptionUtils._key_migration_task
+        if task is not None:
+            return
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        ImageCaptionUtils._key_migration_task = asyncio.create_task(
+            ImageCaptionUtils._migrate_caption_keys()
+        )
+
+    @staticmethod
+    async def _migrate_caption_keys() -> None:
+        """
+        将会话转述文件中的旧格式键（原始引用/别名的哈希）统一改写为规范化引用的哈希。
+
+        哈希不可逆，需借助历史记录中出现过的图片引用重建映射；完成后写入版本标记，
+        此后查询只需一次哈希探测。未能在历史中找到引用的旧条目保留，随过期清理淘汰。
+        """
+        try:
+            from .history_storage import HistoryStorage  # 延迟导入避免循环
+
+            chats = await asyncio.to_thread(HistoryStorage.collect_chat_image_refs)
+            moved = 0
+            for platform_name, is_private, chat_id, refs in chats:
+                chat_type = "private" if is_private else "group"
+                path = ImageCaptionUtils._cache_path(platform_name, chat_type, chat_id)
+                data = ImageCaptionUtils._load_cache(path)
+                if not data:
+                    continue
+                changed = False
+                for ref in refs:
+                    hashed = ImageCaptionUtils._hash_image(ref)
+                    for legacy_hashed in ImageCaptionUtils._legacy_hash_candidates(ref):
+                        if legacy_hashed == hashed or legacy_hashed not in data:
+                            continue
+                        item = data.pop(legacy_hashed)
+                        if hashed not in data:
+                            data[hashed] = item
+                        changed = True
+                        moved += 1
+                if changed:
+                    ImageCaptionUtils._expiry_heaps.pop(path, None)
+                    ImageCaptionUtils._queue_save(path, data)
+                # 逐会话让出事件循环
+                await asyncio.sleep(0)
+            await asyncio.to_thread(ImageCaptionUtils._write_format_version)
+            ImageCaptionUtils._keys_canonical = True
+            logger.info(f"[SpectreCore] 图片转述缓存键迁移完成，共改写 {moved} 条。")
+        except Exception as e:
+            ImageCaptionUtils._key_migration_task = None
+            logger.warning(f"图片转述缓存键迁移失败: {e}")
+
     @staticmethod
     def _copy_tree_if_missing(src_dir: str, dst_dir: str) -> None:
         if not os.path.exists(src_dir):
@@ -160,8 +326,9 @@ class ImageCaptionUtils:
         safe_chat = str(chat_id or "unknown")
         root_dir = base_dir if base_dir else ImageCaptionUtils.cache_dir
         path = os.path.join(root_dir, safe_platform, safe_type)
-        if create_dir:
+        if create_dir and path not in ImageCaptionUtils._known_dirs:
             os.makedirs(path, exist_ok=True)
+            ImageCaptionUtils._known_dirs.add(path)
         return os.path.join(path, f"{safe_chat}.json")
 
     @staticmethod
@@ -178,114 +345,513 @@ class ImageCaptionUtils:
         return False
 
     @staticmethod
-    def _load_cache(path: str) -> Dict[str, Any]:
-        if not os.path.exists(path): return {}
+    def _file_signature(path: str) -> tuple[int, int] | None:
         try:
-            with open(path, "r", encoding="utf-8") as f:
-                data = json.load(f)
-            return data if isinstance(data, dict) else {}
-        except Exception:
-            return {}
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
 
     @staticmethod
-    def _save_cache(path: str, data: Dict[str, Any]) -> None:
+    def _load_cache(path: str) -> Dict[str, Any]:
+        """
+        读取会话转述缓存（内存常驻）
+
+        解析结果按路径缓存在有界 LRU 中，仅在超过复核间隔后比对 mtime/大小，
+        热点会话的查询不产生文件 I/O。返回的字典即缓存本体，修改后须调用 _queue_save。
+        待落盘的数据优先于磁盘内容（条目可能已被淘汰）。
+        """
+        now = time.monotonic()
+        entry = ImageCaptionUtils._file_cache.get(path, count=False)
+        dirty = ImageCaptionUtils._dirty_paths.get(path)
+        if dirty is not None:
+            if entry is None or entry["data"] is not dirty:
+                ImageCaptionUtils._file_cache.set(
+                    path, {"sig": entry["sig"] if entry else None, "checked": now, "data": dirty}
+                )
+            return dirty
+        if entry and now - entry["checked"] < ImageCaptionUtils.FILE_CACHE_REVALIDATE:
+            return entry["data"]
+        sig = ImageCaptionUtils._file_signature(path)
+        if entry and entry["sig"] == sig:
+            entry["checked"] = now
+            return entry["data"]
+        data: Dict[str, Any] = {}
+        if sig is not None:
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    loaded = json.load(f)
+                if isinstance(loaded, dict):
+                    data = loaded
+            except Exception:
+                data = {}
+        ImageCaptionUtils._file_cache.set(path, {"sig": sig, "checked": now, "data": data})
+        return data
+
+    @staticmethod
+    def _write_cache_file(path: str, data: Dict[str, Any]) -> tuple[int, int] | None:
         try:
             os.makedirs(os.path.dirname(path), exist_ok=True)
-            with open(path, "w", encoding="utf-8") as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
+            tmp = f"{path}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+            os.replace(tmp, path)
         except Exception as e:
             logger.error(f"保存图片转述缓存失败: {e}")
+            return None
+        return ImageCaptionUtils._file_signature(path)
 
     @staticmethod
-    def _on_caption_task_done(task: asyncio.Task) -> None:
-        try:
-            error = task.exception()
-        except asyncio.CancelledError:
+    def _save_cache(path: str, data: Dict[str, Any]) -> None:
+        sig = ImageCaptionUtils._write_cache_file(path, data)
+        if sig is None:
             return
-        except Exception:
+        # 自身写入后直接更新签名，避免下次查询重新解析
+        ImageCaptionUtils._file_cache.set(path, {
+            "sig": sig,
+            "checked": time.monotonic(),
+            "data": data,
+        })
+
+    @staticmethod
+    def _queue_save(path: str, data: Dict[str, Any]) -> None:
+        """登记待写入的会话文件，短暂合并后在线程中批量落盘；无事件循环时同步写入。"""
+        previous = ImageCaptionUtils._file_cache.get(path, count=False) or {}
+        ImageCaptionUtils._file_cache.set(path, {
+            "sig": previous.get("sig"),
+            "checked": time.monotonic(),
+            "data": data,
+        })
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            ImageCaptionUtils._dirty_paths.pop(path, None)
+            ImageCaptionUtils._save_cache(path, data)
             return
-        if error:
-            logger.warning(f"后台图片转述任务异常: {error}")
+        ImageCaptionUtils._dirty_paths[path] = data
+        task = ImageCaptionUtils._flush_task
+        if task is None or task.done():
+            ImageCaptionUtils._flush_task = asyncio.create_task(
+                ImageCaptionUtils._flush_later()
+            )
 
     @staticmethod
-    async def _wait_and_caption(image: str, platform_name: str, is_private: bool, chat_id: str):
+    async def _flush_later() -> None:
+        await asyncio.sleep(ImageCaptionUtils.FLUSH_DELAY)
+        while ImageCaptionUtils._dirty_paths:
+            batch: list[tuple[str, Dict[str, Any]]] = []
+            for path, data in ImageCaptionUtils._dirty_paths.items():
+                # 条目字典写入后不再原地修改，浅拷贝即可得到一致快照
+                batch.append((path, dict(data)))
+            ImageCaptionUtils._dirty_paths.clear()
+            if not batch:
+                return
+
+            def write_batch() -> list[tuple[int, int] | None]:
+                return [ImageCaptionUtils._write_cache_file(p, d) for p, d in batch]
+
+            sigs = await asyncio.to_thread(write_batch)
+            for (path, _snapshot), sig in zip(batch, sigs):
+                entry = ImageCaptionUtils._file_cache.get(path, count=False)
+                if entry is not None and sig is not None and path not in ImageCaptionUtils._dirty_paths:
+                    entry["sig"] = sig
+                    entry["checked"] = time.monotonic()
+
+    @staticmethod
+    def flush_pending() -> None:
+        """同步写出所有待落盘的转述缓存（插件卸载/重载时调用）。"""
+        task = ImageCaptionUtils._flush_task
+        ImageCaptionUtils._flush_task = None
+        if task is not None and not task.done():
+            task.cancel()
+        for path, data in list(ImageCaptionUtils._dirty_paths.items()):
+            ImageCaptionUtils._save_cache(path, data)
+        ImageCaptionUtils._dirty_paths.clear()
+
+    @staticmethod
+    def _job_chat_busy(job: CaptionJob) -> bool:
         try:
             from .llm_utils import LLMUtils  # 延迟导入避免循环
         except Exception:
-            LLMUtils = None
+            return False
+        return LLMUtils.is_llm_in_progress(job.platform_name, job.is_private, job.chat_id)
 
-        # 若 LLM 正在处理该会话，等待空闲或超时
-        for _ in range(60):
-            try:
-                if not LLMUtils or not LLMUtils.is_llm_in_progress(platform_name, is_private, chat_id):
-                    break
-            except Exception:
-                break
-            await asyncio.sleep(1)
+    @staticmethod
+    def _settle(key: str, fut: asyncio.Future, result: Optional[str]) -> None:
+        ImageCaptionUtils.caption_generation += 1
+        if not fut.done():
+            fut.set_result(result)
+        if ImageCaptionUtils._pending.get(key) is fut:
+            ImageCaptionUtils._pending.pop(key, None)
+
+    @staticmethod
+    def _on_job_dropped(job: CaptionJob) -> None:
+        fut = ImageCaptionUtils._pending.get(job.key)
+        if fut is not None:
+            ImageCaptionUtils._settle(job.key, fut, None)
 
+    @staticmethod
+    async def _run_owned(
+        key: str,
+        fut: asyncio.Future,
+        image: str,
+        timeout: int,
+        platform_name: str,
+        is_private: bool,
+        chat_id: str,
+    ) -> Optional[str]:
+        result = None
         try:
-            sema = ImageCaptionUtils._sema
-            if sema:
-                async with sema:
-                    await ImageCaptionUtils.generate_image_caption(
-                        image,
-                        platform_name=platform_name,
-                        is_private=is_private,
-                        chat_id=chat_id,
-                    )
-            else:
-                await ImageCaptionUtils.generate_image_caption(
-                    image,
-                    platform_name=platform_name,
-                    is_private=is_private,
-                    chat_id=chat_id,
-                )
+            result = await ImageCaptionUtils._generate_image_caption(
+                image,
+                timeout=timeout,
+                platform_name=platform_name,
+                is_private=is_private,
+                chat_id=chat_id,
+            )
+            return result
+        finally:
+            ImageCaptionUtils._settle(key, fut, result)
+
+    @staticmethod
+    async def _run_caption_jobs(jobs: list[CaptionJob]) -> None:
+        owned = []
+        for job in jobs:
+            fut = ImageCaptionUtils._pending.get(job.key)
+            if fut is not None and not fut.done():
+                owned.append((job, fut))
+        if not owned:
+            return
+        if len(owned) == 1:
+            job, fut = owned[0]
+            await ImageCaptionUtils._run_owned(
+                job.key,
+                fut,
+                job.image,
+                30,
+                job.platform_name,
+                job.is_private,
+                job.chat_id,
+            )
+            return
+        results: dict[str, Optional[str]] = {}
+        try:
+            results = await ImageCaptionUtils._caption_batch([job for job, _ in owned])
         finally:
-            ImageCaptionUtils._pending.discard(ImageCaptionUtils._hash_image(image))
+            for job, fut in owned:
+                ImageCaptionUtils._settle(job.key, fut, results.get(job.key))
+
+    @staticmethod
+    async def _caption_batch(jobs: list[CaptionJob], timeout: float = 30) -> dict[str, Optional[str]]:
+        """
+        同一会话的多张图片合并为一次视觉请求
+
+        先逐张完成缓存查询与准备；仍需转述的图片一次性发给首选提供商，
+        要求返回按序的 JSON 数组。解析失败或缺失的图片回退为单张请求。
+        """
+        prepared = await asyncio.gather(
+            *[
+                ImageCaptionUtils._prepare_caption(
+                    job.image, job.platform_name, job.is_private, job.chat_id
+                )
+                for job in jobs
+            ]
+        )
+        results: dict[str, Optional[str]] = {}
+        need: list[tuple[CaptionJob, Dict[str, Any]]] = []
+        for job, (caption, ctx) in zip(jobs, prepared):
+            if caption:
+                results[job.key] = caption
+            elif ctx is not None:
+                need.append((job, ctx))
+        if not need:
+            return results
+        image_processing_config = ImageCaptionUtils.config.get("image_processing", {})
+        providers = ImageCaptionUtils._caption_providers(image_processing_config)
+        if not providers:
+            logger.warning("无法找到提供商，批量图片转述跳过")
+            return results
+
+        if len(need) > 1:
+            label, provider = providers[0]
+            captions = await ImageCaptionUtils._request_batch(
+                label, provider, need[0][1]["prompt"], [ctx["image_url"] for _, ctx in need], timeout * 2
+            )
+            ImageCaptionUtils._batch_stats["batches"] += 1
+            remaining = []
+            for idx, (job, ctx) in enumerate(need):
+                caption = captions.get(idx)
+                if not caption:
+                    remaining.append((job, ctx))
+                    continue
+                await ImageCaptionUtils._commit_caption(
+                    job.image, caption, label, ctx, job.platform_name, job.is_private, job.chat_id
+                )
+                results[job.key] = caption
+            ImageCaptionUtils._batch_stats["batched_images"] += len(need) - len(remaining)
+            ImageCaptionUtils._batch_stats["fallback_images"] += len(remaining)
+            need = remaining
+
+        for job, ctx in need:
+            results[job.key] = await ImageCaptionUtils._caption_single(
+                job.image, ctx, providers, timeout, job.platform_name, job.is_private, job.chat_id
+            )
+        return results
+
+    @staticmethod
+    async def _request_batch(
+        label: str,
+        provider,
+        caption_prompt: str,
+        image_urls: list[str],
+        timeout: float,
+    ) -> dict[int, str]:
+        count = len(image_urls)
+        prompt = (
+            f"{caption_prompt}\n\n"
+            f"以上共 {count} 张图片，请按顺序逐张描述。"
+            f"只输出一个 JSON 字符串数组，第 i 个元素对应第 i 张图片，数组长度必须为 {count}，不要输出其他内容。"
+        )
+        try:
+            llm_response = await asyncio.wait_for(
+                provider.text_chat(
+                    prompt=prompt,
+                    contexts=[],
+                    image_urls=image_urls,
+                    func_tool=None,
+                    system_prompt="",
+                ),
+                timeout=timeout,
+            )
+        except asyncio.TimeoutError:
+            logger.warning(f"批量图片转述超时({label})，{count} 张图片改为逐张转述")
+            return {}
+        except Exception as e:
+            logger.warning(f"批量图片转述失败({label}): {e}，改为逐张转述")
+            return {}
+        role = getattr(llm_response, "role", "")
+        text = (getattr(llm_response, "completion_text", "") or "").strip()
+        if role and role != "assistant":
+            return {}
+        captions = ImageCaptionUtils._parse_batch_captions(text, count)
+        if len(captions) < count:
+            logger.debug(f"[SpectreCore] 批量转述仅解析出 {len(captions)}/{count} 条，其余逐张转述")
+        return captions
+
+    @staticmethod
+    def _parse_batch_captions(text: str, count: int) -> dict[int, str]:
+        """
+        解析批量转述结果，返回 {图片序号(0 起): 转述}
+
+        优先按 JSON 数组解析（允许代码块包裹、元素为字符串或含 index/caption 的对象）；
+        无序号的数组长度与图片数不一致时视为错位，整体丢弃。
+        JSON 失败时退回逐行解析 "1. xxx" / "图片1：xxx" 等格式。
+        """
+        result: dict[int, str] = {}
+
+        def accept(idx: int, caption: Any) -> None:
+            if not isinstance(caption, str):
+                return
+            caption = caption.strip()
+            if 0 <= idx < count and caption and not ImageCaptionUtils._looks_like_error_text(caption):
+                result.setdefault(idx, caption)
+
+        if not text:
+            return result
+        body = re.sub(r"^```[a-zA-Z]*\s*|\s*```$", "", text.strip())
+        left, right = body.find("["), body.rfind("]")
+        if left != -1 and right > left:
+            try:
+                items = json.loads(body[left : right + 1])
+            except ValueError:
+                items = None
+            if isinstance(items, list):
+                indexed = all(isinstance(i, dict) and "index" in i for i in items)
+                if indexed:
+                    for item in items:
+                        try:
+                            idx = int(item.get("index")) - 1
+                        except (TypeError, ValueError):
+                            continue
+                        accept(idx, item.get("caption") or item.get("description"))
+                elif len(items) == count:
+                    for idx, item in enumerate(items):
+                        if isinstance(item, dict):
+                            item = item.get("caption") or item.get("description")
+                        accept(idx, item)
+                if result:
+                    return result
+        for line in body.splitlines():
+            match = ImageCaptionUtils._BATCH_LINE_RE.match(line)
+            if match:
+                accept(int(match.group(1)) - 1, match.group(2))
+        return result
 
     @staticmethod
-    def schedule_caption(image: str, platform_name: str, is_private: bool, chat_id: str, msg_ts: float | None = None):
-        """后台调度图片转述（幂等）。若命中缓存/正在转述则不重复。"""
+    def _record_failure(image: str) -> None:
+        """记录一次转述失败，下次重试时间按 caption_retry_backoff * 2^(n-1) 递增。"""
+        cfg = ImageCaptionUtils.config.get("image_processing", {}) if ImageCaptionUtils.config else {}
+        base = float(cfg.get("caption_retry_backoff", 60))
+        limit = int(cfg.get("caption_retry_limit", 3))
+        key = ImageCaptionUtils._hash_image(image)
+        record = ImageCaptionUtils._failures.get(key, count=False) or {"attempts": 0, "next_retry": 0.0}
+        attempts = record["attempts"] + 1
+        delay = min(base * (2 ** (attempts - 1)), ImageCaptionUtils.RETRY_BACKOFF_MAX)
+        ImageCaptionUtils._failures.set(
+            key, {"attempts": attempts, "next_retry": time.time() + delay, "avoided": False}
+        )
+        ImageCaptionUtils._failure_stats["failures"] += 1
+        if limit > 0 and attempts == limit:
+            ImageCaptionUtils._failure_stats["given_up"] += 1
+            logger.info(f"[SpectreCore] 图片转述连续失败 {attempts} 次，不再重试: {str(image)[:50]}...")
+
+    @staticmethod
+    def _failure_blocked(key: str) -> bool:
+        """
+        该图片是否处于失败退避期或已达重试上限。
+
+        命中时计入节省的调用次数，每张图片每个退避期只计一次（渲染等路径会反复询问）。
+        """
+        record = ImageCaptionUtils._failures.get(key, count=False)
+        if not record:
+            return False
+        cfg = ImageCaptionUtils.config.get("image_processing", {}) if ImageCaptionUtils.config else {}
+        limit = int(cfg.get("caption_retry_limit", 3))
+        if (limit > 0 and record["attempts"] >= limit) or time.time() < record["next_retry"]:
+            if not record.get("avoided"):
+                record["avoided"] = True
+                ImageCaptionUtils._failure_stats["avoided"] += 1
+            return True
+        return False
+
+    @staticmethod
+    def is_caption_pending(image: str) -> bool:
+        """该图片是否已在排队或转述中。"""
+        fut = ImageCaptionUtils._pending.get(ImageCaptionUtils._hash_image(image))
+        return fut is not None and not fut.done()
+
+    @staticmethod
+    def notify_llm_idle() -> None:
+        """某会话 LLM 调用结束时调用，唤醒因该会话繁忙而暂缓的转述任务。"""
+        CaptionScheduler.notify()
+
+    @staticmethod
+    def schedule_caption(
+        image: str,
+        platform_name: str,
+        is_private: bool,
+        chat_id: str,
+        msg_ts: float | None = None,
+        priority: int = CaptionScheduler.PRIORITY_NORMAL,
+        warmup: bool = False,
+    ) -> bool:
+        """
+        后台调度图片转述（幂等）。若命中缓存/正在转述则不重复。
+
+        priority 越小越先处理：即将进入提示词窗口或被引用的图片使用 PRIORITY_HIGH。
+        warmup 为 True 时跳过重启时间判断（启动预热专用）。返回是否新入队。
+        """
         cfg = ImageCaptionUtils.config.get("image_processing", {}) if ImageCaptionUtils.config else {}
         if not cfg.get("use_image_caption", False):
-            return
+            return False
         # 插件重启后，仅处理新的图片
-        if msg_ts is not None and msg_ts < ImageCaptionUtils.start_time:
-            return
+        if not warmup and msg_ts is not None and msg_ts < ImageCaptionUtils.start_time:
+            return False
+        ImageCaptionUtils.start_key_migration()
         hashed = ImageCaptionUtils._hash_image(image)
         if hashed in ImageCaptionUtils._pending:
-            return
-        if ImageCaptionUtils.get_cached_caption(image, platform_name, is_private, chat_id):
-            return
-        ImageCaptionUtils._pending.add(hashed)
-        task = asyncio.create_task(
-            ImageCaptionUtils._wait_and_caption(image, platform_name, is_private, chat_id)
+            return False
+        if ImageCaptionUtils._failure_blocked(hashed):
+            return False
+        if ImageCaptionUtils.get_memory_caption(image) or ImageCaptionUtils.get_cached_caption(
+            image, platform_name, is_private, chat_id
+        ):
+            return False
+        job = CaptionJob(hashed, image, platform_name, is_private, chat_id, priority, msg_ts)
+        fut = asyncio.get_running_loop().create_future()
+        ImageCaptionUtils._pending[hashed] = fut
+        if not CaptionScheduler.submit(job):
+            ImageCaptionUtils._settle(hashed, fut, None)
+            return False
+        return True
+
+    @staticmethod
+    def request_caption(
+        image: str,
+        platform_name: str,
+        is_private: bool,
+        chat_id: str,
+    ) -> Optional[asyncio.Future]:
+        """
+        为当前请求调度转述并返回可等待的 future（已有缓存或无法调度时返回 None）。
+
+        任务仍经由调度器执行、受并发与队列上限约束，但以 PRIORITY_HIGH 排队且
+        不因本会话 LLM 繁忙而暂缓。等待方超时不会取消转述。
+        """
+        ImageCaptionUtils.schedule_caption(
+            image,
+            platform_name,
+            is_private,
+            chat_id,
+            priority=CaptionScheduler.PRIORITY_HIGH,
         )
-        task.add_done_callback(ImageCaptionUtils._on_caption_task_done)
+        hashed = ImageCaptionUtils._hash_image(image)
+        fut = ImageCaptionUtils._pending.get(hashed)
+        if fut is None or fut.done():
+            return None
+        CaptionScheduler.expedite(hashed)
+        return fut
+
+    @staticmethod
+    def _expiry_heap(path: str, data: Dict[str, Any]) -> list[tuple[float, str]]:
+        heap = ImageCaptionUtils._expiry_heaps.get(path, count=False)
+        if heap is None:
+            heap = []
+            for key, item in data.items():
+                if isinstance(item, dict):
+                    heap.append((float(item.get("ts", 0) or 0), key))
+            heapq.heapify(heap)
+            ImageCaptionUtils._expiry_heaps.set(path, heap)
+        return heap
 
     @staticmethod
     def _prune_cache_data(
+        path: str,
         data: Dict[str, Any],
         max_age_days: int,
         max_items: int,
-    ) -> Dict[str, Any]:
-        if not data:
-            return data
-        try:
-            now = time.time()
-            # 删除过期
-            expire_ts = now - max_age_days * 86400
-            for k in list(data.keys()):
-                ts = data[k].get("ts", 0)
-                if ts < expire_ts:
-                    data.pop(k, None)
-            # 超出数量则按时间排序保留最新
-            if len(data) > max_items > 0:
-                sorted_items = sorted(data.items(), key=lambda kv: kv[1].get("ts", 0), reverse=True)
-                data = dict(sorted_items[:max_items])
-        except Exception:
-            pass
-        return data
+    ) -> None:
+        """
+        增量清理：按 ts 最小堆弹出过期或超量条目（原地修改 data）
+
+        堆中已被覆盖/删除的条目在弹出时惰性跳过，每次写入只需 O(log n)。
+        """
+        heap = ImageCaptionUtils._expiry_heap(path, data)
+        expire_ts = time.time() - max_age_days * 86400
+        while heap:
+            ts, key = heap[0]
+            item = data.get(key)
+            if not isinstance(item, dict) or float(item.get("ts", 0) or 0) != ts:
+                heapq.heappop(heap)
+                continue
+            if ts < expire_ts or (max_items > 0 and len(data) > max_items):
+                heapq.heappop(heap)
+                data.pop(key, None)
+                continue
+            break
+        # 惰性删除累积过多时重建，避免堆无界增长
+        if len(heap) > 2 * max(len(data), 64):
+            ImageCaptionUtils._expiry_heaps.pop(path, None)
+
+    @staticmethod
+    def _resolve_entry(item: Dict[str, Any]) -> Optional[str]:
+        """会话缓存条目优先经全局转述库（仅内存 LRU）按内容哈希解析，缺失时回退条目自带的转述。"""
+        content_hash = item.get("content")
+        if content_hash and CaptionStore.available():
+            row = CaptionStore.peek(content_hash)
+            if row and row.get("caption"):
+                return row["caption"]
+        return item.get("caption")
 
     @staticmethod
     def get_memory_caption(image: str) -> Optional[str]:
@@ -295,7 +861,6 @@ class ImageCaptionUtils:
     def get_cached_caption(image: str, platform: str, is_private: bool, chat_id: str) -> Optional[str]:
         chat_type = "private" if is_private else "group"
         hashed = ImageCaptionUtils._hash_image(image)
-        legacy_hashes = ImageCaptionUtils._legacy_hash_candidates(image)
         candidates = [
             ImageCaptionUtils._cache_path(platform, chat_type, chat_id),
         ]
@@ -318,9 +883,10 @@ class ImageCaptionUtils:
             if not data:
                 continue
             item = data.get(hashed)
-            if not item:
+            # 主目录完成键迁移后只需单次探测；旧目录为只读回退，仍按旧格式查找
+            if not item and (index > 0 or not ImageCaptionUtils._keys_canonical):
                 hit_legacy_hash = None
-                for legacy_hashed in legacy_hashes:
+                for legacy_hashed in ImageCaptionUtils._legacy_hash_candidates(image):
                     if legacy_hashed == hashed:
                         continue
                     legacy_item = data.get(legacy_hashed)
@@ -332,10 +898,11 @@ class ImageCaptionUtils:
                     data[hashed] = item
                     if hit_legacy_hash:
                         data.pop(hit_legacy_hash, None)
-                    ImageCaptionUtils._save_cache(path, data)
+                    ImageCaptionUtils._expiry_heaps.pop(path, None)
+                    ImageCaptionUtils._queue_save(path, data)
             if not item:
                 continue
-            caption = item.get("caption")
+            caption = ImageCaptionUtils._resolve_entry(item)
             if not caption:
                 continue
             if index > 0:
@@ -353,21 +920,94 @@ class ImageCaptionUtils:
         return None
 
     @staticmethod
-    def set_cached_caption(image: str, caption: str, platform: str, is_private: bool, chat_id: str) -> None:
+    def set_cached_caption(
+        image: str,
+        caption: str,
+        platform: str,
+        is_private: bool,
+        chat_id: str,
+        phash: str | None = None,
+        content_hash: str | None = None,
+    ) -> None:
         chat_type = "private" if is_private else "group"
         path = ImageCaptionUtils._cache_path(platform, chat_type, chat_id)
         data = ImageCaptionUtils._load_cache(path)
+        heap = ImageCaptionUtils._expiry_heap(path, data)
         hashed = ImageCaptionUtils._hash_image(image)
-        data[hashed] = {"caption": caption, "ts": time.time()}
-        for legacy_hashed in ImageCaptionUtils._legacy_hash_candidates(image):
-            if legacy_hashed != hashed:
-                data.pop(legacy_hashed, None)
+        entry = {"caption": caption, "ts": time.time()}
+        if phash:
+            entry["phash"] = phash
+        if content_hash:
+            entry["content"] = content_hash
+        data[hashed] = entry
+        heapq.heappush(heap, (entry["ts"], hashed))
+        if not ImageCaptionUtils._keys_canonical:
+            for legacy_hashed in ImageCaptionUtils._legacy_hash_candidates(image):
+                if legacy_hashed != hashed:
+                    data.pop(legacy_hashed, None)
         # 清理策略
         cfg = ImageCaptionUtils.config.get("image_processing", {})
         max_age = int(cfg.get("caption_cache_days", 7))
         max_items = int(cfg.get("caption_cache_limit", 200))
-        data = ImageCaptionUtils._prune_cache_data(data, max_age, max_items)
-        ImageCaptionUtils._save_cache(path, data)
+        ImageCaptionUtils._prune_cache_data(path, data, max_age, max_items)
+        ImageCaptionUtils._queue_save(path, data)
+
+    @staticmethod
+    def _remember_caption(
+        image: str,
+        caption: str,
+        platform_name: str,
+        is_private: bool,
+        chat_id: str,
+        phash: str | None = None,
+        content_hash: str | None = None,
+    ) -> None:
+        """写入内存缓存，并按配置写入会话持久化缓存。"""
+        ImageCaptionUtils.caption_generation += 1
+        ImageCaptionUtils._failures.pop(ImageCaptionUtils._hash_image(image))
+        ImageCaptionUtils.caption_cache.set(ImageCaptionUtils._cache_key(image), caption)
+        cfg = ImageCaptionUtils.config.get("image_processing", {}) if ImageCaptionUtils.config else {}
+        try:
+            if cfg.get("caption_cache_persist", True):
+                ImageCaptionUtils.set_cached_caption(
+                    image,
+                    caption,
+                    platform_name,
+                    is_private,
+                    chat_id,
+                    phash=phash,
+                    content_hash=content_hash,
+                )
+        except Exception as e:
+            logger.warning(f"写入持久化转述缓存失败: {e}")
+        ImageCaptionUtils._notify_caption_ready(image, caption, platform_name, is_private, chat_id)
+
+    @staticmethod
+    def _notify_caption_ready(
+        image: str,
+        caption: str,
+        platform_name: str,
+        is_private: bool,
+        chat_id: str,
+    ) -> None:
+        """新转述写入缓存后交由 HistoryStorage 回填进近期消息的入库大纲（仅在新产生时调用）。"""
+        try:
+            from .history_storage import HistoryStorage  # 延迟导入避免循环
+        except Exception:
+            return
+        try:
+            HistoryStorage.queue_outline_backfill(platform_name, is_private, chat_id, image, caption)
+        except Exception as e:
+            logger.debug(f"登记大纲转述回填失败: {e}")
+
+    @staticmethod
+    def _provider_label(provider, provider_id: str) -> str:
+        if provider_id:
+            return provider_id
+        try:
+            return str(provider.meta().id)
+        except Exception:
+            return "default"
 
     @staticmethod
     async def generate_image_caption(
@@ -380,6 +1020,9 @@ class ImageCaptionUtils:
         """
         为单张图片生成文字描述
         
+        同一图片同时只会有一次生成：已在后台排队的任务被认领后立即执行，
+        正在执行的任务则直接等待其结果。
+        
         Args:
             image: 图片的base64编码或URL
             timeout: 超时时间（秒）
@@ -388,17 +1031,73 @@ class ImageCaptionUtils:
             生成的图片描述文本，如果失败则返回None
         """
         config = ImageCaptionUtils.config
-        context = ImageCaptionUtils.context
-        if not config:
+        if not config or not config.get("image_processing", {}).get("use_image_caption", False):
             return None
-        image_processing_config = config.get("image_processing", {})
-        if not image_processing_config.get("use_image_caption", False):
+        memory_caption = ImageCaptionUtils.get_memory_caption(image)
+        if memory_caption:
+            return memory_caption
+        key = ImageCaptionUtils._hash_image(image)
+        fut = ImageCaptionUtils._pending.get(key)
+        if fut is None and ImageCaptionUtils._failure_blocked(key):
             return None
+        if fut is not None and not fut.done():
+            if CaptionScheduler.claim(key) is None:
+                return await asyncio.shield(fut)
+        else:
+            fut = asyncio.get_running_loop().create_future()
+            ImageCaptionUtils._pending[key] = fut
+        return await ImageCaptionUtils._run_owned(
+            key, fut, image, timeout, platform_name, is_private, chat_id
+        )
 
+    @staticmethod
+    async def _generate_image_caption(
+        image: str,
+        timeout: int = 30,
+        platform_name: str = "",
+        is_private: bool = False,
+        chat_id: str = "",
+    ) -> Optional[str]:
+        caption, ctx = await ImageCaptionUtils._prepare_caption(
+            image, platform_name, is_private, chat_id
+        )
+        if caption or ctx is None:
+            return caption
+        image_processing_config = ImageCaptionUtils.config.get("image_processing", {})
+        providers = ImageCaptionUtils._caption_providers(image_processing_config)
+        if not providers:
+            provider_id = image_processing_config.get("image_caption_provider_id", "")
+            logger.warning(f"无法找到提供商: {provider_id if provider_id else '默认'}")
+            return None
+        return await ImageCaptionUtils._caption_single(
+            image, ctx, providers, timeout, platform_name, is_private, chat_id
+        )
+
+    @staticmethod
+    async def _prepare_caption(
+        image: str,
+        platform_name: str = "",
+        is_private: bool = False,
+        chat_id: str = "",
+    ) -> tuple[Optional[str], Optional[Dict[str, Any]]]:
+        """
+        转述前的准备阶段：依次查询各级缓存、校验/下载图片并转码。
+
+        Returns:
+            (caption, None)  命中缓存或可复用的近似图片转述
+            (None, None)     无需或无法转述
+            (None, ctx)      需要调用视觉模型，ctx 含 image_url/prompt/phash 等
+        """
+        config = ImageCaptionUtils.config
+        if not config:
+            return None, None
+        image_processing_config = config.get("image_processing", {})
+        if not image_processing_config.get("use_image_caption", False):
+            return None, None
         cache_key = ImageCaptionUtils._cache_key(image)
         memory_caption = ImageCaptionUtils.caption_cache.get(cache_key)
         if memory_caption:
-            return memory_caption
+            return memory_caption, None
 
         persistent_caption = None
         try:
@@ -410,21 +1109,23 @@ class ImageCaptionUtils:
             persistent_caption = None
 
         if persistent_caption:
-            ImageCaptionUtils.caption_cache[cache_key] = persistent_caption
-            return persistent_caption
+            ImageCaptionUtils.caption_cache.set(cache_key, persistent_caption)
+            return persistent_caption, None
 
         if isinstance(image, str):
             if image.startswith("file:///"):
                 file_path = normalize_image_ref(image)
                 if not os.path.exists(file_path) or os.path.getsize(file_path) <= 0:
                     logger.warning(f"图片转述跳过：本地文件无效 {file_path}")
-                    return None
+                    ImageCaptionUtils._record_failure(image)
+                    return None, None
             elif image.startswith("http"):
                 pass
             elif os.path.exists(image):
                 if os.path.getsize(image) <= 0:
                     logger.warning(f"图片转述跳过：本地文件为空 {image}")
-                    return None
+                    ImageCaptionUtils._record_failure(image)
+                    return None, None
 
         effective_image = image
         if isinstance(image, str) and image.startswith("http"):
@@ -434,72 +1135,277 @@ class ImageCaptionUtils:
                 effective_image = await download_image_by_url_safe(image)
                 if not effective_image:
                     logger.warning(f"图片转述跳过：下载为空 {image}")
-                    return None
+                    ImageCaptionUtils._record_failure(image)
+                    return None, None
             except Exception as e:
                 logger.warning(f"图片转述跳过：下载失败 {image} ({e})")
-                return None
+                ImageCaptionUtils._record_failure(image)
+                return None, None
+        caption_prompt = image_processing_config.get("image_caption_prompt", "请直接简短描述这张图片")
+        prompt_version = CaptionStore.prompt_version(caption_prompt)
 
-        provider_id = image_processing_config.get("image_caption_provider_id", "")
-        # 获取提供商
-        if provider_id == "":
-            provider = context.get_using_provider()
-        else:
-            provider = context.get_provider_by_id(provider_id)
-        
-        if not provider:
-            logger.warning(f"无法找到提供商: {provider_id if provider_id else '默认'}")
+        # 全局转述库：相同字节的图片在任意会话中只转述一次
+        content_hash = None
+        if (
+            CaptionStore.available()
+            and isinstance(effective_image, str)
+            and not effective_image.startswith(("http://", "https://", "base64://"))
+        ):
+            content_hash = await asyncio.to_thread(file_content_hash, effective_image)
+            row = await CaptionStore.get_async(content_hash)
+            if row and row.get("caption") and row.get("prompt_version") == prompt_version:
+                logger.debug(f"[SpectreCore] 全局转述库命中: {image[:50]}...")
+                ImageCaptionUtils._remember_caption(
+                    image,
+                    row["caption"],
+                    platform_name,
+                    is_private,
+                    chat_id,
+                    content_hash=content_hash,
+                )
+                return row["caption"], None
+
+        # 感知哈希：近似图片（不同 URL/文件名的同一张图）直接复用已有转述
+        phash = await ImagePHash.compute(effective_image)
+        similar_caption = await ImagePHash.find_caption(phash)
+        if similar_caption:
+            logger.debug(f"[SpectreCore] 近似图片复用转述: {image[:50]}...")
+            ImageCaptionUtils._remember_caption(
+                image,
+                similar_caption,
+                platform_name,
+                is_private,
+                chat_id,
+                phash=phash,
+                content_hash=content_hash,
+            )
+            await CaptionStore.put_async(content_hash, similar_caption, "phash", prompt_version)
+            return similar_caption, None
+
+        effective_image = await ImageTranscoder.prepare(effective_image)
+
+        return None, {
+            "image_url": effective_image,
+            "prompt": caption_prompt,
+            "prompt_version": prompt_version,
+            "phash": phash,
+            "content_hash": content_hash,
+        }
+
+    @staticmethod
+    async def _caption_single(
+        image: str,
+        ctx: Dict[str, Any],
+        providers: list[tuple[str, Any]],
+        timeout: float,
+        platform_name: str,
+        is_private: bool,
+        chat_id: str,
+    ) -> Optional[str]:
+        image_processing_config = ImageCaptionUtils.config.get("image_processing", {})
+        caption, label = await ImageCaptionUtils._hedged_caption(
+            providers,
+            ctx["prompt"],
+            ctx["image_url"],
+            timeout,
+            bool(image_processing_config.get("caption_hedge_enable", True)),
+        )
+        if not caption:
+            ImageCaptionUtils._record_failure(image)
             return None
+        await ImageCaptionUtils._commit_caption(
+            image, caption, label, ctx, platform_name, is_private, chat_id
+        )
+        return caption
 
-        try:
-            # 带超时控制的调用大模型进行图片转述
-            async def call_llm():
-                return await provider.text_chat(
-                    prompt=image_processing_config.get("image_caption_prompt", "请直接简短描述这张图片"),
-                    contexts=[], 
-                    image_urls=[effective_image], # 图片链接，支持路径和网络链接
-                    func_tool=None, # 当前用户启用的函数调用工具。如果不需要，可以不传
-                    system_prompt=""  # 系统提示，可以不传
+    @staticmethod
+    async def _commit_caption(
+        image: str,
+        caption: str,
+        label: str,
+        ctx: Dict[str, Any],
+        platform_name: str,
+        is_private: bool,
+        chat_id: str,
+    ) -> None:
+        """视觉模型转述成功后写入各级缓存。"""
+        short_caption = caption.replace("\n", " ").strip()
+        if len(short_caption) > 80:
+            short_caption = short_caption[:80] + "..."
+        logger.info(f"[SpectreCore] 图片转述完成({label}): {short_caption}")
+        ImagePHash.remember(ctx["phash"], caption)
+        logger.debug(f"缓存图片描述: {image[:50]}... -> {caption}")
+        ImageCaptionUtils._remember_caption(
+            image,
+            caption,
+            platform_name,
+            is_private,
+            chat_id,
+            phash=ctx["phash"],
+            content_hash=ctx["content_hash"],
+        )
+        await CaptionStore.put_async(
+            ctx["content_hash"], caption, label, ctx["prompt_version"]
+        )
+
+    @staticmethod
+    def _caption_providers(image_processing_config: dict) -> list[tuple[str, Any]]:
+        """
+        按配置顺序解析转述提供商列表 [(label, provider), ...]
+
+        image_caption_provider_ids 为空时回退到 image_caption_provider_id 或当前对话模型。
+        """
+        context = ImageCaptionUtils.context
+        ids = [str(i).strip() for i in image_processing_config.get("image_caption_provider_ids", []) or []]
+        ids = [i for i in ids if i]
+        if not ids:
+            ids = [image_processing_config.get("image_caption_provider_id", "")]
+        providers: list[tuple[str, Any]] = []
+        seen: set[str] = set()
+        for provider_id in ids:
+            try:
+                provider = (
+                    context.get_provider_by_id(provider_id)
+                    if provider_id
+                    else context.get_using_provider()
                 )
-            
-            # 使用asyncio.wait_for添加超时控制
-            llm_response = await asyncio.wait_for(call_llm(), timeout=timeout)
-            caption = (llm_response.completion_text or "").strip()
-            role = getattr(llm_response, "role", "")
-            if role and role != "assistant":
-                short_caption = caption.replace("\n", " ").strip()
-                if len(short_caption) > 80:
-                    short_caption = short_caption[:80] + "..."
-                logger.warning(f"[SpectreCore] 图片转述失败({role}): {short_caption}")
-                return None
-            if not caption:
-                return None
-            if ImageCaptionUtils._looks_like_error_text(caption):
-                short_caption = caption.replace("\n", " ").strip()
-                if len(short_caption) > 80:
-                    short_caption = short_caption[:80] + "..."
-                logger.warning(f"[SpectreCore] 图片转述异常文本: {short_caption}")
-                return None
-            
-            # 缓存结果
-            if caption:
-                short_caption = caption.replace("\n", " ").strip()
-                if len(short_caption) > 80:
-                    short_caption = short_caption[:80] + "..."
-                logger.info(f"[SpectreCore] 图片转述完成: {short_caption}")
-                ImageCaptionUtils.caption_cache[cache_key] = caption
-                logger.debug(f"缓存图片描述: {image[:50]}... -> {caption}")
-                try:
-                    if image_processing_config.get("caption_cache_persist", True):
-                        ImageCaptionUtils.set_cached_caption(
-                            image, caption, platform_name, is_private, chat_id
-                        )
-                except Exception as e:
-                    logger.warning(f"写入持久化转述缓存失败: {e}")
-                 
-            return caption
+            except Exception:
+                provider = None
+            if not provider:
+                if provider_id:
+                    logger.warning(f"无法找到转述提供商: {provider_id}")
+                continue
+            label = ImageCaptionUtils._provider_label(provider, provider_id)
+            if label in seen:
+                continue
+            seen.add(label)
+            providers.append((label, provider))
+        return providers
+
+    @staticmethod
+    def _latency(label: str) -> LatencyTracker:
+        tracker = ImageCaptionUtils._provider_latency.get(label)
+        if tracker is None:
+            tracker = LatencyTracker()
+            ImageCaptionUtils._provider_latency[label] = tracker
+        return tracker
+
+    @staticmethod
+    def _adaptive_timeout(label: str, max_timeout: float) -> float:
+        """按该提供商的滚动 p90 延迟收紧超时：p90 × 3，限定在 [10s, max_timeout]。"""
+        p90 = ImageCaptionUtils._latency(label).quantile(0.9)
+        if p90 is None:
+            return max_timeout
+        return min(max_timeout, max(ImageCaptionUtils.MIN_CAPTION_TIMEOUT, p90 * 3))
+
+    @staticmethod
+    async def _caption_once(
+        label: str,
+        provider,
+        caption_prompt: str,
+        image_url: str,
+        timeout: float,
+    ) -> Optional[str]:
+        """向单个提供商请求一次转述，失败或结果无效时返回 None。"""
+        started = time.monotonic()
+        try:
+            llm_response = await asyncio.wait_for(
+                provider.text_chat(
+                    prompt=caption_prompt,
+                    contexts=[],
+                    image_urls=[image_url],  # 图片链接，支持路径和网络链接
+                    func_tool=None,
+                    system_prompt="",
+                ),
+                timeout=timeout,
+            )
         except asyncio.TimeoutError:
-            logger.warning(f"图片转述超时，超过了{timeout}秒")
+            ImageCaptionUtils._latency(label).record(timeout, ok=False)
+            logger.warning(f"图片转述超时({label})，超过了{timeout:.0f}秒")
             return None
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
-            logger.error(f"图片转述失败: {e}")
+            ImageCaptionUtils._latency(label).record(time.monotonic() - started, ok=False)
+            logger.error(f"图片转述失败({label}): {e}")
+            return None
+        elapsed = time.monotonic() - started
+        caption = (getattr(llm_response, "completion_text", "") or "").strip()
+        role = getattr(llm_response, "role", "")
+        short_caption = caption.replace("\n", " ").strip()
+        if len(short_caption) > 80:
+            short_caption = short_caption[:80] + "..."
+        if role and role != "assistant":
+            ImageCaptionUtils._latency(label).record(elapsed, ok=False)
+            logger.warning(f"[SpectreCore] 图片转述失败({label}/{role}): {short_caption}")
+            return None
+        if not caption:
+            ImageCaptionUtils._latency(label).record(elapsed, ok=False)
+            return None
+        if ImageCaptionUtils._looks_like_error_text(caption):
+            ImageCaptionUtils._latency(label).record(elapsed, ok=False)
+            logger.warning(f"[SpectreCore] 图片转述异常文本({label}): {short_caption}")
             return None
+        ImageCaptionUtils._latency(label).record(elapsed)
+        return caption
+
+    @staticmethod
+    async def _hedged_caption(
+        providers: list[tuple[str, Any]],
+        caption_prompt: str,
+        image_url: str,
+        max_timeout: float,
+        hedge: bool = True,
+    ) -> tuple[Optional[str], str]:
+        """
+        按顺序向提供商请求转述，返回 (caption, label)
+
+        当前请求失败时立即改用下一个提供商；若运行超过其历史 p90 延迟仍未返回，
+        并行向下一个提供商发出对冲请求，先返回有效结果者胜出，其余请求取消。
+        """
+        tasks: dict[asyncio.Task, str] = {}
+        next_idx = 0
+
+        def launch() -> str:
+            nonlocal next_idx
+            label, provider = providers[next_idx]
+            next_idx += 1
+            task = asyncio.create_task(
+                ImageCaptionUtils._caption_once(
+                    label,
+                    provider,
+                    caption_prompt,
+                    image_url,
+                    ImageCaptionUtils._adaptive_timeout(label, max_timeout),
+                )
+            )
+            tasks[task] = label
+            return label
+
+        current = launch()
+        try:
+            while tasks:
+                hedge_after = None
+                if hedge and len(tasks) == 1 and next_idx < len(providers):
+                    hedge_after = ImageCaptionUtils._latency(current).quantile(0.9)
+                done, _pending = await asyncio.wait(
+                    tasks, timeout=hedge_after, return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    ImageCaptionUtils._hedge_stats["hedged"] += 1
+                    logger.debug(f"[SpectreCore] 转述超过 {current} 的 p90 延迟，对冲请求下一个提供商。")
+                    current = launch()
+                    continue
+                for task in done:
+                    label = tasks.pop(task)
+                    caption = task.result()
+                    if caption:
+                        if label != providers[0][0]:
+                            ImageCaptionUtils._hedge_stats["fallback_wins"] += 1
+                        return caption, label
+                if next_idx < len(providers):
+                    current = launch()
+            return None, ""
+        finally:
+            for task in tasks:
+                task.cancel()
@@ -0,0 +1,210 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+import time
+from collections import OrderedDict
+
+from astrbot.api.all import logger
+
+from .image_ref import file_content_hash, normalize_image_ref
+
+
+def _compute_phash(path: str) -> str | None:
+    """计算 aHash + dHash（各 64 位），拼接为 32 位十六进制串。"""
+    from PIL import Image as PILImage
+    import numpy as np
+
+    with PILImage.open(path) as img:
+        try:
+            img.seek(0)
+        except EOFError:
+            pass
+        gray = img.convert("L")
+        small_a = np.asarray(gray.resize((8, 8), PILImage.LANCZOS), dtype=np.float32)
+        small_d = np.asarray(gray.resize((9, 8), PILImage.LANCZOS), dtype=np.int16)
+    a_bits = (small_a > small_a.mean()).flatten()
+    d_bits = (small_d[:, 1:] > small_d[:, :-1]).flatten()
+    a_hash = int.from_bytes(np.packbits(a_bits).tobytes(), "big")
+    d_hash = int.from_bytes(np.packbits(d_bits).tobytes(), "big")
+    return f"{a_hash:016x}{d_hash:016x}"
+
+
+class ImagePHash:
+    """
+    图片感知哈希索引
+
+    同一张表情/梗图常以不同 URL、文件名出现。这里以图片内容计算感知哈希，
+    哈希一致的图片复用已有转述。近似匹配（phash_threshold > 0）需显式开启，
+    且只用于转述复用，不参与上传去重：同一模板配不同文字的梗图哈希往往很接近。
+    依赖 Pillow 与 NumPy，缺失时自动停用。
+    """
+
+    MAX_ENTRIES = 5000
+    SAVE_INTERVAL = 30.0
+
+    config = None
+    index_path = None
+    _entries: "OrderedDict[str, str]" = OrderedDict()
+    _content_memo: dict[str, str] = {}
+    _available = False
+    _dirty = False
+    _last_save = 0.0
+
+    @staticmethod
+    def init(config: dict, cache_dir: str) -> None:
+        ImagePHash.config = config
+        ImagePHash.index_path = os.path.join(cache_dir, "phash_index.json")
+        ImagePHash._entries.clear()
+        ImagePHash._content_memo.clear()
+        ImagePHash._dirty = False
+        try:
+            import numpy  # noqa: F401
+            from PIL import Image as _PILImage  # noqa: F401
+
+            ImagePHash._available = True
+        except ImportError:
+            ImagePHash._available = False
+            if ImagePHash._cfg().get("phash_enable", False):
+                logger.info("[SpectreCore] 未安装 Pillow/NumPy，感知哈希去重已停用。")
+            return
+        ImagePHash._load_index()
+
+    @staticmethod
+    def _cfg() -> dict:
+        if not ImagePHash.config:
+            return {}
+        return ImagePHash.config.get("image_processing", {})
+
+    @staticmethod
+    def is_enabled() -> bool:
+        return ImagePHash._available and bool(ImagePHash._cfg().get("phash_enable", False))
+
+    @staticmethod
+    def _threshold() -> int:
+        try:
+            return max(0, int(ImagePHash._cfg().get("phash_threshold", 0)))
+        except (TypeError, ValueError):
+            return 0
+
+    @staticmethod
+    def _load_index() -> None:
+        path = ImagePHash.index_path
+        if not path or not os.path.exists(path):
+            return
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if isinstance(data, dict):
+                for phash, caption in data.items():
+                    if isinstance(caption, str) and caption:
+                        ImagePHash._entries[phash] = caption
+        except Exception as e:
+            logger.warning(f"读取感知哈希索引失败: {e}")
+
+    @staticmethod
+    def _save_index(data: dict[str, str]) -> None:
+        path = ImagePHash.index_path
+        if not path:
+            return
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(tmp, path)
+        except Exception as e:
+            logger.error(f"保存感知哈希索引失败: {e}")
+
+    @staticmethod
+    def flush() -> None:
+        if ImagePHash._dirty:
+            ImagePHash._dirty = False
+            ImagePHash._last_save = time.time()
+            ImagePHash._save_index(dict(ImagePHash._entries))
+
+    @staticmethod
+    def distance(a: str, b: str) -> int:
+        """两个哈希的汉明距离，取 aHash 与 dHash 中较大者。"""
+        try:
+            da = (int(a[:16], 16) ^ int(b[:16], 16)).bit_count()
+            dd = (int(a[16:], 16) ^ int(b[16:], 16)).bit_count()
+        except (TypeError, ValueError):
+            return 64
+        return max(da, dd)
+
+    @staticmethod
+    async def compute(image: str) -> str | None:
+        """计算本地图片的感知哈希；远程/base64 图片或计算失败时返回 None。"""
+        if not isinstance(image, str) or not ImagePHash.is_enabled():
+            return None
+        if image.startswith(("http://", "https://", "base64://")):
+            return None
+        path = normalize_image_ref(image)
+        content_hash = await asyncio.to_thread(file_content_hash, path)
+        if not content_hash:
+            return None
+        cached = ImagePHash._content_memo.get(content_hash)
+        if cached:
+            return cached
+        try:
+            phash = await asyncio.to_thread(_compute_phash, path)
+        except Exception as e:
+            logger.debug(f"[SpectreCore] 感知哈希计算失败: {path} ({e})")
+            return None
+        if phash:
+            if len(ImagePHash._content_memo) >= ImagePHash.MAX_ENTRIES:
+                ImagePHash._content_memo.clear()
+            ImagePHash._content_memo[content_hash] = phash
+        return phash
+
+    @staticmethod
+    def _nearest(phash: str, keys: list[str], threshold: int) -> str | None:
+        best_key = None
+        best_dist = threshold + 1
+        for key in keys:
+            dist = ImagePHash.distance(phash, key)
+            if dist < best_dist:
+                best_key, best_dist = key, dist
+                if dist == 0:
+                    break
+        return best_key
+
+    @staticmethod
+    async def find_caption(phash: str | None) -> str | None:
+        if not phash or not ImagePHash.is_enabled():
+            return None
+        caption = ImagePHash._entries.get(phash)
+        if caption:
+            ImagePHash._entries.move_to_end(phash)
+            return caption
+        threshold = ImagePHash._threshold()
+        if threshold <= 0:
+            return None
+        # 近似匹配需线性扫描全部条目，放到线程中执行避免阻塞事件循环
+        keys = list(ImagePHash._entries)
+        best_key = await asyncio.to_thread(ImagePHash._nearest, phash, keys, threshold)
+        if best_key is None or best_key not in ImagePHash._entries:
+            return None
+        ImagePHash._entries.move_to_end(best_key)
+        return ImagePHash._entries[best_key]
+
+    @staticmethod
+    def remember(phash: str | None, caption: str) -> None:
+        if not phash or not caption or not ImagePHash.is_enabled():
+            return
+        ImagePHash._entries[phash] = caption
+        ImagePHash._entries.move_to_end(phash)
+        while len(ImagePHash._entries) > ImagePHash.MAX_ENTRIES:
+            ImagePHash._entries.popitem(last=False)
+        ImagePHash._dirty = True
+        if time.time() - ImagePHash._last_save >= ImagePHash.SAVE_INTERVAL:
+            ImagePHash._dirty = False
+            ImagePHash._last_save = time.time()
+            snapshot = dict(ImagePHash._entries)
+            try:
+                asyncio.get_running_loop()
+                asyncio.create_task(asyncio.to_thread(ImagePHash._save_index, snapshot))
+            except RuntimeError:
+                ImagePHash._save_index(snapshot)
@@ -1,8 +1,15 @@
+import hashlib
 import os
+import threading
 
 from astrbot.api.all import Image
 
 
+_CONTENT_HASH_LIMIT = 4096
+_content_hash_memo: dict[tuple[str, int, int], str] = {}
+_content_hash_lock = threading.Lock()
+
+
 def _normalize_file_path(path: str) -> str:
     return os.path.abspath(path).replace("\\", "/")
 
@@ -22,6 +29,37 @@ def normalize_image_ref(image: str) -> str:
     return image
 
 
+def file_content_hash(path: str) -> str | None:
+    """返回本地图片文件内容的 sha1，按 (路径, mtime, 大小) 记忆；文件无效时返回 None。"""
+    if not isinstance(path, str) or not path:
+        return None
+    path = normalize_image_ref(path)
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    if st.st_size <= 0:
+        return None
+    memo_key = (path, st.st_mtime_ns, st.st_size)
+    with _content_hash_lock:
+        cached = _content_hash_memo.get(memo_key)
+    if cached:
+        return cached
+    h = hashlib.sha1()
+    try:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 16), b""):
+                h.update(chunk)
+    except OSError:
+        return None
+    digest = h.hexdigest()
+    with _content_hash_lock:
+        if len(_content_hash_memo) >= _CONTENT_HASH_LIMIT:
+            _content_hash_memo.clear()
+        _content_hash_memo[memo_key] = digest
+    return digest
+
+
 def build_image_aliases(image: str) -> set[str]:
     aliases: set[str] = set()
     if not isinstance(image, str) or not image:
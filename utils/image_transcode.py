@@ -0,0 +1,224 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from astrbot.api.all import logger
+from astrbot.core.utils.astrbot_path import get_astrbot_plugin_data_path
+
+from .image_ref import file_content_hash, normalize_image_ref
+
+
+def _transcode_worker(
+    src: str,
+    dst: str,
+    max_edge: int,
+    fmt: str,
+    quality: int,
+) -> bool:
+    """进程池内执行：缩放、动图取关键帧并重编码。返回 False 表示沿用原图。"""
+    try:
+        from PIL import Image as PILImage
+    except ImportError:
+        return False
+
+    with PILImage.open(src) as img:
+        animated = bool(getattr(img, "is_animated", False))
+        if animated:
+            # 动图取中间帧作为关键帧，首帧常为空白或过渡帧
+            try:
+                img.seek(max(0, int(getattr(img, "n_frames", 1)) // 2))
+            except EOFError:
+                img.seek(0)
+        width, height = img.size
+        needs_resize = max_edge > 0 and max(width, height) > max_edge
+        if fmt == "jpeg":
+            if img.mode in ("RGBA", "LA", "P"):
+                rgba = img.convert("RGBA")
+                frame = PILImage.new("RGB", rgba.size, (255, 255, 255))
+                frame.paste(rgba, mask=rgba.split()[-1])
+            else:
+                frame = img.convert("RGB")
+        else:
+            frame = img.convert("RGBA") if img.mode in ("RGBA", "LA", "P") else img.convert("RGB")
+        if needs_resize:
+            frame.thumbnail((max_edge, max_edge), PILImage.LANCZOS)
+
+        tmp = f"{dst}.tmp"
+        save_kwargs = {"quality": quality}
+        try:
+            if fmt == "jpeg":
+                frame.save(tmp, format="JPEG", optimize=True, **save_kwargs)
+            else:
+                frame.save(tmp, format="WEBP", method=4, **save_kwargs)
+        except BaseException:
+            # 写入失败时清理残留的半成品
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+
+    # 静态小图若重编码后反而更大，则沿用原图
+    if not animated and not needs_resize and os.path.getsize(tmp) >= os.path.getsize(src):
+        os.remove(tmp)
+        return False
+    os.replace(tmp, dst)
+    return True
+
+
+class ImageTranscoder:
+    """
+    图片上传前预处理
+
+    将待上传给模型的本地图片缩放到最长边上限，重编码为 JPEG/WebP，
+    动图仅保留关键帧。转码在进程池中进行，结果按内容哈希缓存到磁盘，
+    重试与重复上传直接复用。
+    """
+
+    config = None
+    cache_dir = None
+    _executor: ProcessPoolExecutor | None = None
+    _results: dict[str, str | None] = {}
+    _inflight: dict[str, asyncio.Future] = {}
+    _pil_available = False
+
+    @staticmethod
+    def init(config: dict) -> None:
+        ImageTranscoder.config = config
+        ImageTranscoder.cache_dir = os.path.join(
+            get_astrbot_plugin_data_path(),
+            "spectrecorepro",
+            "transcoded",
+        )
+        ImageTranscoder._results.clear()
+        ImageTranscoder._inflight.clear()
+        ImageTranscoder.shutdown()
+        try:
+            import PIL  # noqa: F401
+
+            ImageTranscoder._pil_available = True
+        except ImportError:
+            ImageTranscoder._pil_available = False
+            if ImageTranscoder._cfg().get("transcode_enable", False):
+                logger.warning("[SpectreCore] 未安装 Pillow，图片压缩功能已停用。")
+
+    @staticmethod
+    def _cfg() -> dict:
+        if not ImageTranscoder.config:
+            return {}
+        return ImageTranscoder.config.get("image_processing", {})
+
+    @staticmethod
+    def is_enabled() -> bool:
+        return ImageTranscoder._pil_available and bool(
+            ImageTranscoder._cfg().get("transcode_enable", False)
+        )
+
+    @staticmethod
+    def _get_executor() -> ProcessPoolExecutor:
+        if ImageTranscoder._executor is None:
+            workers = int(ImageTranscoder._cfg().get("transcode_workers", 2))
+            ImageTranscoder._executor = ProcessPoolExecutor(max_workers=max(1, workers))
+        return ImageTranscoder._executor
+
+    @staticmethod
+    def shutdown() -> None:
+        executor = ImageTranscoder._executor
+        ImageTranscoder._executor = None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    @staticmethod
+    def cleanup(days: int) -> None:
+        cache_dir = ImageTranscoder.cache_dir
+        if not cache_dir or not os.path.exists(cache_dir):
+            return
+        thresh = days * 24 * 3600
+        now = time.time()
+        for fname in os.listdir(cache_dir):
+            fpath = os.path.join(cache_dir, fname)
+            try:
+                if os.path.isfile(fpath) and now - os.path.getmtime(fpath) > thresh:
+                    os.remove(fpath)
+            except Exception:
+                pass
+        ImageTranscoder._results.clear()
+
+    @staticmethod
+    async def _run_transcode(src: str, dst: str, max_edge: int, fmt: str, quality: int) -> bool:
+        loop = asyncio.get_running_loop()
+        args = (src, dst, max_edge, fmt, quality)
+        try:
+            return await loop.run_in_executor(
+                ImageTranscoder._get_executor(), _transcode_worker, *args
+            )
+        except BrokenProcessPool:
+            # 进程池不可用（如平台不支持 fork），回退线程执行
+            ImageTranscoder.shutdown()
+            return await asyncio.to_thread(_transcode_worker, *args)
+
+    @staticmethod
+    async def prepare(image: str) -> str:
+        """
+        返回用于上传的图片路径
+
+        Args:
+            image: 本地路径或 file:/// 引用；其他形式原样返回
+
+        Returns:
+            转码后的本地路径；未启用、无需转码或失败时返回原值
+        """
+        if not isinstance(image, str) or not ImageTranscoder.is_enabled():
+            return image
+        if image.startswith(("http://", "https://", "base64://")):
+            return image
+        src = normalize_image_ref(image)
+        if not os.path.isfile(src):
+            return image
+
+        cfg = ImageTranscoder._cfg()
+        max_edge = int(cfg.get("transcode_max_edge", 1280))
+        fmt = str(cfg.get("transcode_format", "jpeg")).lower()
+        fmt = "webp" if fmt == "webp" else "jpeg"
+        quality = min(100, max(1, int(cfg.get("transcode_quality", 85))))
+
+        content_hash = await asyncio.to_thread(file_content_hash, src)
+        if not content_hash:
+            return image
+        key = f"{content_hash}_{max_edge}_{quality}_{fmt}"
+        ext = ".webp" if fmt == "webp" else ".jpg"
+        dst = os.path.join(ImageTranscoder.cache_dir, f"{key}{ext}")
+
+        if key in ImageTranscoder._results:
+            cached = ImageTranscoder._results[key]
+            if cached is None:
+                return image
+            if os.path.exists(cached):
+                return cached
+        elif os.path.exists(dst) and os.path.getsize(dst) > 0:
+            ImageTranscoder._results[key] = dst
+            return dst
+
+        inflight = ImageTranscoder._inflight.get(key)
+        if inflight is not None:
+            result = await asyncio.shield(inflight)
+            return result or image
+
+        future = asyncio.get_running_loop().create_future()
+        ImageTranscoder._inflight[key] = future
+        result: str | None = None
+        try:
+            os.makedirs(ImageTranscoder.cache_dir, exist_ok=True)
+            if await ImageTranscoder._run_transcode(src, dst, max_edge, fmt, quality):
+                result = dst
+            ImageTranscoder._results[key] = result
+        except Exception as e:
+            logger.warning(f"[SpectreCore] 图片压缩失败，使用原图: {src} ({e})")
+        finally:
+            ImageTranscoder._inflight.pop(key, None)
+            future.set_result(result)
+        return result or image
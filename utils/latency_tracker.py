@@ -0,0 +1,43 @@
+from __future__ import annotations
+
+from collections import deque
+from typing import Any, Dict, Optional
+
+
+class LatencyTracker:
+    """
+    滚动延迟统计
+
+    保留最近 window 次成功调用的耗时（秒），样本数不少于 min_samples 时才给出分位数，
+    用于自适应超时与对冲请求的触发时机。失败（超时、异常、错误回复）只计入 failures，
+    不进入样本，避免超时上限或快速报错拉偏分位数。
+    """
+
+    def __init__(self, window: int = 50, min_samples: int = 5):
+        self.min_samples = max(1, int(min_samples))
+        self._samples: deque[float] = deque(maxlen=max(1, int(window)))
+        self.calls = 0
+        self.failures = 0
+
+    def record(self, seconds: float, ok: bool = True) -> None:
+        self.calls += 1
+        if not ok:
+            self.failures += 1
+            return
+        self._samples.append(max(0.0, float(seconds)))
+
+    def quantile(self, q: float) -> Optional[float]:
+        if len(self._samples) < self.min_samples:
+            return None
+        ordered = sorted(self._samples)
+        idx = min(len(ordered) - 1, max(0, int(round(q * (len(ordered) - 1)))))
+        return ordered[idx]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "samples": len(self._samples),
+            "calls": self.calls,
+            "failures": self.failures,
+            "p50": self.quantile(0.5),
+            "p90": self.quantile(0.9),
+        }
@@ -1,5 +1,6 @@
 from astrbot.api.all import *
 from typing import Dict, List, Optional, Any
+import asyncio
 import time
 import datetime
 import threading
@@ -10,12 +11,14 @@ try:
 except ImportError:
     from backports.zoneinfo import ZoneInfo
 
+from .context_snapshot import ContextSnapshot
 from .history_storage import HistoryStorage
 from .message_utils import MessageUtils
 from .image_caption import ImageCaptionUtils
 from astrbot.core.provider.entites import ProviderRequest
 from .persona_utils import PersonaUtils
-from .image_ref import build_image_aliases, extract_image_src, normalize_image_ref
+from .image_ref import build_image_aliases, extract_image_src, file_content_hash, normalize_image_ref
+from .image_transcode import ImageTranscoder
 
 class LLMUtils:
     """
@@ -25,6 +28,8 @@ class LLMUtils:
     
     _llm_call_status: Dict[str, Dict[str, Any]] = {}
     _lock = threading.Lock()
+    # call_llm 挑选上传图片时回看的消息条数
+    UPLOAD_SCAN_RANGE = 15
     
     # 网络时间校准相关
     _time_offset: float = 0.0  # 网络时间 - 系统时间 的偏移量 (秒)
@@ -63,21 +68,47 @@ class LLMUtils:
                 logger.warning(f"图片下载为空，已跳过: {image}")
                 return None, aliases, image_key
             aliases.update(build_image_aliases(local_path))
-            return local_path, aliases, image_key
+            return await ImageTranscoder.prepare(local_path), aliases, image_key
         if image.startswith("file:///"):
             file_path = normalize_image_ref(image)
             if not os.path.exists(file_path) or os.path.getsize(file_path) <= 0:
                 return None, aliases, image_key
             aliases.update(build_image_aliases(file_path))
-            return image, aliases, normalize_image_ref(file_path)
+            return await ImageTranscoder.prepare(image), aliases, normalize_image_ref(file_path)
         if os.path.exists(image):
             if os.path.getsize(image) <= 0:
                 return None, aliases, image_key
             normalized = normalize_image_ref(image)
             aliases.update(build_image_aliases(normalized))
-            return image, aliases, normalized
+            return await ImageTranscoder.prepare(image), aliases, normalized
         return image, aliases, image_key
     
+    @staticmethod
+    def upload_window_images(history: List[AstrBotMessage], image_count: int) -> Dict[str, tuple[str, Any]]:
+        """
+        预估下一次 call_llm 会作为视觉输入上传的图片（与其选取规则一致：
+        最近 UPLOAD_SCAN_RANGE 条消息中最新的 image_count 张，按规范化引用去重）。
+
+        Returns:
+            {图片键: (图片引用, 消息时间戳)}
+        """
+        window: Dict[str, tuple[str, Any]] = {}
+        if image_count <= 0 or not history:
+            return window
+        for msg in reversed(history[-LLMUtils.UPLOAD_SCAN_RANGE:]):
+            for comp in getattr(msg, "message", None) or []:
+                if not isinstance(comp, Image):
+                    continue
+                img_src = LLMUtils._get_image_src(comp)
+                if not img_src:
+                    continue
+                key = ImageCaptionUtils._hash_image(str(img_src))
+                if key not in window:
+                    window[key] = (str(img_src), getattr(msg, "timestamp", None))
+                if len(window) >= image_count:
+                    return window
+        return window
+
     @staticmethod
     def get_chat_key(platform_name: str, is_private_chat: bool, chat_id: str) -> str:
         chat_type = "private" if is_private_chat else "group"
@@ -91,6 +122,9 @@ class LLMUtils:
                 LLMUtils._llm_call_status[chat_key] = {}
             LLMUtils._llm_call_status[chat_key]["in_progress"] = in_progress
             LLMUtils._llm_call_status[chat_key]["last_call_time"] = time.time()
+        if not in_progress:
+            # 唤醒因该会话繁忙而暂缓的后台转述任务
+            ImageCaptionUtils.notify_llm_idle()
     
     @staticmethod
     def is_llm_in_progress(platform_name: str, is_private_chat: bool, chat_id: str) -> bool:
@@ -219,9 +253,15 @@ class LLMUtils:
         return mapping.get(tz_str, tz_str)
 
     @staticmethod
-    async def _get_time_prompt(history_msgs: List[AstrBotMessage], current_user_id: str, config: AstrBotConfig) -> str:
+    async def _get_time_prompt(
+        history_msgs: List[AstrBotMessage],
+        current_user_id: str,
+        config: AstrBotConfig,
+        snapshot: Optional[ContextSnapshot] = None,
+    ) -> str:
         """
         [双时区 + 多源校准版] 生成时间感知提示词
+        传入 snapshot 时直接复用其活跃度统计，不再重新遍历历史。
         """
         try:
             if not config.get('enable_time_tracking', True):
@@ -254,19 +294,23 @@ class LLMUtils:
             last_global_msg = None
             last_user_msg = None
             
-            for i in range(len(history_msgs) - 1, -1, -1):
-                msg = history_msgs[i]
-                if not hasattr(msg, "timestamp") or not msg.timestamp: continue
+            if snapshot is not None:
+                last_global_msg = snapshot.last_global_msg
+                last_user_msg = snapshot.last_user_msg
+            else:
+                for i in range(len(history_msgs) - 1, -1, -1):
+                    msg = history_msgs[i]
+                    if not hasattr(msg, "timestamp") or not msg.timestamp: continue
                 
-                diff = current_ts - msg.timestamp
-                if diff < 2.0:
-                    sender_id = str(msg.sender.user_id) if (hasattr(msg, "sender") and msg.sender) else ""
-                    if sender_id == str(current_user_id): continue
+                    diff = current_ts - msg.timestamp
+                    if diff < 2.0:
+                        sender_id = str(msg.sender.user_id) if (hasattr(msg, "sender") and msg.sender) else ""
+                        if sender_id == str(current_user_id): continue
                 
-                if last_global_msg is None: last_global_msg = msg
-                sender_id = str(msg.sender.user_id) if (hasattr(msg, "sender") and msg.sender) else ""
-                if last_user_msg is None and sender_id == str(current_user_id): last_user_msg = msg
-                if last_global_msg and last_user_msg: break
+                    if last_global_msg is None: last_global_msg = msg
+                    sender_id = str(msg.sender.user_id) if (hasattr(msg, "sender") and msg.sender) else ""
+                    if last_user_msg is None and sender_id == str(current_user_id): last_user_msg = msg
+                    if last_global_msg and last_user_msg: break
             
             # --- 构建 Prompt ---
             prompts = [f"{time_display_str}。"]
@@ -302,7 +346,11 @@ class LLMUtils:
         bot_self_id = str(event.get_self_id())
         umo = event.unified_msg_origin
 
-        # 特例：引用图片时，若无转述缓存则先同步转述，再拼装提示词
+        # 特例：引用图片若无转述缓存，立即以高优先级交给转述调度器，与历史/人设加载并行，
+        # 拼装提示词前最多等待 reply_caption_deadline 秒，超时的图片继续在后台完成
+        image_processing_cfg = config.get("image_processing", {})
+        started_at = time.monotonic()
+        caption_waits = []
         try:
             if hasattr(event.message_obj, "message"):
                 for comp in event.message_obj.message:
@@ -315,14 +363,15 @@ class LLMUtils:
                                 if not ImageCaptionUtils.get_cached_caption(
                                     img_src, platform_name, is_private, chat_id
                                 ):
-                                    await ImageCaptionUtils.generate_image_caption(
-                                        img_src,
-                                        platform_name=platform_name,
-                                        is_private=is_private,
-                                        chat_id=chat_id,
+                                    fut = ImageCaptionUtils.request_caption(
+                                        img_src, platform_name, is_private, chat_id
                                     )
+                                    if fut is not None and fut not in caption_waits:
+                                        caption_waits.append(fut)
         except Exception as e:
             logger.warning(f"引用图片转述预处理失败: {e}")
+
+        persona_task = asyncio.create_task(PersonaUtils.get_persona_prompt(context, umo))
         
         all_msgs = []
         try:
@@ -332,8 +381,18 @@ class LLMUtils:
         except Exception as e:
             logger.error(f"获取历史失败: {e}")
 
+        # 单次遍历得到历史窗口与活跃度，挂到事件上供 on_llm_request 兜底复用
+        now_ts = None
+        if config.get('enable_time_tracking', True):
+            now_ts = (await LLMUtils._get_precise_now(
+                config, config.get("system_timezone", "Asia/Shanghai")
+            )).timestamp()
+        snapshot = await ContextSnapshot.capture(
+            event, config, all_msgs=all_msgs, now_ts=now_ts
+        )
+
         # 调用新的双时区时间生成逻辑
-        time_prompt = await LLMUtils._get_time_prompt(all_msgs, user_id, config)
+        time_prompt = await LLMUtils._get_time_prompt(all_msgs, user_id, config, snapshot=snapshot)
 
         system_parts = []
         
@@ -349,30 +408,23 @@ class LLMUtils:
         else:
             env_info += f"\n场景: 群聊 ({chat_id})。"
         
+        # 缓存友好布局：系统提示词只放稳定内容（人设 → 规则 → 场景），
+        # 时间/活跃度与图片说明作为易变内容放到用户提示词末尾
+        cache_layout = bool(config.get("prompt_cache_layout", False))
+        volatile_parts = []
         if time_prompt:
-            env_info += f"\n{time_prompt}"
+            if cache_layout:
+                volatile_parts.append(time_prompt)
+            else:
+                env_info += f"\n{time_prompt}"
 
-        system_parts.append(env_info)
+        if not cache_layout:
+            system_parts.append(env_info)
 
         contexts = []
         try:
-            if hasattr(PersonaUtils, "resolve_persona_v3"):
-                persona = await PersonaUtils.resolve_persona_v3(
-                    context,
-                    umo,
-                )
-            else:
-                persona = await context.persona_manager.get_default_persona_v3(
-                    umo=umo
-                )
+            persona, persona_prompt = await persona_task
             if persona:
-                persona_prompt = persona.get("prompt", "")
-                mood_dialogs = persona.get("_mood_imitation_dialogs_processed", "")
-                if mood_dialogs:
-                    persona_prompt += (
-                        "\n请模仿以下示例的对话风格来反应(示例中，a代表用户，b代表你)\n"
-                        + str(mood_dialogs)
-                    )
                 if persona_prompt:
                     system_parts.append(persona_prompt)
                 begin_dialogs = persona.get("_begin_dialogs_processed", [])
@@ -387,9 +439,10 @@ class LLMUtils:
         else:
             instruction += "\n3. 请直接生成回复。"
         system_parts.append(instruction)
+        if cache_layout:
+            system_parts.append(env_info)
 
         # 预取图片用于上传与提示
-        image_processing_cfg = config.get("image_processing", {})
         use_image_caption = bool(image_processing_cfg.get("use_image_caption", False))
         image_urls = []
         image_notes = []
@@ -399,7 +452,7 @@ class LLMUtils:
         img_check_count = image_processing_cfg.get("image_count", 0)
         
         if img_check_count > 0 and all_msgs:
-            check_range = 15 
+            check_range = LLMUtils.UPLOAD_SCAN_RANGE
             msgs_to_check = all_msgs[-check_range:] if len(all_msgs) > check_range else all_msgs
             for msg in reversed(msgs_to_check):
                 if hasattr(msg, "message") and msg.message:
@@ -414,11 +467,19 @@ class LLMUtils:
                             )
                             if not upload_src:
                                 continue
-                            if image_key in seen_image_keys:
+                            # 同一内容可能以不同 URL/路径出现，按本地文件内容哈希精确去重
+                            content_key = None
+                            if not str(upload_src).startswith(("http://", "https://", "base64://")):
+                                content_hash = await asyncio.to_thread(file_content_hash, str(upload_src))
+                                if content_hash:
+                                    content_key = f"content:{content_hash}"
+                            if image_key in seen_image_keys or (content_key and content_key in seen_image_keys):
                                 if aliases:
                                     upload_aliases.update(aliases)
                                 continue
                             seen_image_keys.add(image_key)
+                            if content_key:
+                                seen_image_keys.add(content_key)
                             image_urls.append(upload_src)
                             if aliases:
                                 upload_aliases.update(aliases)
@@ -427,6 +488,9 @@ class LLMUtils:
                             if isinstance(img_src, str):
                                 basename = os.path.basename(normalize_image_ref(img_src))
                             note_name = basename or f"img_{note_idx}"
+                            if cache_layout:
+                                # 与稳定段历史中的 [图片@标识] 对应
+                                note_name += f", @{MessageUtils.image_tag_id(str(img_src))}"
                             image_notes.append(f"图片{note_idx}({note_name})")
                             if len(image_urls) >= img_check_count: break
                 if len(image_urls) >= img_check_count: break
@@ -444,63 +508,18 @@ class LLMUtils:
 
         final_system_prompt = "\n\n".join(system_parts)
 
-        history_str = ""
-        msg_limit = config.get("group_msg_history", 10)
-        bot_history_keep = config.get("bot_reply_history_count", 3)
-        current_msg_id = getattr(event.message_obj, "message_id", None)
-        current_msg_id = str(current_msg_id) if current_msg_id is not None else None
-        
-        if all_msgs:
-            tail_msgs = all_msgs[-msg_limit:] if len(all_msgs) > msg_limit else all_msgs
-            
-            recent_bot_msgs = []
-            if bot_history_keep > 0:
-                bot_msgs = []
-                for m in all_msgs:
-                    sender_id = None
-                    if hasattr(m, "sender") and m.sender:
-                        sender_id = str(m.sender.user_id)
-                    if sender_id == bot_self_id:
-                        bot_msgs.append(m)
-                if bot_msgs:
-                    recent_bot_msgs = bot_msgs[-bot_history_keep:]
-
-            seen_timestamps = set()
-            merged_list = []
-            
-            for m in tail_msgs:
-                merged_list.append(m)
-                if hasattr(m, 'timestamp'): seen_timestamps.add(m.timestamp)
-            
-            for bm in recent_bot_msgs:
-                ts = getattr(bm, 'timestamp', 0)
-                if ts not in seen_timestamps:
-                    merged_list.append(bm)
-                    seen_timestamps.add(ts)
-            
-            merged_list.sort(key=lambda x: getattr(x, 'timestamp', 0))
-            if current_msg_id:
-                merged_list = [
-                    msg
-                    for msg in merged_list
-                    if str(getattr(msg, "message_id", "")) != current_msg_id
-                ]
-            
-            fmt = await MessageUtils.format_history_for_llm(
-                merged_list,
-                max_messages=999,
-                image_caption=use_image_caption,
-                platform_name=platform_name,
-                is_private=is_private,
-                chat_id=str(chat_id),
-                uploaded_images=uploaded_images,
-            )
-            if fmt:
-                history_str = "以下是最近的聊天记录：\n" + fmt
+        if caption_waits:
+            deadline = float(image_processing_cfg.get("reply_caption_deadline", 8))
+            remaining = deadline - (time.monotonic() - started_at)
+            if remaining > 0:
+                # asyncio.wait 超时不会取消 future，转述由调度器继续完成
+                _done, pending = await asyncio.wait(caption_waits, timeout=remaining)
             else:
-                history_str = "（暂无历史记录）"
-        else:
-            history_str = "（暂无历史记录）"
+                pending = [f for f in caption_waits if not f.done()]
+            if pending:
+                logger.info(f"[SpectreCore] 引用图片转述未在 {deadline:g}s 内完成，{len(pending)} 张以占位发送，转述继续在后台进行。")
+
+        history_str = await snapshot.render(use_image_caption, uploaded_images)
 
         setattr(event, "_spectre_history", history_str)
         try:
@@ -527,10 +546,21 @@ class LLMUtils:
 
         if image_urls:
             notes = ", ".join(image_notes)
-            final_system_prompt += (
-                f"\n\n[ImageRefs]: 最近上传的图片（按顺序传给模型）: {notes}。"
+            image_refs = (
+                f"[ImageRefs]: 最近上传的图片（按顺序传给模型）: {notes}。"
                 " 若需描述，请依赖视觉输入；请勿臆造未提供的图片内容。"
             )
+            if cache_layout:
+                volatile_parts.append(image_refs)
+            else:
+                final_system_prompt += f"\n\n{image_refs}"
+
+        volatile_block = "\n".join(volatile_parts)
+        setattr(event, "_spectre_volatile", volatile_block)
+        try:
+            event.set_extra("spectre_volatile", volatile_block)
+        except Exception:
+            pass
 
         func_tools_mgr = context.get_llm_tool_manager() if config.get("use_func_tool", False) else None
 
@@ -0,0 +1,128 @@
+from __future__ import annotations
+
+import sys
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable
+
+
+def _default_sizeof(key: Hashable, value: Any) -> int:
+    size = len(key.encode("utf-8")) if isinstance(key, str) else sys.getsizeof(key)
+    if isinstance(value, str):
+        size += len(value.encode("utf-8"))
+    else:
+        size += sys.getsizeof(value)
+    return size
+
+
+class LRUCache:
+    """
+    有界 LRU 缓存
+
+    同时限制条目数与字节数（任一为 0 表示不限），可选 TTL；
+    记录命中/未命中/淘汰/过期次数，供运行状态查看。
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 0,
+        max_bytes: int = 0,
+        ttl: float = 0.0,
+        sizeof: Callable[[Hashable, Any], int] | None = None,
+    ):
+        self.max_entries = max(0, int(max_entries))
+        self.max_bytes = max(0, int(max_bytes))
+        self.ttl = max(0.0, float(ttl))
+        self._sizeof = sizeof or _default_sizeof
+        # key -> (value, size, stored_at)
+        self._data: "OrderedDict[Hashable, tuple[Any, int, float]]" = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def configure(self, max_entries: int = 0, max_bytes: int = 0, ttl: float = 0.0) -> None:
+        self.max_entries = max(0, int(max_entries))
+        self.max_bytes = max(0, int(max_bytes))
+        self.ttl = max(0.0, float(ttl))
+        self._evict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key, _MISSING, count=False) is not _MISSING
+
+    def _expired(self, stored_at: float, now: float) -> bool:
+        return self.ttl > 0 and now - stored_at > self.ttl
+
+    def get(self, key: Hashable, default: Any = None, count: bool = True) -> Any:
+        item = self._data.get(key)
+        if item is None:
+            if count:
+                self.misses += 1
+            return default
+        value, size, stored_at = item
+        if self._expired(stored_at, time.monotonic()):
+            self._remove(key)
+            self.expirations += 1
+            if count:
+                self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        if count:
+            self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        if key in self._data:
+            self._remove(key)
+        size = self._sizeof(key, value)
+        if self.max_bytes and size > self.max_bytes:
+            return
+        self._data[key] = (value, size, time.monotonic())
+        self._bytes += size
+        self._evict()
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        item = self._data.get(key)
+        if item is None:
+            return default
+        self._remove(key)
+        return item[0]
+
+    def clear(self) -> None:
+        self._data.clear()
+        self._bytes = 0
+
+    def reset_stats(self) -> None:
+        self.hits = self.misses = self.evictions = self.expirations = 0
+
+    def _remove(self, key: Hashable) -> None:
+        _value, size, _stored_at = self._data.pop(key)
+        self._bytes -= size
+
+    def _evict(self) -> None:
+        while self._data and (
+            (self.max_entries and len(self._data) > self.max_entries)
+            or (self.max_bytes and self._bytes > self.max_bytes)
+        ):
+            key = next(iter(self._data))
+            self._remove(key)
+            self.evictions += 1
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._data),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits / total) if total else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+_MISSING = object()
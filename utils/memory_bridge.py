@@ -0,0 +1,136 @@
+from __future__ import annotations
+
+import asyncio
+import inspect
+from typing import Any, Dict
+
+from astrbot.api.all import *
+
+from .lru_cache import LRUCache
+
+
+class MemoryBridge:
+    """
+    Mnemosyne 长期记忆插件桥接
+
+    插件实例只在插件列表变化（加载/卸载）、原实例被停用或被重载替换时重新查找；
+    get_memory_data 在线程中调用（若为协程函数则直接 await），避免阻塞事件循环。
+    可选按会话(UMO)缓存记忆块，热点会话的连续请求无需重复获取。
+    """
+
+    PLUGIN_NAMES = ("Mnemosyne", "astrbot_plugin_mnemosyne")
+
+    _star_meta = None
+    _plugin = None
+    _star_count = -1
+    _memo = LRUCache(max_entries=64, ttl=30)
+    _memo_enabled = False
+    _lookups = 0
+
+    @staticmethod
+    def init(config: dict) -> None:
+        try:
+            ttl = float(config.get("memory_cache_ttl", 0))
+        except (TypeError, ValueError):
+            ttl = 0.0
+        try:
+            size = int(config.get("memory_cache_size", 64))
+        except (TypeError, ValueError):
+            size = 64
+        MemoryBridge._memo_enabled = ttl > 0
+        MemoryBridge._memo.configure(max_entries=max(1, size), ttl=max(0.0, ttl))
+        MemoryBridge._memo.clear()
+        MemoryBridge._memo.reset_stats()
+        MemoryBridge.reset_handle()
+
+    @staticmethod
+    def reset_handle() -> None:
+        MemoryBridge._star_meta = None
+        MemoryBridge._plugin = None
+        MemoryBridge._star_count = -1
+
+    @staticmethod
+    def invalidate(umo: str | None = None) -> None:
+        if umo is None:
+            MemoryBridge._memo.clear()
+        else:
+            MemoryBridge._memo.pop(umo)
+
+    @staticmethod
+    def _plugin_from_meta(star_meta) -> Any:
+        # AstrBot 的 StarMetadata 使用 star_cls 保存实例
+        if getattr(star_meta, "star_cls", None):
+            return star_meta.star_cls
+        for attr in ("plugin", "star", "plugin_instance"):
+            if hasattr(star_meta, attr):
+                return getattr(star_meta, attr)
+        return None
+
+    @staticmethod
+    def get_plugin(context: Context) -> Any:
+        """返回 Mnemosyne 插件实例，未安装或已停用时返回 None。"""
+        try:
+            all_stars = context.get_all_stars()
+        except Exception:
+            return None
+        meta = MemoryBridge._star_meta
+        stale = (
+            len(all_stars) != MemoryBridge._star_count
+            or (meta is not None and getattr(meta, "activated", True) is False)
+            # 重载插件时插件数量与启用状态不变，但实例（或整个元数据对象）会被替换
+            or (meta is not None and MemoryBridge._plugin_from_meta(meta) is not MemoryBridge._plugin)
+            or (meta is not None and not any(star_meta is meta for star_meta in all_stars))
+        )
+        if not stale:
+            return MemoryBridge._plugin
+
+        MemoryBridge._lookups += 1
+        MemoryBridge.reset_handle()
+        MemoryBridge._star_count = len(all_stars)
+        for star_meta in all_stars:
+            if star_meta.name not in MemoryBridge.PLUGIN_NAMES:
+                continue
+            if getattr(star_meta, "activated", True) is False:
+                continue
+            plugin = MemoryBridge._plugin_from_meta(star_meta)
+            if plugin:
+                MemoryBridge._star_meta = star_meta
+                MemoryBridge._plugin = plugin
+                break
+        return MemoryBridge._plugin
+
+    @staticmethod
+    async def fetch(context: Context, umo: str) -> str:
+        """获取会话的记忆块，插件不可用或获取失败时返回空字符串。"""
+        if MemoryBridge._memo_enabled:
+            cached = MemoryBridge._memo.get(umo)
+            if cached is not None:
+                return cached
+
+        plugin = MemoryBridge.get_plugin(context)
+        getter = getattr(plugin, "get_memory_data", None) if plugin else None
+        if getter is None:
+            return ""
+        try:
+            if inspect.iscoroutinefunction(getter):
+                mem_data = await getter(umo)
+            else:
+                mem_data = await asyncio.to_thread(getter, umo)
+                if inspect.isawaitable(mem_data):
+                    mem_data = await mem_data
+        except Exception as e:
+            logger.warning(f"[SpectreCore] 获取 Mnemosyne 记忆失败: {e}")
+            return ""
+        mem_data = str(mem_data) if mem_data else ""
+        # 空结果不缓存，记忆可能稍后才由 Mnemosyne 写入
+        if mem_data and MemoryBridge._memo_enabled:
+            MemoryBridge._memo.set(umo, mem_data)
+        return mem_data
+
+    @staticmethod
+    def stats() -> Dict[str, Any]:
+        data = MemoryBridge._memo.stats()
+        data["enabled"] = MemoryBridge._memo_enabled
+        data["plugin"] = MemoryBridge._plugin is not None
+        data["lookups"] = MemoryBridge._lookups
+        return data
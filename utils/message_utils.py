@@ -1,14 +1,31 @@
 from astrbot.api.all import *
-from typing import List, Dict
+from typing import Any, List, Dict
 import os
+import itertools
+import re
+from collections import OrderedDict
 from datetime import datetime
+from .caption_scheduler import CaptionScheduler
 from .image_caption import ImageCaptionUtils
 from .image_ref import build_image_aliases, extract_image_src, normalize_image_ref
+from .lru_cache import LRUCache
+from .token_estimator import TokenEstimator
 
 class MessageUtils:
     """
     消息处理工具类
     """
+
+    # 渲染缓存：会话 -> OrderedDict(消息键 -> 渲染块)
+    _render_cache = LRUCache(max_entries=64)
+    RENDER_CACHE_PER_CHAT = 256
+    OUTLINE_VERSION = 1
+    # 图片占位符 \x00局部序号[@图片标识]\x00
+    _SLOT_RE = re.compile(r"\x00(\d+)(?:@([0-9a-f]+))?\x00")
+    _SLOT_FRAGMENT_RE = re.compile(r"\x00\d*(?:@[0-9a-f]*)?")
+    IMAGE_ID_LENGTH = 6
+    # 引用段标记：\x02目标消息ID\x03内联文本\x04，拼接时按窗口解析为回指或内联
+    _REPLY_REF_RE = re.compile(r"\x02([^\x03]*)\x03([^\x04]*)\x04")
         
     @staticmethod
     def _get_image_src(component: Image) -> str | None:
@@ -23,42 +40,295 @@ class MessageUtils:
         is_private: bool = False,
         chat_id: str = "",
         uploaded_images: set[str] | None = None,
+        token_budget: int = 0,
+        bot_self_id: str = "",
+        report: Dict[str, int] | None = None,
+        compact: bool = False,
+        image_ids: bool = False,
     ) -> str:
+        """
+        渲染历史消息窗口
+
+        每条消息的渲染结果按会话缓存，图片序号以占位符保存，拼接时再按窗口内位置
+        填入（从旧到新倒数）。仅新消息、转述/上传状态变化的消息需要重新渲染。
+        token_budget > 0 时按预算装箱：机器人发言与被引用的消息优先，其余从新到旧连续填充，
+        保留条目之间的断档以 "（省略 N 条）" 标出。
+        report 若提供，写入窗口条数、保留条数与估算 token 数。
+        compact 为 True 时使用紧凑格式（见 _join_compact），report 额外写入相对标准格式节省的 token 数。
+        image_ids 为 True 时图片以固定标识代替序号（[图片@标识: 转述]，见 image_tag_id），
+        结果不随后续新图片变化。
+        """
         if not history_messages:
             return ""
         
         if len(history_messages) > max_messages:
             history_messages = history_messages[-max_messages:]
         
-        formatted_text = ""
         divider = "\n" + "-" + "\n"
-        
-        total_images = 0
+        uploaded_images = uploaded_images or set()
+        chat_cache = MessageUtils._chat_render_cache(platform_name, is_private, chat_id)
+        blocks = []
         for msg in history_messages:
-            if hasattr(msg, "message") and msg.message:
-                total_images += MessageUtils._count_images_in_message_list(msg.message)
-        if total_images > 0:
-            counter = {"i": total_images + 1, "step": -1}
-        else:
-            counter = {"i": 0, "step": 1}
-        for idx, msg in enumerate(history_messages):
-            sender_name = "未知用户"
-            sender_id = "unknown"
-            if hasattr(msg, "sender") and msg.sender:
-                sender_name = msg.sender.nickname or "未知用户"
-                sender_id = msg.sender.user_id or "unknown"
-            
-            # 【修改点】如果旧历史记录中名字是 AstrBot，强制显示为 Rosa
-            if sender_name == "AstrBot":
-                sender_name = "Rosa"
-            
-            send_time = "未知时间"
-            if hasattr(msg, "timestamp") and msg.timestamp:
+            blocks.append(
+                await MessageUtils._render_block(
+                    msg,
+                    chat_cache,
+                    image_caption=image_caption,
+                    platform_name=platform_name,
+                    is_private=is_private,
+                    chat_id=chat_id,
+                    uploaded_images=uploaded_images,
+                )
+            )
+
+        gaps: Dict[int, int] = {}
+        if token_budget > 0 and len(blocks) > 1:
+            quoted: set[str] = set()
+            for msg in history_messages:
+                quoted.update(MessageUtils.reply_target_ids(msg))
+            priorities = []
+            for msg in history_messages:
+                sender = getattr(msg, "sender", None)
+                sender_id = str(getattr(sender, "user_id", "")) if sender else ""
+                message_id = str(getattr(msg, "message_id", "") or "")
+                high = (bot_self_id and sender_id == str(bot_self_id)) or (message_id and message_id in quoted)
+                priorities.append(TokenEstimator.PRIORITY_HIGH if high else TokenEstimator.PRIORITY_NORMAL)
+            if compact:
+                # 紧凑格式每行仅多出别名与冒号
+                costs = [block["content_tokens"] + 2 for block in blocks]
+            else:
+                divider_cost = TokenEstimator.estimate(divider)
+                costs = [block["tokens"] + divider_cost for block in blocks]
+            kept = TokenEstimator.pack(costs, priorities, token_budget)
+            # 保留的条目之间被省略的消息数，渲染为 "（省略 N 条）" 提示断档
+            for pos in range(1, len(kept)):
+                if kept[pos] - kept[pos - 1] > 1:
+                    gaps[pos] = kept[pos] - kept[pos - 1] - 1
+            blocks = [blocks[i] for i in kept]
+        if report is not None:
+            report["messages"] = len(history_messages)
+            report["kept"] = len(blocks)
+            report["tokens"] = sum(block["tokens"] for block in blocks)
+
+        # 引用目标在窗口内（且早于引用方）时改为回指 ↪#n，只有被回指的消息带 #n 标签
+        positions = {block["message_id"]: pos for pos, block in enumerate(blocks) if block.get("message_id")}
+        labels: Dict[int, int] = {}
+        raw_contents = []
+        for pos, block in enumerate(blocks):
+            content = block["content"]
+            if "\x02" in content:
+                def resolve(m, pos=pos):
+                    target = positions.get(m.group(1))
+                    if target is None or target >= pos:
+                        return m.group(2)
+                    labels[target] = target + 1
+                    return f"「↪#{target + 1}」"
+                content = MessageUtils._REPLY_REF_RE.sub(resolve, content)
+            raw_contents.append(content)
+
+        slot_counts = []
+        for block, content in zip(blocks, raw_contents):
+            if content is block["content"]:
+                slot_counts.append(block["slots"])
+            else:
+                slot_counts.append(len(MessageUtils._SLOT_RE.findall(content)))
+        total_images = sum(slot_counts)
+        seen = 0
+        contents = []
+        for block, content, slots in zip(blocks, raw_contents, slot_counts):
+            if slots and image_ids:
+                content = MessageUtils._SLOT_RE.sub(
+                    lambda m: f"@{m.group(2)}" if m.group(2) else "", content
+                )
+            elif slots:
+                base = total_images - seen + 1
+                if content is block["content"]:
+                    content = MessageUtils._SLOT_RE.sub(
+                        lambda m: str(base - int(m.group(1))), content
+                    )
+                else:
+                    # 回指去掉了引用内的图片，剩余占位符按出现顺序重新编号
+                    order = itertools.count(1)
+                    content = MessageUtils._SLOT_RE.sub(
+                        lambda m: str(base - next(order)), content
+                    )
+                seen += slots
+            # 引用内容截断可能切断占位符，清理残片
+            contents.append(MessageUtils._SLOT_FRAGMENT_RE.sub("", content))
+
+        if not compact:
+            return divider.join(
+                (MessageUtils._omission_note(gaps[pos]) + divider if pos in gaps else "")
+                + (f"#{labels[pos]} " if pos in labels else "")
+                + block["header"]
+                + content
+                for pos, (block, content) in enumerate(zip(blocks, contents))
+            )
+
+        text = MessageUtils._join_compact(blocks, contents, labels, gaps)
+        if report is not None:
+            standard = sum(block["tokens"] for block in blocks) + TokenEstimator.estimate(divider) * (len(blocks) - 1)
+            report["tokens"] = TokenEstimator.estimate(text)
+            report["saved"] = max(0, standard - report["tokens"])
+        return text
+
+    @staticmethod
+    def _omission_note(count: int) -> str:
+        return f"（省略 {count} 条）"
+
+    @staticmethod
+    def _join_compact(
+        blocks: List[Dict[str, Any]],
+        contents: List[str],
+        labels: Dict[int, int] | None = None,
+        gaps: Dict[int, int] | None = None,
+    ) -> str:
+        """
+        紧凑格式：首行为成员别名表（ID 只出现一次），之后每条消息一行 "别名: 内容"；
+        时间精确到分钟，仅在变化时于行首标出 [HH:MM]（跨天时带日期）；
+        连续内容相同的刷屏合并为一行并标注次数。gaps 中的位置前插入省略提示行。
+        """
+        aliases: Dict[str, str] = {}
+        used_names: Dict[str, int] = {}
+        table = []
+        for block in blocks:
+            sender_id = str(block.get("sender_id", "unknown"))
+            if sender_id in aliases:
+                continue
+            name = str(block.get("sender_name") or "未知用户").replace(":", "：")
+            count = used_names.get(name, 0) + 1
+            used_names[name] = count
+            alias = name if count == 1 else f"{name}#{count}"
+            aliases[sender_id] = alias
+            table.append(f"{alias}({sender_id})")
+
+        # 合并连续相同内容
+        labels = labels or {}
+        gaps = gaps or {}
+        runs: List[list] = []
+        for pos, (block, content) in enumerate(zip(blocks, contents)):
+            if pos in gaps:
+                # 省略提示单独成行，且不与前后的刷屏合并
+                runs.append([None, MessageUtils._omission_note(gaps[pos]), 0, [], True])
+            line = content.replace("\r", "").replace("\n", " ↵ ").strip()
+            alias = aliases[str(block.get("sender_id", "unknown"))]
+            if pos in labels:
+                # 被回指的消息单独成行，保证 #n 可定位
+                runs.append([block, line, 1, [f"#{labels[pos]} {alias}"], True])
+                continue
+            if runs and line and runs[-1][1] == line and not runs[-1][4]:
+                runs[-1][2] += 1
+                if alias not in runs[-1][3]:
+                    runs[-1][3].append(alias)
+                continue
+            runs.append([block, line, 1, [alias], False])
+
+        lines = ["成员: " + ", ".join(table)]
+        last_minute = None
+        last_day = None
+        for block, line, count, senders, _labelled in runs:
+            if block is None:
+                lines.append(line)
+                continue
+            prefix = ""
+            ts = block.get("timestamp")
+            if ts:
                 try:
-                    time_obj = datetime.fromtimestamp(msg.timestamp)
-                    send_time = time_obj.strftime("%Y-%m-%d %H:%M:%S")
-                except: pass
-            
+                    time_obj = datetime.fromtimestamp(ts)
+                except Exception:
+                    time_obj = None
+                if time_obj is not None:
+                    minute = time_obj.strftime("%Y-%m-%d %H:%M")
+                    if minute != last_minute:
+                        day = time_obj.strftime("%Y-%m-%d")
+                        stamp = time_obj.strftime("%H:%M") if day == last_day else time_obj.strftime("%m-%d %H:%M")
+                        prefix = f"[{stamp}] "
+                        last_minute = minute
+                        last_day = day
+            suffix = f" (×{count})" if count > 1 else ""
+            lines.append(f"{prefix}{'/'.join(senders)}: {line}{suffix}")
+        return "\n".join(lines)
+
+    @staticmethod
+    def _chat_render_cache(platform_name: str, is_private: bool, chat_id: str) -> "OrderedDict[str, Dict[str, Any]]":
+        chat_key = f"{platform_name}_{'private' if is_private else 'group'}_{chat_id}"
+        chat_cache = MessageUtils._render_cache.get(chat_key, count=False)
+        if chat_cache is None:
+            chat_cache = OrderedDict()
+            MessageUtils._render_cache.set(chat_key, chat_cache)
+        return chat_cache
+
+    @staticmethod
+    def _message_cache_key(msg: AstrBotMessage) -> str | None:
+        message_id = getattr(msg, "message_id", None)
+        if message_id:
+            return f"id:{message_id}"
+        timestamp = getattr(msg, "timestamp", None)
+        if timestamp is None:
+            return None
+        sender = getattr(msg, "sender", None)
+        return f"ts:{timestamp}:{getattr(sender, 'user_id', '')}"
+
+    @staticmethod
+    def _block_valid(entry: Dict[str, Any], image_caption: bool, uploaded_images: set[str]) -> bool:
+        if entry["image_caption"] != image_caption:
+            return False
+        uploaded = tuple(bool(aliases & uploaded_images) for aliases in entry["aliases"])
+        if uploaded != entry["uploaded"]:
+            return False
+        # 含未转述图片的消息在任何转述完成后重新渲染
+        if entry["incomplete"] and entry["generation"] != ImageCaptionUtils.caption_generation:
+            return False
+        return True
+
+    @staticmethod
+    async def _render_block(
+        msg: AstrBotMessage,
+        chat_cache: "OrderedDict[str, Dict[str, Any]]",
+        image_caption: bool,
+        platform_name: str,
+        is_private: bool,
+        chat_id: str,
+        uploaded_images: set[str],
+    ) -> Dict[str, Any]:
+        key = MessageUtils._message_cache_key(msg)
+        entry = chat_cache.get(key) if key else None
+        if entry is not None and MessageUtils._block_valid(entry, image_caption, uploaded_images):
+            chat_cache.move_to_end(key)
+            return entry
+
+        sender_name = "未知用户"
+        sender_id = "unknown"
+        if hasattr(msg, "sender") and msg.sender:
+            sender_name = msg.sender.nickname or "未知用户"
+            sender_id = msg.sender.user_id or "unknown"
+        
+        # 【修改点】如果旧历史记录中名字是 AstrBot，强制显示为 Rosa
+        if sender_name == "AstrBot":
+            sender_name = "Rosa"
+        
+        send_time = "未知时间"
+        if hasattr(msg, "timestamp") and msg.timestamp:
+            try:
+                time_obj = datetime.fromtimestamp(msg.timestamp)
+                send_time = time_obj.strftime("%Y-%m-%d %H:%M:%S")
+            except: pass
+
+        generation = ImageCaptionUtils.caption_generation
+        counter = {"i": 0, "step": 1, "slot": True, "aliases": [], "incomplete": False}
+        record = MessageUtils.get_outline_record(msg)
+        if record is not None:
+            message_content = MessageUtils.render_outline_parts(
+                record["parts"],
+                counter=counter,
+                image_caption=image_caption,
+                platform_name=platform_name,
+                is_private=is_private,
+                chat_id=chat_id,
+                uploaded_images=uploaded_images,
+                reply_refs=True,
+            )
+        else:
             message_content = await MessageUtils.outline_message_list(
                 msg.message,
                 counter=counter,
@@ -67,18 +337,31 @@ class MessageUtils:
                 is_private=is_private,
                 chat_id=chat_id,
                 uploaded_images=uploaded_images,
+                reply_refs=True,
             ) if hasattr(msg, "message") and msg.message else ""
-            
-            message_text = f"发送者: {sender_name} (ID: {sender_id})\n"
-            message_text += f"时间: {send_time}\n"
-            message_text += f"内容: {message_content}"
-            
-            formatted_text += message_text
-            
-            if idx < len(history_messages) - 1:
-                formatted_text += divider
-        
-        return formatted_text
+
+        entry = {
+            "header": f"发送者: {sender_name} (ID: {sender_id})\n时间: {send_time}\n内容: ",
+            "content": message_content,
+            "slots": counter["i"],
+            "aliases": counter["aliases"],
+            "uploaded": tuple(bool(a & uploaded_images) for a in counter["aliases"]),
+            "incomplete": counter["incomplete"],
+            "generation": generation,
+            "image_caption": image_caption,
+            "sender_name": sender_name,
+            "sender_id": sender_id,
+            "timestamp": getattr(msg, "timestamp", None),
+            "message_id": str(getattr(msg, "message_id", "") or ""),
+        }
+        entry["content_tokens"] = TokenEstimator.estimate(message_content)
+        entry["tokens"] = TokenEstimator.estimate(entry["header"]) + entry["content_tokens"]
+        if key:
+            chat_cache[key] = entry
+            chat_cache.move_to_end(key)
+            while len(chat_cache) > MessageUtils.RENDER_CACHE_PER_CHAT:
+                chat_cache.popitem(last=False)
+        return entry
            
     @staticmethod
     async def outline_message_list(
@@ -89,11 +372,50 @@ class MessageUtils:
         is_private: bool = False,
         chat_id: str = "",
         uploaded_images: set[str] | None = None,
+        reply_refs: bool = False,
     ) -> str:
-        outline = ""
-        idx_ref = counter or {"i": 0}
-        step = idx_ref.get("step", 1)
-        uploaded_images = uploaded_images or set()
+        return MessageUtils.render_outline_parts(
+            MessageUtils.build_outline_parts(message_list),
+            counter=counter,
+            image_caption=image_caption,
+            platform_name=platform_name,
+            is_private=is_private,
+            chat_id=chat_id,
+            uploaded_images=uploaded_images,
+            reply_refs=reply_refs,
+        )
+
+    @staticmethod
+    def build_outline_record(message_list: List[BaseMessageComponent]) -> Dict[str, Any]:
+        """
+        入库时生成的规范化大纲，随消息一起持久化
+
+        {"v": 版本, "parts": [...], "images": [图片引用], "mentions": [被@的ID]}
+        parts 元素为文本字符串、{"img": 引用, "caption": 转述(回填)} 或
+        {"reply": {"sender": 发送者, "id": 被引用消息ID, "parts": [...] | "text": 文本}}。
+        """
+        meta: Dict[str, list] = {"images": [], "mentions": []}
+        parts = MessageUtils.build_outline_parts(message_list, meta)
+        return {
+            "v": MessageUtils.OUTLINE_VERSION,
+            "parts": parts,
+            "images": meta["images"],
+            "mentions": meta["mentions"],
+        }
+
+    @staticmethod
+    def get_outline_record(msg: AstrBotMessage) -> Dict[str, Any] | None:
+        record = getattr(msg, "spectre_outline", None)
+        if isinstance(record, dict) and record.get("v") == MessageUtils.OUTLINE_VERSION:
+            return record
+        return None
+
+    @staticmethod
+    def build_outline_parts(
+        message_list: List[BaseMessageComponent],
+        meta: Dict[str, list] | None = None,
+    ) -> list:
+        parts: list = []
         for i in message_list:
             try:
                 component_type = getattr(i, 'type', None)
@@ -101,126 +423,222 @@ class MessageUtils:
                     component_type = i.__class__.__name__.lower()
                 
                 if component_type == "reply" or isinstance(i, Reply):
-                    outline += await MessageUtils._format_reply_component(
-                        i,
-                        uploaded_images=uploaded_images,
-                        counter=idx_ref,
-                        image_caption=image_caption,
-                        platform_name=platform_name,
-                        is_private=is_private,
-                        chat_id=chat_id,
-                    )
-                    continue
+                    parts.append(MessageUtils._build_reply_part(i, meta))
                 elif component_type == "plain" or isinstance(i, Plain):
-                    outline += i.text
+                    parts.append(i.text if isinstance(i.text, str) else "[未知消息]")
                 elif component_type == "image" or isinstance(i, Image):
                     try:
                         image = MessageUtils._get_image_src(i)
-                        idx_ref["i"] += step
-                        tag = f"[图片{idx_ref['i']}"
-                        if image:
-                            raw_image = image
-                            is_uploaded = False
-                            if uploaded_images:
-                                aliases = build_image_aliases(str(raw_image))
-                                is_uploaded = any(alias in uploaded_images for alias in aliases)
-                            if is_uploaded:
-                                outline += f"{tag} 已上传]"
-                                continue
-                            if image_caption:
-                                if isinstance(image, str) and image.startswith("file:///"):
-                                    image_path = normalize_image_ref(image)
-                                    if not os.path.exists(image_path):
-                                        outline += f"{tag}: 文件过期]"
-                                        continue
-                                    image = image_path
-                                # 优先命中缓存，未命中则调度后台转述
-                                caption = ImageCaptionUtils.get_cached_caption(
-                                    image, platform_name, is_private, chat_id
-                                ) or ImageCaptionUtils.get_memory_caption(image)
-                                if caption:
-                                    outline += f"{tag}: {caption}]"
-                                else:
-                                    outline += f"{tag}]"
-                                    ImageCaptionUtils.schedule_caption(
-                                        image, platform_name, is_private, chat_id
-                                    )
-                            else:
-                                outline += f"{tag}]"
-                        else:
-                            outline += f"{tag}]"
                     except Exception:
-                        outline += "[图片]"
+                        image = None
+                    parts.append({"img": str(image) if image else None})
+                    if image and meta is not None:
+                        meta["images"].append(str(image))
                 elif component_type == "face" or isinstance(i, Face):
-                    outline += f"[表情:{getattr(i, 'id', '')}]"
+                    parts.append(f"[表情:{getattr(i, 'id', '')}]")
                 elif component_type == "at" or isinstance(i, At):
                     qq = getattr(i, 'qq', '')
                     name = getattr(i, 'name', '')
-                    if str(qq).lower() == "all": outline += "@全体成员"
-                    elif name: outline += f"@{name}({qq})"
-                    else: outline += f"@{qq}"
+                    if meta is not None:
+                        meta["mentions"].append(str(qq))
+                    if str(qq).lower() == "all": parts.append("@全体成员")
+                    elif name: parts.append(f"@{name}({qq})")
+                    else: parts.append(f"@{qq}")
                 else:
-                    outline += f"[{component_type}]"
+                    parts.append(f"[{component_type}]")
                     
             except Exception:
-                outline += f"[未知消息]"
+                parts.append("[未知消息]")
                 continue
-        return outline
+        return parts
 
     @staticmethod
-    async def _format_reply_component(
-        reply_component: Reply,
-        uploaded_images: set[str] | None = None,
-        counter: Dict[str, int] | None = None,
-        image_caption: bool = True,
-        platform_name: str = "",
-        is_private: bool = False,
-        chat_id: str = "",
-    ) -> str:
+    def reply_target_ids(msg: AstrBotMessage) -> List[str]:
+        """消息中引用（回复）的目标消息 ID。"""
+        ids = []
+        record = MessageUtils.get_outline_record(msg)
+        if record is not None:
+            for part in record["parts"]:
+                if isinstance(part, dict) and "reply" in part and part["reply"].get("id"):
+                    ids.append(str(part["reply"]["id"]))
+            if ids:
+                return ids
+        for comp in getattr(msg, "message", None) or []:
+            if isinstance(comp, Reply) or getattr(comp, "type", None) == "reply":
+                reply_id = getattr(comp, "id", None)
+                if reply_id:
+                    ids.append(str(reply_id))
+        return ids
+
+    @staticmethod
+    def _build_reply_part(reply_component: Reply, meta: Dict[str, list] | None = None):
         try:
             sender_id = getattr(reply_component, 'sender_id', '')
             sender_nickname = getattr(reply_component, 'sender_nickname', '')
+            reply_id = str(getattr(reply_component, 'id', '') or '')
             
             sender_info = f"{sender_nickname}({sender_id})" if sender_nickname else f"{sender_id}" or "未知用户"
             
-            reply_content = ""
             if hasattr(reply_component, 'chain') and reply_component.chain:
-                reply_content = await MessageUtils.outline_message_list(
-                    reply_component.chain,
-                    counter=counter,
-                    image_caption=image_caption,
-                    platform_name=platform_name,
-                    is_private=is_private,
-                    chat_id=chat_id,
-                    uploaded_images=uploaded_images,
-                )
+                return {"reply": {"sender": sender_info, "id": reply_id, "parts": MessageUtils.build_outline_parts(reply_component.chain, meta)}}
             elif hasattr(reply_component, 'message_str') and reply_component.message_str:
                 reply_content = reply_component.message_str
             elif hasattr(reply_component, 'text') and reply_component.text:
                 reply_content = reply_component.text
             else:
                 reply_content = "[内容不可用]"
-            
-            if len(reply_content) > 150: reply_content = reply_content[:150] + "..."
-            return f"「↪ 引用消息 {sender_info}：{reply_content}」"
+            return {"reply": {"sender": sender_info, "id": reply_id, "text": str(reply_content)}}
         except Exception:
             return "[回复消息]"
 
     @staticmethod
-    def _count_images_in_message_list(
-        message_list: List[BaseMessageComponent],
-    ) -> int:
-        total = 0
-        for comp in message_list:
-            try:
-                component_type = getattr(comp, "type", None)
-                if component_type == "image" or isinstance(comp, Image):
-                    total += 1
-                    continue
-                if component_type == "reply" or isinstance(comp, Reply):
-                    chain = getattr(comp, "chain", None)
-                    if chain:
-                        total += MessageUtils._count_images_in_message_list(chain)
-            except Exception:
+    def render_outline_parts(
+        parts: list,
+        counter: Dict[str, int] | None = None,
+        image_caption: bool = True,
+        platform_name: str = "",
+        is_private: bool = False,
+        chat_id: str = "",
+        uploaded_images: set[str] | None = None,
+        reply_refs: bool = False,
+    ) -> str:
+        """
+        渲染大纲片段。reply_refs 为 True 时引用段带上目标消息 ID 标记，
+        由 format_history_for_llm 按窗口决定渲染为回指（↪#n）还是内联引用文本。
+        """
+        outline = []
+        idx_ref = counter or {"i": 0}
+        uploaded_images = uploaded_images or set()
+        for part in parts:
+            if isinstance(part, str):
+                outline.append(part)
+            elif "img" in part:
+                outline.append(
+                    MessageUtils._render_image_part(
+                        part, idx_ref, image_caption, platform_name, is_private, chat_id, uploaded_images
+                    )
+                )
+            elif "reply" in part:
+                reply = part["reply"]
+                try:
+                    if reply.get("parts") is not None:
+                        reply_content = MessageUtils.render_outline_parts(
+                            reply["parts"],
+                            counter=idx_ref,
+                            image_caption=image_caption,
+                            platform_name=platform_name,
+                            is_private=is_private,
+                            chat_id=chat_id,
+                            uploaded_images=uploaded_images,
+                        )
+                    else:
+                        reply_content = reply.get("text", "")
+                    # 嵌套引用一律内联
+                    reply_content = MessageUtils._REPLY_REF_RE.sub(lambda m: m.group(2), reply_content)
+                    if len(reply_content) > 150: reply_content = reply_content[:150] + "..."
+                    inline = f"「↪ 引用消息 {reply.get('sender', '')}：{reply_content}」"
+                    if reply_refs and reply.get("id"):
+                        inline = f"\x02{reply['id']}\x03{inline}\x04"
+                    outline.append(inline)
+                except Exception:
+                    outline.append("[回复消息]")
+            else:
+                outline.append("[未知消息]")
+        return "".join(outline)
+
+    @staticmethod
+    def image_tag_id(image: str) -> str:
+        """图片的固定短标识（规范化引用哈希前缀），供稳定段历史与 [ImageRefs] 对应。"""
+        return ImageCaptionUtils._hash_image(str(image))[: MessageUtils.IMAGE_ID_LENGTH]
+
+    @staticmethod
+    def _render_image_part(
+        part: Dict[str, Any],
+        idx_ref: Dict[str, Any],
+        image_caption: bool,
+        platform_name: str,
+        is_private: bool,
+        chat_id: str,
+        uploaded_images: set[str],
+    ) -> str:
+        try:
+            image = part.get("img")
+            idx_ref["i"] += idx_ref.get("step", 1)
+            # 占位模式：图片序号写为 \x00局部序号\x00，由 format_history_for_llm 拼接时填入
+            slot_mode = bool(idx_ref.get("slot"))
+            if slot_mode:
+                tag_id = f"@{MessageUtils.image_tag_id(image)}" if image else ""
+                tag = f"[图片\x00{idx_ref['i']}{tag_id}\x00"
+            else:
+                tag = f"[图片{idx_ref['i']}"
+            if not image:
+                return f"{tag}]"
+            is_uploaded = False
+            if slot_mode:
+                aliases = frozenset(build_image_aliases(str(image)))
+                idx_ref["aliases"].append(aliases)
+                is_uploaded = bool(aliases & uploaded_images)
+            elif uploaded_images:
+                aliases = build_image_aliases(str(image))
+                is_uploaded = any(alias in uploaded_images for alias in aliases)
+            if is_uploaded:
+                return f"{tag} 已上传]"
+            if not image_caption:
+                return f"{tag}]"
+            # 优先使用入库大纲中回填的转述；当前消息、尚未回填或超出回填范围的消息
+            # 再查内存缓存与会话缓存（均为内存读取），均未命中则调度后台转述
+            caption = part.get("caption")
+            if caption:
+                return f"{tag}: {caption}]"
+            if image.startswith("file:///"):
+                image_path = normalize_image_ref(image)
+                if not os.path.exists(image_path):
+                    return f"{tag}: 文件过期]"
+                image = image_path
+            caption = ImageCaptionUtils.get_memory_caption(
+                image
+            ) or ImageCaptionUtils.get_cached_caption(
+                image, platform_name, is_private, chat_id
+            )
+            if caption:
+                return f"{tag}: {caption}]"
+            idx_ref["incomplete"] = True
+            if ImageCaptionUtils.is_caption_pending(image):
+                return f"{tag}: 转述中]"
+            # 正在渲染进提示词窗口的图片优先转述
+            ImageCaptionUtils.schedule_caption(
+                image,
+                platform_name,
+                is_private,
+                chat_id,
+                priority=CaptionScheduler.PRIORITY_HIGH,
+            )
+            return f"{tag}]"
+        except Exception:
+            return "[图片]"
+
+    @staticmethod
+    def backfill_outline_captions(parts: list, captions: Dict[str, str]) -> bool:
+        """
+        将已就绪的转述写回入库大纲中尚无转述的图片，返回是否有改动。
+
+        captions 以 ImageCaptionUtils._cache_key 规范化后的图片引用为键；
+        可能访问文件系统，应在线程中调用。
+        """
+        changed = False
+        for part in parts:
+            if not isinstance(part, dict):
+                continue
+            if "reply" in part:
+                sub = part["reply"].get("parts")
+                if sub and MessageUtils.backfill_outline_captions(sub, captions):
+                    changed = True
+                continue
+            image = part.get("img")
+            if not image or part.get("caption"):
                 continue
-        return total
+            caption = captions.get(ImageCaptionUtils._cache_key(image))
+            if caption:
+                part["caption"] = caption
+                changed = True
+        return changed
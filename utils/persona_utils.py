@@ -1,13 +1,111 @@
 from astrbot.api.all import *
 from astrbot.api import sp
 from astrbot.api.provider import Personality
-from typing import List, Optional
+from typing import Any, Dict, List, Optional, Tuple
+import time
+
+from .lru_cache import LRUCache
 
 class PersonaUtils:
     """
     人格信息工具类
     用于获取和管理AstrBot中的人格信息
     """
+
+    # 会话(UMO) -> {"persona": 人格, "prompt": 拼装好的人设提示词或 None}
+    _cache = LRUCache(max_entries=256, ttl=60)
+    _cache_enabled = True
+    _catalog_sig: Tuple[int, int] | None = None
+    _resolve_stats: Dict[str, float] = {"resolves": 0, "resolve_seconds": 0.0, "invalidations": 0}
+
+    @staticmethod
+    def init(config: dict) -> None:
+        try:
+            ttl = float(config.get("persona_cache_ttl", 60))
+        except (TypeError, ValueError):
+            ttl = 60.0
+        PersonaUtils._cache_enabled = ttl > 0
+        PersonaUtils._cache.configure(max_entries=256, ttl=max(0.0, ttl))
+        PersonaUtils._cache.clear()
+        PersonaUtils._cache.reset_stats()
+        PersonaUtils._catalog_sig = None
+        PersonaUtils._resolve_stats = {"resolves": 0, "resolve_seconds": 0.0, "invalidations": 0}
+
+    @staticmethod
+    def invalidate(umo: str | None = None) -> None:
+        """丢弃指定会话（umo 为空时为全部会话）的人格缓存，会话切换人格后调用。"""
+        if umo is None:
+            PersonaUtils._cache.clear()
+        else:
+            PersonaUtils._cache.pop(umo)
+        PersonaUtils._resolve_stats["invalidations"] += 1
+
+    @staticmethod
+    def _check_catalog(context: Context) -> None:
+        # 人格列表被重新加载或增删时整体失效
+        manager = getattr(context, "persona_manager", None)
+        personas = getattr(manager, "personas_v3", None) if manager else None
+        sig = (id(personas), len(personas) if personas is not None else -1)
+        if PersonaUtils._catalog_sig is not None and PersonaUtils._catalog_sig != sig:
+            PersonaUtils._cache.clear()
+        PersonaUtils._catalog_sig = sig
+
+    @staticmethod
+    async def _cached_entry(context: Context, umo: str) -> Dict[str, Any]:
+        if PersonaUtils._cache_enabled:
+            PersonaUtils._check_catalog(context)
+            entry = PersonaUtils._cache.get(umo)
+            if entry is not None:
+                return entry
+        started = time.perf_counter()
+        if hasattr(PersonaUtils, "resolve_persona_v3"):
+            persona = await PersonaUtils.resolve_persona_v3(context, umo)
+        else:
+            persona = await context.persona_manager.get_default_persona_v3(umo=umo)
+        PersonaUtils._resolve_stats["resolves"] += 1
+        PersonaUtils._resolve_stats["resolve_seconds"] += time.perf_counter() - started
+        entry = {"persona": persona, "prompt": None}
+        if PersonaUtils._cache_enabled:
+            PersonaUtils._cache.set(umo, entry)
+        return entry
+
+    @staticmethod
+    async def resolve_persona_cached(context: Context, umo: str) -> Optional[Personality]:
+        """带会话级缓存的 resolve_persona_v3。"""
+        return (await PersonaUtils._cached_entry(context, umo))["persona"]
+
+    @staticmethod
+    async def get_persona_prompt(context: Context, umo: str) -> Tuple[Optional[Personality], str]:
+        """返回 (人格, 人设系统提示词)，提示词（含情绪模仿示例）随人格一起缓存。"""
+        entry = await PersonaUtils._cached_entry(context, umo)
+        if entry["prompt"] is None:
+            entry["prompt"] = PersonaUtils.build_persona_prompt(entry["persona"])
+        return entry["persona"], entry["prompt"]
+
+    @staticmethod
+    def build_persona_prompt(persona: Optional[Personality]) -> str:
+        if not persona:
+            return ""
+        persona_prompt = persona.get("prompt", "") or ""
+        mood_dialogs = persona.get("_mood_imitation_dialogs_processed", "")
+        if mood_dialogs:
+            persona_prompt += (
+                "\n请模仿以下示例的对话风格来反应(示例中，a代表用户，b代表你)\n"
+                + str(mood_dialogs)
+            )
+        return persona_prompt
+
+    @staticmethod
+    def cache_stats() -> Dict[str, Any]:
+        data = PersonaUtils._cache.stats()
+        resolves = PersonaUtils._resolve_stats["resolves"]
+        avg = PersonaUtils._resolve_stats["resolve_seconds"] / resolves if resolves else 0.0
+        data["resolves"] = resolves
+        data["avg_resolve_ms"] = avg * 1000
+        # 以未命中时的平均解析耗时估算命中节省的时间
+        data["saved_ms"] = data["hits"] * avg * 1000
+        data["invalidations"] = PersonaUtils._resolve_stats["invalidations"]
+        return data
     
     @staticmethod
     def get_all_personas(context: Context) -> List[Personality]:
@@ -0,0 +1,65 @@
+from __future__ import annotations
+
+import hashlib
+from typing import Any, Dict, List
+
+from .lru_cache import LRUCache
+
+
+class PromptCacheTracker:
+    """
+    前缀复用统计
+
+    将每次请求的完整输入（系统提示词、预置对话、用户提示词）按 BLOCK_SIZE 字符切块，
+    逐块计算链式哈希作为前缀指纹，与同一会话上一次请求逐块比较，得到可被服务端
+    前缀缓存复用的比例。仅做本地估算，不依赖具体提供商。
+    """
+
+    BLOCK_SIZE = 128
+
+    _fingerprints = LRUCache(max_entries=256)
+    _stats: Dict[str, float] = {"requests": 0, "total_chars": 0, "reused_chars": 0}
+
+    @staticmethod
+    def reset() -> None:
+        PromptCacheTracker._fingerprints.clear()
+        PromptCacheTracker._stats = {"requests": 0, "total_chars": 0, "reused_chars": 0}
+
+    @staticmethod
+    def fingerprint(text: str) -> List[str]:
+        """逐块链式哈希：第 i 项唯一确定前 i+1 块的内容。"""
+        chain = []
+        digest = b""
+        size = PromptCacheTracker.BLOCK_SIZE
+        for start in range(0, len(text), size):
+            digest = hashlib.sha1(digest + text[start:start + size].encode("utf-8")).digest()
+            chain.append(digest.hex()[:16])
+        return chain
+
+    @staticmethod
+    def observe(chat_key: str, parts: List[str]) -> float:
+        """记录一次请求，返回其相对同会话上一次请求的前缀复用比例。"""
+        text = "\x1e".join(part or "" for part in parts)
+        chain = PromptCacheTracker.fingerprint(text)
+        previous = PromptCacheTracker._fingerprints.get(chat_key, count=False) or []
+        shared = 0
+        for current, old in zip(chain, previous):
+            if current != old:
+                break
+            shared += 1
+        # 最后一块可能不足 BLOCK_SIZE，按实际长度计
+        reused = min(len(text), shared * PromptCacheTracker.BLOCK_SIZE)
+        ratio = reused / len(text) if text else 0.0
+        PromptCacheTracker._fingerprints.set(chat_key, chain)
+        PromptCacheTracker._stats["requests"] += 1
+        PromptCacheTracker._stats["total_chars"] += len(text)
+        PromptCacheTracker._stats["reused_chars"] += reused
+        return ratio
+
+    @staticmethod
+    def stats() -> Dict[str, Any]:
+        data = dict(PromptCacheTracker._stats)
+        total = data["total_chars"]
+        data["reuse_ratio"] = data["reused_chars"] / total if total else 0.0
+        data["chats"] = len(PromptCacheTracker._fingerprints)
+        return data
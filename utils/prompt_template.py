@@ -0,0 +1,40 @@
+from __future__ import annotations
+
+import re
+from typing import Any, Dict, Tuple
+
+from .lru_cache import LRUCache
+
+
+class PromptTemplate:
+    """
+    预编译的指令模板
+
+    模板按 {name} 占位符切分为 字面量/变量 交替的片段并按模板内容缓存，
+    渲染时一次拼接完成。配置修改后模板内容变化即自动重新编译；
+    未提供值（或值为 None）的占位符原样保留，供后续环节（如 {memory_block}）替换。
+    """
+
+    _PLACEHOLDER_RE = re.compile(r"\{(\w+)\}")
+    _compiled = LRUCache(max_entries=32)
+
+    @staticmethod
+    def compile(template: str) -> Tuple[str, ...]:
+        """返回片段元组：偶数位为字面量，奇数位为变量名。"""
+        parts = PromptTemplate._compiled.get(template, count=False)
+        if parts is None:
+            parts = tuple(PromptTemplate._PLACEHOLDER_RE.split(template))
+            PromptTemplate._compiled.set(template, parts)
+        return parts
+
+    @staticmethod
+    def render(template: str, values: Dict[str, Any]) -> str:
+        parts = PromptTemplate.compile(template)
+        out = []
+        for idx, part in enumerate(parts):
+            if idx % 2 == 0:
+                out.append(part)
+                continue
+            value = values.get(part)
+            out.append("{" + part + "}" if value is None else str(value))
+        return "".join(out)
@@ -0,0 +1,104 @@
+from __future__ import annotations
+
+import math
+import re
+from typing import Any, List, Sequence
+
+from astrbot.api.all import logger
+
+
+class TokenEstimator:
+    """
+    提示词 token 估算与历史装箱
+
+    默认使用启发式估算：中日韩字符约 1 token/字，连续的字母数字约 4 字符/token，
+    其余标点符号各计 1 token，空白不计。配置 token_encoding（如 cl100k_base）
+    且安装了 tiktoken 时改用精确编码计数。
+    """
+
+    config = None
+    _encoder = None
+
+    _CJK = r"\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff"
+    _CJK_RE = re.compile(rf"[{_CJK}]")
+    _WORD_RE = re.compile(r"[A-Za-z0-9_]+")
+    _SYMBOL_RE = re.compile(rf"[^\sA-Za-z0-9_{_CJK}]")
+
+    PRIORITY_HIGH = 0
+    PRIORITY_NORMAL = 1
+
+    @staticmethod
+    def init(config: dict) -> None:
+        TokenEstimator.config = config
+        TokenEstimator._encoder = None
+        encoding = str(config.get("token_encoding", "") or "").strip() if config else ""
+        if not encoding:
+            return
+        try:
+            import tiktoken
+        except ImportError:
+            logger.info("[SpectreCore] 未安装 tiktoken，token 估算使用启发式算法。")
+            return
+        try:
+            TokenEstimator._encoder = tiktoken.get_encoding(encoding)
+        except Exception as e:
+            logger.warning(f"[SpectreCore] 加载 tiktoken 编码 {encoding} 失败，改用启发式估算: {e}")
+
+    @staticmethod
+    def estimate(text: str) -> int:
+        if not text:
+            return 0
+        if TokenEstimator._encoder is not None:
+            try:
+                return len(TokenEstimator._encoder.encode(text, disallowed_special=()))
+            except Exception:
+                pass
+        cjk = len(TokenEstimator._CJK_RE.findall(text))
+        words = sum(
+            math.ceil(len(w) / 4) for w in TokenEstimator._WORD_RE.findall(text)
+        )
+        symbols = len(TokenEstimator._SYMBOL_RE.findall(text))
+        return cjk + words + symbols
+
+    @staticmethod
+    def budget() -> int:
+        """历史区 token 预算，0 表示不限制（仅按条数截取）。"""
+        if not TokenEstimator.config:
+            return 0
+        try:
+            return max(0, int(TokenEstimator.config.get("history_token_budget", 0) or 0))
+        except (TypeError, ValueError):
+            return 0
+
+    @staticmethod
+    def pack(costs: Sequence[int], priorities: Sequence[int], budget: int) -> List[int]:
+        """
+        在预算内挑选历史条目，返回按原顺序排列的下标
+
+        最新一条始终保留；高优先级（机器人发言、被引用的消息）先入选，从新到旧、
+        放不下的跳过；其余条目从新到旧连续填充，遇到第一条放不下的即停止，
+        保证普通消息不会出现"跳过较长的一条、继续塞入更旧的短消息"的断档。
+        """
+        count = len(costs)
+        if count == 0:
+            return []
+        if budget <= 0:
+            return list(range(count))
+        kept = {count - 1}
+        used = costs[count - 1]
+        for idx in range(count - 2, -1, -1):
+            if priorities[idx] <= TokenEstimator.PRIORITY_HIGH and used + costs[idx] <= budget:
+                kept.add(idx)
+                used += costs[idx]
+        for idx in range(count - 2, -1, -1):
+            if idx in kept or priorities[idx] <= TokenEstimator.PRIORITY_HIGH:
+                continue
+            if used + costs[idx] > budget:
+                break
+            kept.add(idx)
+            used += costs[idx]
+        return sorted(kept)
+
+    @staticmethod
+    def format_report(sections: dict[str, Any]) -> str:
+        return " / ".join(f"{name} {tokens}" for name, tokens in sections.items())